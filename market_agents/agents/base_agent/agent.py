@@ -2,7 +2,7 @@ import uuid
 import json
 import logging
 from datetime import datetime
-from typing import Any, Dict, List, Optional, Type, Union
+from typing import Any, Dict, List, Literal, Optional, Type, Union
 
 from pydantic import BaseModel, Field
 from tenacity import retry, stop_after_attempt, wait_random_exponential
@@ -15,6 +15,20 @@ from market_agents.agents.base_agent.schemas import *
 
 agent_logger = logging.getLogger(__name__)
 
+_shared_ai_utilities: Optional[ParallelAIUtilities] = None
+
+
+def shared_ai_utilities() -> ParallelAIUtilities:
+    """The ParallelAIUtilities used by every agent that is not given its own.
+
+    Sharing it shares the rate limiters, so the requests of concurrently executing agents are
+    scheduled together (priority lanes and per-agent fair sharing, see inference/scheduling.py).
+    """
+    global _shared_ai_utilities
+    if _shared_ai_utilities is None:
+        _shared_ai_utilities = ParallelAIUtilities()
+    return _shared_ai_utilities
+
 
 class Agent(BaseModel):
     """Base class for all agents in the multi-agent system.
@@ -31,13 +45,14 @@ class Agent(BaseModel):
         max_retries (int): Maximum number of retry attempts for AI inference.
         metadata (Optional[Dict[str, Any]]): Additional metadata for the agent.
         interactions (List[Dict[str, Any]]): History of agent interactions.
+        ai_utilities (ParallelAIUtilities): Inference client, shared by all agents unless one is passed in.
 
     Methods:
-        execute(task: Optional[str] = None, output_format: Optional[Union[Dict[str, Any], str]] = None, return_prompt: bool = False) -> Union[str, Dict[str, Any], LLMPromptContext]:
+        execute(task: Optional[str] = None, output_format: Optional[Union[Dict[str, Any], str]] = None, return_prompt: bool = False, priority: str = "action") -> Union[str, Dict[str, Any], LLMPromptContext]:
             Execute a task and return the result or the prompt context.
         _load_output_schema(output_format: Optional[Union[Dict[str, Any], str]]) -> Optional[Dict[str, Any]]:
             Load the output schema based on the output_format.
-        _prepare_prompt_context(task: Optional[str], output_format: Optional[Dict[str, Any]]) -> LLMPromptContext:
+        _prepare_prompt_context(task: Optional[str], output_format: Optional[Dict[str, Any]], priority: str = "action") -> LLMPromptContext:
             Prepare LLMPromptContext for AI inference.
         _run_ai_inference(prompt_context: LLMPromptContext) -> Union[str, Dict[str, Any]]:
             Run AI inference with retry logic.
@@ -60,12 +75,13 @@ class Agent(BaseModel):
     class Config:
         extra = "allow"
 
-    def __init__(self, **data: Any):
+    def __init__(self, ai_utilities: Optional[ParallelAIUtilities] = None, **data: Any):
         super().__init__(**data)
-        self.ai_utilities = ParallelAIUtilities()
+        self.ai_utilities = ai_utilities if ai_utilities is not None else shared_ai_utilities()
 
-    async def execute(self, task: Optional[str] = None, output_format: Optional[Union[Dict[str, Any], str, Type[BaseModel]]] = None, return_prompt: bool = False) -> Union[str, Dict[str, Any], LLMPromptContext]:
-        """Execute a task and return the result or the prompt context."""
+    async def execute(self, task: Optional[str] = None, output_format: Optional[Union[Dict[str, Any], str, Type[BaseModel]]] = None, return_prompt: bool = False,
+                      priority: Literal["action", "perception", "reflection", "research_summary"] = "action") -> Union[str, Dict[str, Any], LLMPromptContext]:
+        """Execute a task and return the result or the prompt context, scheduled in the given priority lane."""
         execution_task = task if task is not None else self.task
         if execution_task is None:
             raise ValueError("No task provided. Agent needs a task to execute.")
@@ -81,7 +97,8 @@ class Agent(BaseModel):
 
         prompt_context = self._prepare_prompt_context(
             execution_task,
-            execution_output_format if isinstance(execution_output_format, dict) else None
+            execution_output_format if isinstance(execution_output_format, dict) else None,
+            priority
         )
         agent_logger.debug(f"Prepared LLMPromptContext:\n{json.dumps(prompt_context.model_dump(), indent=2)}")
         if return_prompt:
@@ -113,7 +130,8 @@ class Agent(BaseModel):
         else:
             return None
 
-    def _prepare_prompt_context(self, task: Optional[str], output_format: Optional[Dict[str, Any]] = None) -> LLMPromptContext:
+    def _prepare_prompt_context(self, task: Optional[str], output_format: Optional[Dict[str, Any]] = None,
+                                priority: Literal["action", "perception", "reflection", "research_summary"] = "action") -> LLMPromptContext:
         """Prepare LLMPromptContext for AI inference."""
         prompt_manager = PromptManager(
             role=self.role,
@@ -139,7 +157,8 @@ class Agent(BaseModel):
             system_string=system_message,
             new_message=user_message,
             llm_config=self.llm_config,
-            structured_output=structured_output
+            structured_output=structured_output,
+            priority=priority
         )
     
     @retry(
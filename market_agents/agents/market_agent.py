@@ -68,7 +68,7 @@ class MarketAgent(LLMAgent):
         
         prompt = self.prompt_manager.get_perception_prompt(variables.model_dump())
         
-        return await self.execute(prompt, output_format=PerceptionSchema.model_json_schema(), return_prompt=return_prompt)
+        return await self.execute(prompt, output_format=PerceptionSchema.model_json_schema(), return_prompt=return_prompt, priority="perception")
 
     async def generate_action(
             self,
@@ -172,7 +172,8 @@ class MarketAgent(LLMAgent):
         response = await self.execute(
             prompt,
             output_format=ReflectionSchema.model_json_schema(),
-            return_prompt=return_prompt
+            return_prompt=return_prompt,
+            priority="reflection"
         )
 
         if not return_prompt and isinstance(response, dict):
@@ -259,10 +259,11 @@ class MultiAgentEnvironment(BaseModel):
             GlobalObservation: Initial global observation of the environment.
         """
         self.current_step = 0
-        self.global_state = {}
         self.history = EnvironmentHistory()
         if isinstance(self.mechanism, Notebook):
             self.mechanism.text = ""
+        elif callable(getattr(self.mechanism, "reset", None)):
+            self.mechanism.reset()
         return GlobalObservation(observations={})
 
     def render(self):
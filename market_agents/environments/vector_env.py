@@ -0,0 +1,324 @@
+"""
+Batched stepping of many independent environment instances.
+
+`VectorEnvironment` steps K `MultiAgentEnvironment`s (e.g. one per point of a parameter sweep)
+with a list of `GlobalAction`s and resets finished ones, keeping the pydantic interface.
+
+`VectorDoubleAuction` is the array-backed counterpart of K `AuctionMarket`s for agents that do
+not need an LLM: the value and cost schedules, holdings, cash and standing orders of every
+market live in numpy arrays of shape (K, agents[, units]), and a step clears all K order books
+at once with the rule of `DoubleAuction._match_orders` (highest bid against lowest ask at the
+midpoint, until they cross). No pydantic model is built per step, so zero-intelligence traders
+(`zi_actions`, the rule of `EconomicAgent._calculate_bid_price` / `_calculate_ask_price`) run at
+millions of market-steps per minute, which is what calibrating market parameters against ZI
+allocative efficiency needs.
+"""
+
+from dataclasses import dataclass
+from typing import Callable, List, Optional, Sequence, Tuple, Union
+
+import numpy as np
+from pydantic import BaseModel, Field
+
+from market_agents.economics.econ_models import Trade
+from market_agents.environments.environment import EnvironmentStep, GlobalAction, GlobalObservation, MultiAgentEnvironment
+from market_agents.environments.mechanisms.auction import MarketSummary
+
+SweepValue = Union[float, List[float]]
+
+
+class VectorEnvironment:
+    """
+    Steps K independent `MultiAgentEnvironment`s together.
+
+    Parameters:
+    - env_factory: Builds the environment of an index, called once per instance.
+    - num_envs: Number of instances K.
+    - autoreset: Reset an instance right after the step that finished it (its history is lost).
+    """
+
+    def __init__(self, env_factory: Callable[[int], MultiAgentEnvironment], num_envs: int, autoreset: bool = False):
+        self.envs = [env_factory(index) for index in range(num_envs)]
+        self.autoreset = autoreset
+
+    @property
+    def num_envs(self) -> int:
+        return len(self.envs)
+
+    def reset(self, indices: Optional[Sequence[int]] = None) -> List[GlobalObservation]:
+        indices = range(self.num_envs) if indices is None else indices
+        return [self.envs[index].reset() for index in indices]
+
+    def step(self, actions: Sequence[GlobalAction]) -> List[EnvironmentStep]:
+        if len(actions) != self.num_envs:
+            raise ValueError(f"Expected {self.num_envs} actions, got {len(actions)}")
+        steps = []
+        for env, action in zip(self.envs, actions):
+            step = env.step(action)
+            if self.autoreset and (step.done or env.current_step >= env.max_steps):
+                env.reset()
+            steps.append(step)
+        return steps
+
+
+class VectorAuctionConfig(BaseModel):
+    num_envs: int = Field(default=1000, description="Number of independent markets K")
+    num_buyers: int = Field(default=10, description="Buyers per market")
+    num_sellers: int = Field(default=10, description="Sellers per market")
+    num_units: int = Field(default=10, description="Units in every buyer's value and seller's cost schedule")
+    max_rounds: int = Field(default=100, description="Rounds after which a market is done")
+    buyer_base_value: SweepValue = Field(default=100.0, description="Value of a buyer's first unit, one per market to sweep it")
+    seller_base_value: SweepValue = Field(default=60.0, description="Cost of a seller's first unit, one per market to sweep it")
+    noise_factor: SweepValue = Field(default=0.1, description="Upper bound of the 2%..noise_factor step between consecutive units, one per market to sweep it")
+    max_relative_spread: SweepValue = Field(default=0.2, description="Relative width of the ZI price range, one per market to sweep it")
+    endowment_factor: float = Field(default=1.2, description="Initial buyer cash as a multiple of the buyer's total value, as in BuyerPreferenceSchedule")
+    autoreset: bool = Field(default=False, description="Redraw the schedules of a market and restart it after the step that finished it")
+    seed: Optional[int] = Field(default=None, description="Seed of the random generator used for schedules and ZI prices")
+
+
+@dataclass
+class VectorAuctionStep:
+    """
+    The outcome of one step of all K markets, arrays indexed by market first.
+
+    Attributes:
+    - trades_count: (K,) trades executed.
+    - average_price: (K,) mean trade price, NaN without trades.
+    - min_price, max_price: (K,) price range of the trades, NaN without trades.
+    - best_bid, best_ask: (K,) best standing orders left after clearing, NaN when the side is empty.
+    - buyer_rewards: (K, buyers) surplus realized this step, value of the unit minus the price.
+    - seller_rewards: (K, sellers) surplus realized this step, price minus the cost of the unit.
+    - done: (K,) markets that reached max_rounds (already restarted with autoreset).
+    """
+
+    trades_count: np.ndarray
+    average_price: np.ndarray
+    min_price: np.ndarray
+    max_price: np.ndarray
+    best_bid: np.ndarray
+    best_ask: np.ndarray
+    buyer_rewards: np.ndarray
+    seller_rewards: np.ndarray
+    done: np.ndarray
+
+
+class VectorDoubleAuction:
+    """
+    K double auction markets for one good with array-backed state.
+
+    Every agent holds at most one standing order. A step takes one price per agent (NaN keeps the
+    standing order), replaces the standing orders with the new prices and clears every book.
+    Buyers trade the units of their value schedule in order and sellers those of their cost
+    schedule; agents whose schedule is used up are ignored.
+    """
+
+    def __init__(self, config: Optional[VectorAuctionConfig] = None):
+        self.config = config if config else VectorAuctionConfig()
+        self.rng = np.random.default_rng(self.config.seed)
+        shape = (self.config.num_envs,)
+        self.buyer_base_value = self._per_market(self.config.buyer_base_value, "buyer_base_value")
+        self.seller_base_value = self._per_market(self.config.seller_base_value, "seller_base_value")
+        self.noise_factor = self._per_market(self.config.noise_factor, "noise_factor")
+        self.max_relative_spread = self._per_market(self.config.max_relative_spread, "max_relative_spread")
+        K, B, S, U = self.config.num_envs, self.config.num_buyers, self.config.num_sellers, self.config.num_units
+        self.values = np.zeros((K, B, U))
+        self.costs = np.zeros((K, S, U))
+        self.units_bought = np.zeros((K, B), dtype=np.int64)
+        self.units_sold = np.zeros((K, S), dtype=np.int64)
+        self.buyer_cash = np.zeros((K, B))
+        self.buyer_surplus = np.zeros((K, B))
+        self.seller_surplus = np.zeros((K, S))
+        self.bids = np.full((K, B), np.nan)
+        self.asks = np.full((K, S), np.nan)
+        self.current_round = np.zeros(shape, dtype=np.int64)
+        self.trades_total = np.zeros(shape, dtype=np.int64)
+        # (market, buyer, seller, price, bid, ask) of the last step's trades, see trades()
+        self._last_trades = tuple(np.zeros(0, dtype=dtype) for dtype in (np.int64, np.int64, np.int64, float, float, float))
+        self.reset()
+
+    @property
+    def num_envs(self) -> int:
+        return self.config.num_envs
+
+    def _per_market(self, value: SweepValue, name: str) -> np.ndarray:
+        array = np.asarray(value, dtype=float)
+        if array.ndim == 1 and array.shape[0] != self.config.num_envs:
+            raise ValueError(f"{name} has {array.shape[0]} values for {self.config.num_envs} markets")
+        return np.broadcast_to(array, (self.config.num_envs,)).copy()
+
+    def reset(self, indices: Optional[Union[Sequence[int], np.ndarray]] = None) -> None:
+        """ Draws new schedules for the given markets (all by default) and clears their books, holdings and counters. """
+        index = np.arange(self.num_envs) if indices is None else np.asarray(indices)
+        if index.dtype == bool:
+            index = np.flatnonzero(index)
+        if index.size == 0:
+            return
+        self.values[index] = self._schedules(self.buyer_base_value[index], self.noise_factor[index], self.config.num_buyers, decreasing=True)
+        self.costs[index] = self._schedules(self.seller_base_value[index], self.noise_factor[index], self.config.num_sellers, decreasing=False)
+        self.buyer_cash[index] = self.values[index].sum(axis=2) * self.config.endowment_factor
+        for array in (self.units_bought, self.units_sold, self.buyer_surplus, self.seller_surplus):
+            array[index] = 0
+        self.bids[index] = np.nan
+        self.asks[index] = np.nan
+        self.current_round[index] = 0
+        self.trades_total[index] = 0
+
+    def _schedules(self, base_value: np.ndarray, noise_factor: np.ndarray, num_agents: int, decreasing: bool) -> np.ndarray:
+        # the unit to unit change of BuyerPreferenceSchedule / SellerPreferenceSchedule: 2%..noise_factor of the previous unit
+        low = np.full_like(noise_factor, 0.02)
+        steps = self.rng.uniform(low[:, None, None], np.maximum(noise_factor, low)[:, None, None], size=(len(base_value), num_agents, self.config.num_units))
+        factors = 1 - steps if decreasing else 1 + steps
+        return base_value[:, None, None] * np.cumprod(factors, axis=2)
+
+    def current_values(self) -> np.ndarray:
+        """ (K, buyers) value of each buyer's next unit, NaN when its schedule is used up. """
+        return self._next_unit(self.values, self.units_bought)
+
+    def current_costs(self) -> np.ndarray:
+        """ (K, sellers) cost of each seller's next unit, NaN when it has sold everything. """
+        return self._next_unit(self.costs, self.units_sold)
+
+    def _next_unit(self, schedules: np.ndarray, used: np.ndarray) -> np.ndarray:
+        units = self.config.num_units
+        unit = np.take_along_axis(schedules, np.minimum(used, units - 1)[:, :, None], axis=2)[:, :, 0]
+        return np.where(used < units, unit, np.nan)
+
+    def zi_actions(self) -> Tuple[np.ndarray, np.ndarray]:
+        """
+        Bids and asks of budget-constrained zero-intelligence traders for every market, drawn as
+        `EconomicAgent` does: a buyer bids uniformly in [(1 - spread) * m, m] with
+        m = min(cash, 0.99 * value of the next unit), a seller asks uniformly in
+        [c, (1 + spread) * c] with c = 1.01 * cost of the next unit.
+        """
+        spread = self.max_relative_spread[:, None]
+        max_bid = np.minimum(self.buyer_cash, self.current_values() * 0.99)
+        bids = max_bid * (1 - spread * self.rng.random(max_bid.shape))
+        min_ask = self.current_costs() * 1.01
+        asks = min_ask * (1 + spread * self.rng.random(min_ask.shape))
+        return bids, asks
+
+    def step(self, bids: Optional[np.ndarray] = None, asks: Optional[np.ndarray] = None) -> VectorAuctionStep:
+        """
+        Places the (K, buyers) bids and (K, sellers) asks, NaN or None keeping the standing orders,
+        and clears every market once.
+        """
+        K = self.num_envs
+        if bids is not None:
+            self.bids = np.where(np.isnan(bids), self.bids, bids)
+        if asks is not None:
+            self.asks = np.where(np.isnan(asks), self.asks, asks)
+        # agents without units left cannot trade
+        self.bids[self.units_bought >= self.config.num_units] = np.nan
+        self.asks[self.units_sold >= self.config.num_units] = np.nan
+        self.current_round += 1
+
+        bid_order = np.argsort(np.where(np.isnan(self.bids), np.inf, -self.bids), axis=1, kind="stable")
+        ask_order = np.argsort(np.where(np.isnan(self.asks), np.inf, self.asks), axis=1, kind="stable")
+        depth = min(self.config.num_buyers, self.config.num_sellers)
+        bid_order, ask_order = bid_order[:, :depth], ask_order[:, :depth]
+        sorted_bids = np.take_along_axis(self.bids, bid_order, axis=1)
+        sorted_asks = np.take_along_axis(self.asks, ask_order, axis=1)
+        # bids descend and asks ascend, so the crossing pairs are a prefix of every row (NaN never crosses)
+        matched = sorted_bids >= sorted_asks
+        markets, ranks = np.nonzero(matched)
+        buyers, sellers = bid_order[markets, ranks], ask_order[markets, ranks]
+        bid_prices, ask_prices = sorted_bids[markets, ranks], sorted_asks[markets, ranks]
+        prices = (bid_prices + ask_prices) / 2
+
+        buyer_rewards = np.zeros_like(self.buyer_surplus)
+        seller_rewards = np.zeros_like(self.seller_surplus)
+        buyer_rewards[markets, buyers] = self.values[markets, buyers, self.units_bought[markets, buyers]] - prices
+        seller_rewards[markets, sellers] = prices - self.costs[markets, sellers, self.units_sold[markets, sellers]]
+        self.buyer_surplus += buyer_rewards
+        self.seller_surplus += seller_rewards
+        self.buyer_cash[markets, buyers] -= prices
+        self.units_bought[markets, buyers] += 1
+        self.units_sold[markets, sellers] += 1
+        self.bids[markets, buyers] = np.nan
+        self.asks[markets, sellers] = np.nan
+        self._last_trades = (markets, buyers, sellers, prices, bid_prices, ask_prices)
+
+        trades_count = np.bincount(markets, minlength=K)
+        self.trades_total += trades_count
+        with np.errstate(invalid="ignore"):
+            average_price = np.bincount(markets, weights=prices, minlength=K) / trades_count
+        min_price = np.full(K, np.inf)
+        max_price = np.full(K, -np.inf)
+        np.minimum.at(min_price, markets, prices)
+        np.maximum.at(max_price, markets, prices)
+        no_trades = trades_count == 0
+        min_price[no_trades] = np.nan
+        max_price[no_trades] = np.nan
+
+        done = self.current_round >= self.config.max_rounds
+        step = VectorAuctionStep(
+            trades_count=trades_count,
+            average_price=average_price,
+            min_price=min_price,
+            max_price=max_price,
+            best_bid=self._best(self.bids, np.fmax),
+            best_ask=self._best(self.asks, np.fmin),
+            buyer_rewards=buyer_rewards,
+            seller_rewards=seller_rewards,
+            done=done,
+        )
+        if self.config.autoreset and done.any():
+            self.reset(done)
+        return step
+
+    @staticmethod
+    def _best(orders: np.ndarray, reduce) -> np.ndarray:
+        best = np.full(orders.shape[0], np.nan)
+        if orders.shape[1]:
+            best = reduce.reduce(orders, axis=1)
+        return best
+
+    def run_zi(self, num_rounds: Optional[int] = None) -> np.ndarray:
+        """ Runs `num_rounds` (default max_rounds) of ZI trading in every market and returns the trades per market. """
+        trades = np.zeros(self.num_envs, dtype=np.int64)
+        for _ in range(num_rounds if num_rounds is not None else self.config.max_rounds):
+            trades += self.step(*self.zi_actions()).trades_count
+        return trades
+
+    def equilibrium(self) -> Tuple[np.ndarray, np.ndarray, np.ndarray]:
+        """
+        (K,) competitive equilibrium price, quantity and total surplus of each market's schedules,
+        computed as `Equilibrium` does from the aggregated demand and supply curves.
+        """
+        K = self.num_envs
+        demand = -np.sort(-self.values.reshape(K, -1), axis=1)
+        supply = np.sort(self.costs.reshape(K, -1), axis=1)
+        depth = min(demand.shape[1], supply.shape[1])
+        demand, supply = demand[:, :depth], supply[:, :depth]
+        crossing = demand >= supply
+        quantity = crossing.sum(axis=1)
+        surplus = np.where(crossing, demand - supply, 0.0).sum(axis=1)
+        last = np.maximum(quantity - 1, 0)[:, None]
+        price = (np.take_along_axis(demand, last, axis=1) + np.take_along_axis(supply, last, axis=1))[:, 0] / 2
+        return np.where(quantity > 0, price, 0.0), quantity, surplus
+
+    def efficiency(self) -> np.ndarray:
+        """ (K,) realized surplus since the last reset over the equilibrium surplus, the allocative efficiency of the market. """
+        _, _, max_surplus = self.equilibrium()
+        realized = self.buyer_surplus.sum(axis=1) + self.seller_surplus.sum(axis=1)
+        with np.errstate(invalid="ignore", divide="ignore"):
+            return np.where(max_surplus > 0, realized / max_surplus, np.nan)
+
+    def trades(self, market: int, good_name: str = "apple") -> List[Trade]:
+        """ The last step's trades of one market as `Trade` models, for inspection next to `DoubleAuction` results. """
+        markets, buyers, sellers, prices, bid_prices, ask_prices = self._last_trades
+        rows = np.flatnonzero(markets == market)
+        first_id = max(int(self.trades_total[market]) - len(rows), 0)
+        return [
+            Trade(trade_id=first_id + i, buyer_id=f"buyer_{buyers[row]}", seller_id=f"seller_{sellers[row]}", price=float(prices[row]),
+                  quantity=1, good_name=good_name, bid_price=float(bid_prices[row]), ask_price=float(ask_prices[row]))
+            for i, row in enumerate(rows)
+        ]
+
+    def market_summary(self, market: int) -> MarketSummary:
+        """ The last step of one market as the `MarketSummary` of `DoubleAuction`. """
+        prices = self._last_trades[3][self._last_trades[0] == market]
+        if not len(prices):
+            return MarketSummary()
+        return MarketSummary(trades_count=len(prices), average_price=float(prices.mean()), total_volume=len(prices),
+                             price_range=(float(prices.min()), float(prices.max())))
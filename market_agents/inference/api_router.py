@@ -1,41 +1,306 @@
+import asyncio
 import logging
+import os
+import random
+import time
+from collections import defaultdict
+from typing import Any, AsyncIterator, Awaitable, Callable, Dict, List, Optional, Tuple
+
+import httpx
+import yaml
 from fastapi import FastAPI, Request, HTTPException, Depends
+from fastapi.responses import Response, StreamingResponse
 from fastapi.security import HTTPBearer, HTTPAuthorizationCredentials
 from contextlib import asynccontextmanager
-import httpx
-import os
+from pydantic import BaseModel, Field, model_validator
 
 # Configure logging
 logging.basicConfig(level=logging.INFO)
 logger = logging.getLogger("uvicorn.error")
 
+
+class BackendConfig(BaseModel):
+    api_url: str = Field(description="The chat completions URL of the backend")
+    model: str = Field(description="The model identifier expected by the backend")
+    api_key: Optional[str] = Field(default=None, description="Bearer token of the backend, defaults to ROUTER_BACKEND_API_KEY")
+    weight: float = Field(default=1.0, gt=0, description="Share of the model's traffic relative to the other backends")
+
+
+class ModelRoute(BaseModel):
+    backends: List[BackendConfig] = Field(description="The backends serving the model")
+
+    @model_validator(mode="before")
+    @classmethod
+    def single_backend(cls, data: Any) -> Any:
+        # `api_url`/`model` directly under the model name is shorthand for a single backend
+        if isinstance(data, dict) and "backends" not in data:
+            return {"backends": [data]}
+        return data
+
+
+class RouterConfig(BaseModel):
+    model_configs: Dict[str, ModelRoute] = Field(default_factory=dict, description="Public model name to backends")
+    max_concurrent_requests_per_backend: int = Field(default=64, description="Requests in flight to one backend, further requests are queued")
+    max_queue_size: int = Field(default=1024, description="Requests waiting for a backend slot before new ones are rejected with 429")
+    queue_timeout: float = Field(default=30.0, description="Seconds a request may wait for a backend slot before failing with 503")
+    request_timeout: float = Field(default=60.0, description="Seconds to wait for the backend response (between chunks when streaming)")
+    max_connections: int = Field(default=512, description="Size of the shared backend connection pool")
+    max_keepalive_connections: int = Field(default=128, description="Idle keep-alive connections kept in the pool")
+
+    @model_validator(mode="before")
+    @classmethod
+    def drop_empty_models(cls, data: Any) -> Any:
+        if isinstance(data, dict) and data.get("model_configs") is None:
+            data = {**data, "model_configs": {}}
+        return data
+
+
+def load_router_config(path: Optional[str] = None) -> RouterConfig:
+    """ Reads the model to backend map from `path`, API_ROUTER_CONFIG or the api_config.yaml next to this module. """
+    path = path or os.getenv("API_ROUTER_CONFIG", os.path.join(os.path.dirname(__file__), "api_config.yaml"))
+    with open(path) as file:
+        return RouterConfig(**(yaml.safe_load(file) or {}))
+
+
+class Backend:
+    """ A backend of one model with its share of the traffic and a bound on its requests in flight. """
+
+    def __init__(self, model_name: str, config: BackendConfig, default_api_key: str):
+        self.model_name = model_name
+        self.config = config
+        self.headers = {
+            "Content-Type": "application/json",
+            "Authorization": f"Bearer {config.api_key or default_api_key}",
+        }
+        self.in_flight = 0
+
+
+class LatencyHistogram:
+    """ Cumulative Prometheus-style histogram of request durations in seconds. """
+
+    buckets = (0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0, 60.0, float("inf"))
+
+    def __init__(self):
+        self.counts = [0] * len(self.buckets)
+        self.sum = 0.0
+        self.count = 0
+
+    def observe(self, seconds: float) -> None:
+        for index, bound in enumerate(self.buckets):
+            if seconds <= bound:
+                self.counts[index] += 1
+        self.sum += seconds
+        self.count += 1
+
+
+class RouterMetrics:
+    """ Throughput, latency, backpressure and upstream error counters, rendered in the Prometheus text format. """
+
+    def __init__(self):
+        self.requests: Dict[Tuple[str, str, str], int] = defaultdict(int)
+        self.rejected: Dict[Tuple[str, str], int] = defaultdict(int)
+        self.latency: Dict[Tuple[str, str], LatencyHistogram] = defaultdict(LatencyHistogram)
+        self.queued = 0
+
+    def render(self, router: "Router") -> str:
+        lines = [
+            "# HELP router_requests_total Requests forwarded to a backend by status code.",
+            "# TYPE router_requests_total counter",
+        ]
+        for (model, backend, status), value in sorted(self.requests.items()):
+            lines.append(f'router_requests_total{{model="{model}",backend="{backend}",status="{status}"}} {value}')
+        lines += [
+            "# HELP router_rejected_requests_total Requests rejected before reaching a backend.",
+            "# TYPE router_rejected_requests_total counter",
+        ]
+        for (model, reason), value in sorted(self.rejected.items()):
+            lines.append(f'router_rejected_requests_total{{model="{model}",reason="{reason}"}} {value}')
+        lines += [
+            "# HELP router_request_duration_seconds Time from dispatch to the end of the backend response.",
+            "# TYPE router_request_duration_seconds histogram",
+        ]
+        for (model, backend), histogram in sorted(self.latency.items()):
+            labels = f'model="{model}",backend="{backend}"'
+            for bound, count in zip(histogram.buckets, histogram.counts):
+                le = "+Inf" if bound == float("inf") else f"{bound}"
+                lines.append(f'router_request_duration_seconds_bucket{{{labels},le="{le}"}} {count}')
+            lines.append(f"router_request_duration_seconds_sum{{{labels}}} {histogram.sum}")
+            lines.append(f"router_request_duration_seconds_count{{{labels}}} {histogram.count}")
+        lines += [
+            "# HELP router_in_flight_requests Requests currently in flight to a backend.",
+            "# TYPE router_in_flight_requests gauge",
+        ]
+        for backends in router.backends.values():
+            for backend in backends:
+                lines.append(f'router_in_flight_requests{{model="{backend.model_name}",backend="{backend.config.api_url}"}} {backend.in_flight}')
+        lines += [
+            "# HELP router_queued_requests Requests waiting for a backend slot.",
+            "# TYPE router_queued_requests gauge",
+            f"router_queued_requests {self.queued}",
+        ]
+        return "\n".join(lines) + "\n"
+
+
+class _ClosingStreamingResponse(StreamingResponse):
+    """
+    A `StreamingResponse` that awaits `on_close` however sending ends, also when the client
+    disconnects before the body iterator was ever started and its own cleanup cannot run.
+    """
+
+    def __init__(self, content: AsyncIterator[bytes], on_close: Callable[[], Awaitable[None]], **kwargs: Any):
+        super().__init__(content, **kwargs)
+        self.on_close = on_close
+
+    async def __call__(self, scope, receive, send) -> None:
+        try:
+            await super().__call__(scope, receive, send)
+        finally:
+            await self.on_close()
+
+
+class Router:
+    """
+    Routes OpenAI-style chat completions to the backends of the requested model.
+
+    A backend is drawn at random in proportion to its weight among those below
+    `max_concurrent_requests_per_backend`. When every backend of the model is saturated the
+    request waits for a slot; once `max_queue_size` requests are waiting new ones are rejected
+    with 429 so callers back off instead of piling up. All backends share one pooled
+    `httpx.AsyncClient`, and streamed responses are passed through chunk by chunk.
+    """
+
+    def __init__(self, config: RouterConfig, default_api_key: str):
+        self.config = config
+        self.backends = {
+            model_name: [Backend(model_name, backend, default_api_key) for backend in route.backends]
+            for model_name, route in config.model_configs.items()
+        }
+        self.metrics = RouterMetrics()
+        self.client: Optional[httpx.AsyncClient] = None
+        self._slot_released: Optional[asyncio.Condition] = None
+
+    async def start(self) -> None:
+        self.client = httpx.AsyncClient(
+            timeout=httpx.Timeout(self.config.request_timeout, connect=10.0),
+            limits=httpx.Limits(max_connections=self.config.max_connections, max_keepalive_connections=self.config.max_keepalive_connections),
+        )
+        self._slot_released = asyncio.Condition()
+
+    async def stop(self) -> None:
+        if self.client is not None:
+            await self.client.aclose()
+            self.client = None
+
+    def _pick(self, backends: List[Backend]) -> Optional[Backend]:
+        available = [backend for backend in backends if backend.in_flight < self.config.max_concurrent_requests_per_backend]
+        if not available:
+            return None
+        return random.choices(available, weights=[backend.config.weight for backend in available])[0]
+
+    async def acquire(self, model_name: str) -> Backend:
+        backends = self.backends[model_name]
+        backend = self._pick(backends)
+        if backend is None:
+            if self.metrics.queued >= self.config.max_queue_size:
+                self.metrics.rejected[(model_name, "queue_full")] += 1
+                raise HTTPException(status_code=429, detail="Router queue is full, retry later.", headers={"Retry-After": "1"})
+            self.metrics.queued += 1
+            try:
+                async with self._slot_released:
+                    await asyncio.wait_for(
+                        self._slot_released.wait_for(lambda: self._pick(backends) is not None),
+                        timeout=self.config.queue_timeout,
+                    )
+                    backend = self._pick(backends)
+            except asyncio.TimeoutError:
+                self.metrics.rejected[(model_name, "queue_timeout")] += 1
+                raise HTTPException(status_code=503, detail=f"No backend for model '{model_name}' became available in time.")
+            finally:
+                self.metrics.queued -= 1
+        backend.in_flight += 1
+        return backend
+
+    async def release(self, backend: Backend, status: str, start_time: float) -> None:
+        backend.in_flight -= 1
+        self.metrics.requests[(backend.model_name, backend.config.api_url, status)] += 1
+        self.metrics.latency[(backend.model_name, backend.config.api_url)].observe(time.perf_counter() - start_time)
+        async with self._slot_released:
+            self._slot_released.notify_all()
+
+    async def forward(self, model_name: str, request_body: Dict[str, Any]) -> Response:
+        backend = await self.acquire(model_name)
+        start_time = time.perf_counter()
+        # Replace the model name with the actual model identifier expected by the backend
+        backend_request_body = dict(request_body, model=backend.config.model)
+        backend_request = self.client.build_request("POST", backend.config.api_url, json=backend_request_body, headers=backend.headers)
+        try:
+            backend_response = await self.client.send(backend_request, stream=True)
+        except httpx.HTTPError as exc:
+            logger.error(f"Error while requesting backend model '{model_name}' at {backend.config.api_url}: {exc}")
+            await self.release(backend, "error", start_time)
+            raise HTTPException(status_code=502, detail=str(exc))
+
+        headers = {name: value for name, value in backend_response.headers.items()
+                   if name.lower() in ("content-type", "retry-after") or name.lower().startswith("x-ratelimit-")}
+        if request_body.get("stream"):
+            finished = False
+            status = str(backend_response.status_code)
+
+            async def finish() -> None:
+                # runs once, whether the stream completed, the upstream failed or the client went away
+                nonlocal finished
+                if finished:
+                    return
+                finished = True
+                try:
+                    await backend_response.aclose()
+                finally:
+                    await self.release(backend, status, start_time)
+
+            async def relay() -> AsyncIterator[bytes]:
+                nonlocal status
+                try:
+                    async for chunk in backend_response.aiter_raw():
+                        yield chunk
+                except httpx.HTTPError as exc:
+                    status = "error"
+                    logger.error(f"Error while streaming the response of backend model '{model_name}' at {backend.config.api_url}: {exc}")
+                    raise
+                finally:
+                    await finish()
+
+            # pass the server-sent events through as they arrive instead of buffering the whole answer
+            return _ClosingStreamingResponse(relay(), on_close=finish, status_code=backend_response.status_code, headers=headers)
+        try:
+            content = await backend_response.aread()
+        except httpx.HTTPError as exc:
+            logger.error(f"Error while reading the response of backend model '{model_name}' at {backend.config.api_url}: {exc}")
+            raise HTTPException(status_code=502, detail=str(exc))
+        finally:
+            await backend_response.aclose()
+            await self.release(backend, str(backend_response.status_code), start_time)
+        # the body is forwarded as is, without decoding and re-encoding the JSON
+        return Response(content=content, status_code=backend_response.status_code, headers=headers)
+
+
+# Local API key for authentication
+API_KEY = os.getenv("ROUTER_API_KEY", "MarketAgents")
+
+router = Router(load_router_config(), default_api_key=os.getenv("ROUTER_BACKEND_API_KEY", API_KEY))
+
+
 @asynccontextmanager
 async def lifespan(app: FastAPI):
     # Startup code
     logger.info("Starting up the server...")
+    await router.start()
     yield
-    # Shutdown code (if any)
+    # Shutdown code
+    await router.stop()
     logger.info("Shutting down the server...")
 
 app = FastAPI(lifespan=lifespan)
 
-# Define your model configurations
-model_configs = {
-    "Hermes-3": {
-        "api_url": "https://hermes-70b.legendarywou.com/v1/chat/completions",
-        "api_key": "MarketAgents",
-        "model": "/models/Hermes-3-Llama-3.1-70B-FP8",
-    },
-    "llama-3.1-70b": {
-        "api_url": "https://llama3-70b.legendarywou.com/v1/chat/completions",
-        "api_key": "MarketAgents",
-        "model": "/models/Meta-Llama-3.1-70B-Instruct-FP8",
-    },
-}
-
-# Local API key for authentication
-API_KEY = "MarketAgents"
-
 security = HTTPBearer()
 
 async def verify_api_key(credentials: HTTPAuthorizationCredentials = Depends(security)):
@@ -43,14 +308,6 @@ async def verify_api_key(credentials: HTTPAuthorizationCredentials = Depends(sec
         logger.warning("Invalid API Key provided")
         raise HTTPException(status_code=403, detail="Invalid API Key")
 
-# Add middleware to log requests
-@app.middleware("http")
-async def log_requests(request: Request, call_next):
-    logger.info(f"Received request: {request.method} {request.url}")
-    response = await call_next(request)
-    logger.info(f"Response status code: {response.status_code}")
-    return response
-
 @app.post("/v1/chat/completions")
 async def chat_completions(
     request: Request,
@@ -58,47 +315,23 @@ async def chat_completions(
 ):
     request_body = await request.json()
     model_name = request_body.get("model")
-    
-    logger.info(f"Received request for model: {model_name}")
-    
+
+    logger.debug(f"Received request for model: {model_name}")
+
     if not model_name:
         logger.error("Model name is missing in the request.")
         raise HTTPException(status_code=400, detail="Model name is required.")
 
     # Check if the model is in our configs
-    config = model_configs.get(model_name)
-    if not config:
+    if model_name not in router.backends:
         logger.error(f"Model '{model_name}' is not available.")
         raise HTTPException(status_code=400, detail=f"Model '{model_name}' is not available.")
-    
-    # Prepare the request for the backend API
-    backend_request_body = request_body.copy()
-    # Replace the model name with the actual model identifier expected by the backend
-    backend_request_body["model"] = config["model"]
-    
-    # Extract headers
-    headers = {
-        "Content-Type": "application/json",
-        "Authorization": f"Bearer {config['api_key']}",
-    }
-    
-    # Send the request to the backend API
-    async with httpx.AsyncClient() as client:
-        try:
-            backend_response = await client.post(
-                config["api_url"],
-                json=backend_request_body,
-                headers=headers,
-                timeout=60.0  # Adjust timeout as needed
-            )
-            backend_response.raise_for_status()
-            logger.info(f"Successfully got response from backend model '{model_name}'.")
-        except httpx.HTTPError as exc:
-            logger.error(f"Error while requesting backend model '{model_name}': {exc}")
-            raise HTTPException(status_code=500, detail=str(exc))
-    
-    # Return the response from the backend API
-    return backend_response.json()
+
+    return await router.forward(model_name, request_body)
+
+@app.get("/metrics")
+async def metrics():
+    return Response(content=router.metrics.render(router), media_type="text/plain; version=0.0.4")
 
 # If running directly, start the server
 if __name__ == "__main__":
@@ -0,0 +1,164 @@
+import asyncio
+import json
+import logging
+import time
+from typing import Any, Dict, List, Optional, Tuple
+
+import aiohttp
+from pydantic import BaseModel, Field
+
+from market_agents.inference.oai_parallel import request_header_from_url
+
+
+class BatchJobConfig(BaseModel):
+    poll_interval: float = Field(default=30.0, description="Seconds between two status checks of a submitted batch")
+    timeout: Optional[float] = Field(default=None, description="Seconds to wait for a batch before giving up, None to wait for the provider's completion window")
+    completion_window: str = Field(default="24h", description="The OpenAI batch completion window")
+
+
+class BatchJobError(Exception):
+    """ Raised when a batch job cannot be submitted, fails as a whole or does not finish in time. """
+
+
+async def _read_json(response: aiohttp.ClientResponse) -> Dict[str, Any]:
+    if response.status >= 400:
+        # error pages from proxies and gateways are not always JSON
+        raise BatchJobError(f"Batch API request to {response.url} failed with status {response.status}: {await response.text()}")
+    return await response.json(content_type=None)
+
+
+class OpenAIBatchClient:
+    """
+    Submits chat completion requests through the OpenAI Batch API: the requests are uploaded as
+    a JSONL file, a batch is created on `/v1/chat/completions`, polled until it leaves the
+    in-progress states, and the output (and error) files are downloaded and keyed by custom_id.
+    """
+
+    terminal_statuses = {"completed", "failed", "expired", "cancelled"}
+
+    def __init__(self, session: aiohttp.ClientSession, api_key: str, base_url: str = "https://api.openai.com/v1"):
+        self.session = session
+        self.base_url = base_url.rstrip("/")
+        self.headers = request_header_from_url(f"{self.base_url}/chat/completions", api_key)
+
+    async def submit(self, requests: List[Tuple[str, Dict[str, Any]]], config: BatchJobConfig) -> str:
+        lines = "".join(
+            json.dumps({"custom_id": custom_id, "method": "POST", "url": "/v1/chat/completions", "body": request}) + "\n"
+            for custom_id, request in requests
+        )
+        form = aiohttp.FormData()
+        form.add_field("purpose", "batch")
+        form.add_field("file", lines.encode("utf-8"), filename="batch_requests.jsonl", content_type="application/jsonl")
+        async with self.session.post(f"{self.base_url}/files", headers=self.headers, data=form) as response:
+            input_file = await _read_json(response)
+        batch_request = {
+            "input_file_id": input_file["id"],
+            "endpoint": "/v1/chat/completions",
+            "completion_window": config.completion_window,
+        }
+        async with self.session.post(f"{self.base_url}/batches", headers=self.headers, json=batch_request) as response:
+            batch = await _read_json(response)
+        return batch["id"]
+
+    async def retrieve(self, batch_id: str) -> Dict[str, Any]:
+        async with self.session.get(f"{self.base_url}/batches/{batch_id}", headers=self.headers) as response:
+            return await _read_json(response)
+
+    def is_finished(self, batch: Dict[str, Any]) -> bool:
+        return batch["status"] in self.terminal_statuses
+
+    async def _file_lines(self, file_id: Optional[str]) -> List[Dict[str, Any]]:
+        if not file_id:
+            return []
+        async with self.session.get(f"{self.base_url}/files/{file_id}/content", headers=self.headers) as response:
+            if response.status >= 400:
+                raise BatchJobError(f"Downloading batch file {file_id} failed with status {response.status}")
+            text = await response.text()
+        return [json.loads(line) for line in text.splitlines() if line.strip()]
+
+    async def results(self, batch: Dict[str, Any]) -> Dict[str, Dict[str, Any]]:
+        results = {}
+        for line in await self._file_lines(batch.get("output_file_id")) + await self._file_lines(batch.get("error_file_id")):
+            response = line.get("response") or {}
+            if line.get("error") or response.get("status_code", 200) >= 400:
+                results[line["custom_id"]] = {"error": str(line.get("error") or response.get("body"))}
+            else:
+                results[line["custom_id"]] = response["body"]
+        return results
+
+
+class AnthropicBatchClient:
+    """
+    Submits Messages requests through the Anthropic Message Batches API: the requests are posted
+    inline, the batch is polled until its processing status is `ended`, and the JSONL results are
+    downloaded from the batch `results_url` and keyed by custom_id.
+    """
+
+    def __init__(self, session: aiohttp.ClientSession, api_key: str, base_url: str = "https://api.anthropic.com/v1"):
+        self.session = session
+        self.base_url = base_url.rstrip("/")
+        self.headers = request_header_from_url(f"{self.base_url}/messages", api_key)
+        self.headers["anthropic-beta"] = "prompt-caching-2024-07-31,message-batches-2024-09-24"
+
+    async def submit(self, requests: List[Tuple[str, Dict[str, Any]]], config: BatchJobConfig) -> str:
+        body = {"requests": [{"custom_id": custom_id, "params": request} for custom_id, request in requests]}
+        async with self.session.post(f"{self.base_url}/messages/batches", headers=self.headers, json=body) as response:
+            batch = await _read_json(response)
+        return batch["id"]
+
+    async def retrieve(self, batch_id: str) -> Dict[str, Any]:
+        async with self.session.get(f"{self.base_url}/messages/batches/{batch_id}", headers=self.headers) as response:
+            return await _read_json(response)
+
+    def is_finished(self, batch: Dict[str, Any]) -> bool:
+        return batch["processing_status"] == "ended"
+
+    async def results(self, batch: Dict[str, Any]) -> Dict[str, Dict[str, Any]]:
+        results_url = batch.get("results_url") or f"{self.base_url}/messages/batches/{batch['id']}/results"
+        async with self.session.get(results_url, headers=self.headers) as response:
+            if response.status >= 400:
+                raise BatchJobError(f"Downloading batch results {results_url} failed with status {response.status}")
+            text = await response.text()
+        results = {}
+        for line in text.splitlines():
+            if not line.strip():
+                continue
+            entry = json.loads(line)
+            result = entry["result"]
+            if result["type"] == "succeeded":
+                results[entry["custom_id"]] = result["message"]
+            else:
+                results[entry["custom_id"]] = {"error": str(result.get("error") or result["type"])}
+        return results
+
+
+async def run_batch_job(
+    batch_client,
+    requests: List[Tuple[str, Dict[str, Any]]],
+    config: Optional[BatchJobConfig] = None,
+) -> Dict[str, Dict[str, Any]]:
+    """
+    Submits `(custom_id, request_json)` pairs as one batch, waits for it and returns the raw
+    responses keyed by custom_id. Requests the provider did not answer are missing from the result.
+
+    Parameters:
+    - batch_client: An `OpenAIBatchClient` or `AnthropicBatchClient`.
+    - requests: The provider request payloads, custom_ids must be unique within the batch.
+    - config: Polling interval and timeout.
+    """
+    config = config if config else BatchJobConfig()
+    custom_ids = [custom_id for custom_id, _ in requests]
+    if len(set(custom_ids)) != len(custom_ids):
+        raise BatchJobError("custom_id values must be unique within a batch")
+    batch_id = await batch_client.submit(requests, config)
+    logging.info(f"Submitted batch {batch_id} with {len(requests)} requests")
+    deadline = time.time() + config.timeout if config.timeout is not None else None
+    while True:
+        batch = await batch_client.retrieve(batch_id)
+        if batch_client.is_finished(batch):
+            break
+        if deadline is not None and time.time() >= deadline:
+            raise BatchJobError(f"Batch {batch_id} did not finish within {config.timeout} seconds")
+        await asyncio.sleep(config.poll_interval)
+    logging.info(f"Batch {batch_id} finished")
+    return await batch_client.results(batch)
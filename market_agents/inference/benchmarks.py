@@ -0,0 +1,226 @@
+"""
+Micro-benchmarks for the hot paths of the inference stack.
+
+Each benchmark builds synthetic but realistically shaped market-agent requests (one shared
+system prompt, per-agent persona and observation, a few turns of history) and reports the
+wall time of the operation per batch.
+
+Usage:
+    python -m market_agents.inference.benchmarks tokens --num-requests 10000
+    python -m market_agents.inference.benchmarks parsing --num-requests 1000
+    python -m market_agents.inference.benchmarks requests --num-requests 10000
+"""
+
+import argparse
+import json
+import random
+import time
+from typing import Any, Dict, List
+
+import tiktoken
+from openai.types.chat import ChatCompletion
+
+from market_agents.inference.clients_models import OpenAIRequest
+from market_agents.inference.message_models import LLMConfig, LLMOutput, LLMPromptContext, StructuredTool
+from market_agents.inference.oai_parallel import (
+    count_text_tokens,
+    get_token_encoding,
+    num_tokens_consumed_from_request,
+)
+from market_agents.inference.request_builder import RequestBuilder
+
+SYSTEM_PROMPT = (
+    "You are a market agent participating in a double auction. You receive private values or costs "
+    "for a single good and must decide whether to submit a bid or an ask each round. Reason about the "
+    "market state, the order book and your past trades before acting. Always answer with a JSON object "
+    "that follows the provided schema. " * 6
+)
+
+
+def synthetic_chat_requests(num_requests: int, num_agents: int = 100, history_turns: int = 2, seed: int = 0) -> List[Dict[str, Any]]:
+    """Builds OpenAI-style chat requests that share the system prompt and persona texts across rounds."""
+    rng = random.Random(seed)
+    personas = [f"Agent {i} is a {rng.choice(['cautious', 'aggressive', 'neutral'])} trader with budget {rng.randint(100, 1000)}." for i in range(num_agents)]
+    requests = []
+    for i in range(num_requests):
+        agent = i % num_agents
+        messages = [{"role": "system", "content": SYSTEM_PROMPT + personas[agent]}]
+        for turn in range(history_turns):
+            messages.append({"role": "user", "content": f"Round {turn}: best bid {rng.randint(1, 100)}, best ask {rng.randint(1, 100)}."})
+            messages.append({"role": "assistant", "content": '{"action": "bid", "price": %d, "quantity": 1}' % rng.randint(1, 100)})
+        messages.append({"role": "user", "content": f"Round {history_turns}: the last trade cleared at {rng.randint(1, 100)}. What is your next action?"})
+        requests.append({"model": "gpt-4o-mini", "messages": messages, "max_tokens": 400, "temperature": 0})
+    return requests
+
+
+def _uncached_chat_tokens(request_json: Dict[str, Any], token_encoding_name: str) -> int:
+    # the estimation as it was done before encoders and counts were cached
+    encoding = tiktoken.get_encoding(token_encoding_name)
+    num_tokens = 0
+    for message in request_json["messages"]:
+        num_tokens += 4
+        for value in message.values():
+            num_tokens += len(encoding.encode(value))
+    return num_tokens + 2 + request_json["max_tokens"]
+
+
+def benchmark_token_estimation(num_requests: int = 10_000, token_encoding_name: str = "cl100k_base") -> Dict[str, float]:
+    """Returns the seconds spent estimating the token consumption of `num_requests` chat requests per strategy."""
+    requests = synthetic_chat_requests(num_requests)
+    get_token_encoding(token_encoding_name)  # load the encoding outside of the timings
+    results = {}
+
+    start = time.perf_counter()
+    for request in requests:
+        _uncached_chat_tokens(request, token_encoding_name)
+    results["uncached"] = time.perf_counter() - start
+
+    count_text_tokens.cache_clear()
+    start = time.perf_counter()
+    for request in requests:
+        num_tokens_consumed_from_request(request, "chat/completions", token_encoding_name)
+    results["exact_cold_memo"] = time.perf_counter() - start
+
+    start = time.perf_counter()
+    for request in requests:
+        num_tokens_consumed_from_request(request, "chat/completions", token_encoding_name)
+    results["exact_warm_memo"] = time.perf_counter() - start
+
+    start = time.perf_counter()
+    for request in requests:
+        num_tokens_consumed_from_request(request, "chat/completions", token_encoding_name, approximate=True)
+    results["approximate"] = time.perf_counter() - start
+    return results
+
+
+ACTION_SCHEMA = {
+    "type": "object",
+    "properties": {
+        "action": {"type": "string", "enum": ["bid", "ask", "hold"]},
+        "price": {"type": "number"},
+        "quantity": {"type": "integer"},
+        "reasoning": {"type": "string"},
+    },
+    "required": ["action", "price", "quantity"],
+}
+
+
+def synthetic_chat_results(num_results: int, seed: int = 0) -> List[List[Dict[str, Any]]]:
+    """Builds `[request, response]` pairs of structured agent actions, alternating tool calls and json_schema content."""
+    rng = random.Random(seed)
+    results = []
+    for i in range(num_results):
+        action = json.dumps({"action": rng.choice(["bid", "ask"]), "price": rng.randint(1, 100), "quantity": 1,
+                             "reasoning": "The spread is narrowing and my private value leaves room for profit. " * 3})
+        if i % 2:
+            request = {"model": "gpt-4o-mini", "tools": [{"type": "function", "function": {"name": "act", "parameters": ACTION_SCHEMA}}]}
+            message = {"role": "assistant", "content": None,
+                       "tool_calls": [{"id": f"call_{i}", "type": "function", "function": {"name": "act", "arguments": action}}]}
+        else:
+            request = {"model": "gpt-4o-mini", "response_format": {"type": "json_schema", "json_schema": {"name": "act", "schema": ACTION_SCHEMA}}}
+            message = {"role": "assistant", "content": action}
+        response = {
+            "id": f"chatcmpl-{i}", "object": "chat.completion", "created": 0, "model": "gpt-4o-mini",
+            "choices": [{"index": 0, "message": message, "finish_reason": "stop", "logprobs": None}],
+            "usage": {"prompt_tokens": 500, "completion_tokens": 60, "total_tokens": 560},
+        }
+        results.append([request, response])
+    return results
+
+
+def benchmark_output_parsing(num_results: int = 1_000) -> Dict[str, float]:
+    """Returns the seconds spent turning `num_results` raw responses into LLMOutput fields per strategy."""
+    results = synthetic_chat_results(num_results)
+    outputs = [LLMOutput(raw_result=response, completion_kwargs=request, start_time=0, end_time=0, source_id=str(i), client="openai")
+               for i, (request, response) in enumerate(results)]
+    outputs[0].json_object  # compile the schema validator outside of the timings
+    timings = {}
+
+    start = time.perf_counter()
+    for output in outputs:
+        # the parsing as it was done before the raw-dict fast path
+        output._parse_oai_completion(ChatCompletion.model_validate(output.raw_result))
+    timings["legacy_models"] = time.perf_counter() - start
+
+    start = time.perf_counter()
+    for output in outputs:
+        output.json_object
+    timings["fast_path"] = time.perf_counter() - start
+
+    start = time.perf_counter()
+    for output in outputs:
+        # str_content, json_object, error, contains_object and usage all read the memoized result
+        output.str_content, output.json_object, output.error, output.contains_object, output.usage
+    timings["memoized_fields"] = time.perf_counter() - start
+    return timings
+
+
+def synthetic_prompt_contexts(num_prompts: int, num_agents: int = 100, seed: int = 0) -> List[LLMPromptContext]:
+    """Builds tool-calling prompt contexts of `num_agents` agents sharing one config and action schema."""
+    structured_output = StructuredTool(json_schema=ACTION_SCHEMA, schema_name="act", schema_description="Submit the next market action")
+    llm_config = LLMConfig(client="openai", model="gpt-4o-mini", response_format="tool")
+    prompts = []
+    for i, request in enumerate(synthetic_chat_requests(num_prompts, num_agents, seed=seed)):
+        system, *history, new_message = request["messages"]
+        prompts.append(LLMPromptContext(id=f"agent_{i % num_agents}", system_string=system["content"], history=history,
+                                        new_message=new_message["content"], structured_output=structured_output, llm_config=llm_config))
+    return prompts
+
+
+def _legacy_openai_request(prompt: LLMPromptContext) -> Dict[str, Any]:
+    # the request construction as it was done before templates: tool conversion and full validation per prompt
+    request = {
+        "model": prompt.llm_config.model,
+        "messages": prompt.oai_messages,
+        "max_tokens": prompt.llm_config.max_tokens,
+        "temperature": prompt.llm_config.temperature,
+    }
+    if prompt.oai_response_format:
+        request["response_format"] = prompt.oai_response_format
+    tool = prompt.get_tool()
+    if tool:
+        request["tools"] = [tool]
+        request["tool_choice"] = {"type": "function", "function": {"name": prompt.structured_output.schema_name}}
+    OpenAIRequest(**request)
+    return request
+
+
+def benchmark_request_building(num_requests: int = 10_000) -> Dict[str, float]:
+    """Returns the seconds spent building `num_requests` OpenAI tool-calling requests per strategy."""
+    prompts = synthetic_prompt_contexts(num_requests)
+    for prompt in prompts:
+        prompt.oai_messages  # the memoized messages are the same for both strategies, build them outside of the timings
+    timings = {}
+
+    start = time.perf_counter()
+    for prompt in prompts:
+        _legacy_openai_request(prompt)
+    timings["legacy_validate_each"] = time.perf_counter() - start
+
+    builder = RequestBuilder()
+    start = time.perf_counter()
+    for prompt in prompts:
+        builder.build(prompt, "openai")
+    timings["template"] = time.perf_counter() - start
+    return timings
+
+
+def _print_results(title: str, results: Dict[str, float], num_requests: int) -> None:
+    print(f"{title} ({num_requests} requests)")
+    for name, seconds in results.items():
+        print(f"  {name:<20} {seconds * 1000:10.1f} ms   {seconds / num_requests * 1e6:8.2f} us/request")
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("benchmark", choices=["tokens", "parsing", "requests"])
+    parser.add_argument("--num-requests", type=int, default=10_000)
+    parser.add_argument("--token-encoding-name", default="cl100k_base")
+    args = parser.parse_args()
+
+    if args.benchmark == "tokens":
+        _print_results("Token estimation", benchmark_token_estimation(args.num_requests, args.token_encoding_name), args.num_requests)
+    elif args.benchmark == "parsing":
+        _print_results("Output parsing", benchmark_output_parsing(args.num_requests), args.num_requests)
+    elif args.benchmark == "requests":
+        _print_results("Request building", benchmark_request_building(args.num_requests), args.num_requests)
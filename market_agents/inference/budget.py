@@ -0,0 +1,256 @@
+"""
+Token and cost accounting with hard caps for `ParallelAIUtilities`.
+
+Before a request is sent, `BudgetManager.admit` reserves its worst case: the estimated prompt
+tokens plus `max_tokens` of completion, priced as if nothing were cached. The reservation is
+checked against the per-run and per-agent caps together with what was already spent and what
+other in-flight requests reserved, so a large parallel batch cannot overshoot a cap before its
+first response arrives. When a request would exceed a cap it is either rejected (answered with an
+error `LLMOutput`, nothing is sent) or, with `on_exceeded="downgrade"`, switched to the cheaper
+model of `downgrade_models` and checked again. Once the output lands `settle` releases the
+reservation and charges the actual usage reported by the provider. Answers from the response
+cache, a replayed trace or a coalesced request cost nothing; batch API requests are charged at
+`batch_discount`.
+
+Prices are USD per million tokens. Models are looked up by exact name first and then by the
+longest matching prefix, so dated snapshots ("gpt-4o-2024-08-06") use the price of their family.
+Models without a price (typically self-hosted vLLM / LiteLLM models) cost nothing but their
+tokens still count against the token caps.
+
+A `BudgetManager` can be shared by several `ParallelAIUtilities` to cap a whole simulation.
+"""
+
+import logging
+from dataclasses import asdict, dataclass
+from typing import Any, Dict, Literal, Optional
+
+from pydantic import BaseModel, Field
+
+from market_agents.inference.message_models import Usage
+
+
+class ModelPrice(BaseModel):
+    input: float = Field(description="USD per million uncached prompt tokens")
+    output: float = Field(description="USD per million completion tokens")
+    cache_read: Optional[float] = Field(default=None, description="USD per million prompt tokens read from the provider prompt cache, defaults to input")
+    cache_write: Optional[float] = Field(default=None, description="USD per million prompt tokens written to the Anthropic prompt cache, defaults to input")
+
+
+DEFAULT_PRICES: Dict[str, ModelPrice] = {
+    "gpt-4o": ModelPrice(input=2.5, output=10.0, cache_read=1.25),
+    "gpt-4o-mini": ModelPrice(input=0.15, output=0.6, cache_read=0.075),
+    "gpt-4-turbo": ModelPrice(input=10.0, output=30.0),
+    "gpt-4": ModelPrice(input=30.0, output=60.0),
+    "gpt-3.5-turbo": ModelPrice(input=0.5, output=1.5),
+    "o1-preview": ModelPrice(input=15.0, output=60.0, cache_read=7.5),
+    "o1-mini": ModelPrice(input=3.0, output=12.0, cache_read=1.5),
+    "claude-3-5-sonnet": ModelPrice(input=3.0, output=15.0, cache_read=0.3, cache_write=3.75),
+    "claude-3-5-haiku": ModelPrice(input=0.8, output=4.0, cache_read=0.08, cache_write=1.0),
+    "claude-3-opus": ModelPrice(input=15.0, output=75.0, cache_read=1.5, cache_write=18.75),
+    "claude-3-sonnet": ModelPrice(input=3.0, output=15.0),
+    "claude-3-haiku": ModelPrice(input=0.25, output=1.25, cache_read=0.03, cache_write=0.3),
+}
+
+
+class BudgetConfig(BaseModel):
+    max_cost: Optional[float] = Field(default=None, description="Hard cap in USD on the spend of the run")
+    max_tokens: Optional[int] = Field(default=None, description="Hard cap on the prompt and completion tokens of the run")
+    max_cost_per_agent: Optional[float] = Field(default=None, description="Hard cap in USD on the spend of each agent (prompt context id)")
+    max_tokens_per_agent: Optional[int] = Field(default=None, description="Hard cap on the prompt and completion tokens of each agent")
+    on_exceeded: Literal["reject", "downgrade"] = Field(default="reject", description="Reject requests that would exceed a cap, or retry them with the model's downgrade first")
+    downgrade_models: Dict[str, str] = Field(default_factory=dict, description="Cheaper model to switch to per model, followed until a request fits; the fallback must be served by the same client")
+    prices: Dict[str, ModelPrice] = Field(default_factory=dict, description="Prices added to or overriding DEFAULT_PRICES")
+    batch_discount: float = Field(default=0.5, description="Price multiplier of requests sent through the batch APIs")
+
+
+class BudgetExceededError(Exception):
+    pass
+
+
+@dataclass
+class BudgetReservation:
+    """ The worst-case cost and tokens held for one admitted request until it is settled. """
+
+    agent_id: str
+    model: str
+    cost: float
+    prompt_tokens: int
+    completion_tokens: int
+
+    @property
+    def tokens(self) -> int:
+        return self.prompt_tokens + self.completion_tokens
+
+
+@dataclass
+class Spend:
+    """ Running totals of a model or an agent. """
+
+    requests: int = 0
+    cost: float = 0.0
+    prompt_tokens: int = 0
+    completion_tokens: int = 0
+    cache_read_tokens: int = 0
+    cache_write_tokens: int = 0
+    reserved_cost: float = 0.0
+    reserved_tokens: int = 0
+
+    @property
+    def tokens(self) -> int:
+        return self.prompt_tokens + self.completion_tokens + self.cache_read_tokens + self.cache_write_tokens
+
+    def to_dict(self) -> Dict[str, Any]:
+        return dict(asdict(self), tokens=self.tokens)
+
+
+class BudgetManager:
+    """
+    Accounts the spend of a run per model and per agent and enforces the caps of a `BudgetConfig`.
+    """
+
+    def __init__(self, config: Optional[BudgetConfig] = None):
+        self.config = config if config else BudgetConfig()
+        self.prices: Dict[str, ModelPrice] = {**DEFAULT_PRICES, **self.config.prices}
+        self.total = Spend()
+        self.models: Dict[str, Spend] = {}
+        self.agents: Dict[str, Spend] = {}
+        self.rejected = 0
+        self.downgraded = 0
+        self._unpriced = set()
+
+    def price(self, model: str) -> Optional[ModelPrice]:
+        price = self.prices.get(model)
+        if price is not None:
+            return price
+        prefixes = [name for name in self.prices if model.startswith(name)]
+        if prefixes:
+            return self.prices[max(prefixes, key=len)]
+        if model not in self._unpriced:
+            self._unpriced.add(model)
+            logging.warning(f"No price for model '{model}', its requests are accounted at no cost")
+        return None
+
+    def estimate_cost(self, model: str, prompt_tokens: int, completion_tokens: int, batch: bool = False) -> float:
+        """ The cost of the request if none of its prompt is cached. """
+        price = self.price(model)
+        if price is None:
+            return 0.0
+        cost = (prompt_tokens * price.input + completion_tokens * price.output) / 1e6
+        return cost * self.config.batch_discount if batch else cost
+
+    def cost(self, model: str, usage: Usage, client: Optional[str] = None, batch: bool = False) -> float:
+        """ The cost of a provider reported usage. Anthropic reports cached tokens apart from input_tokens, the others include them in prompt_tokens. """
+        price = self.price(model)
+        if price is None:
+            return 0.0
+        cache_read = usage.cache_read_input_tokens or 0
+        cache_write = usage.cache_creation_input_tokens or 0
+        uncached = usage.prompt_tokens if client == "anthropic" else usage.prompt_tokens - cache_read
+        cost = (uncached * price.input
+                + cache_read * (price.cache_read if price.cache_read is not None else price.input)
+                + cache_write * (price.cache_write if price.cache_write is not None else price.input)
+                + usage.completion_tokens * price.output) / 1e6
+        return cost * self.config.batch_discount if batch else cost
+
+    def admit(self, agent_id: str, model: str, prompt_tokens: int, completion_tokens: int, batch: bool = False) -> BudgetReservation:
+        """
+        Reserves the worst case of a request. Returns the reservation, whose model is the one to send
+        the request with (a downgrade of `model` if the config asked for it), or raises
+        `BudgetExceededError` when the request fits under no allowed model.
+        """
+        tokens = prompt_tokens + completion_tokens
+        tried = []
+        while True:
+            tried.append(model)
+            cost = self.estimate_cost(model, prompt_tokens, completion_tokens, batch)
+            exceeded = self._exceeded_cap(agent_id, cost, tokens)
+            if exceeded is None:
+                break
+            fallback = self.config.downgrade_models.get(model) if self.config.on_exceeded == "downgrade" else None
+            if fallback is None or fallback in tried:
+                self.rejected += 1
+                raise BudgetExceededError(f"Request of agent {agent_id} with {' -> '.join(tried)} would exceed the {exceeded}")
+            model = fallback
+        if len(tried) > 1:
+            self.downgraded += 1
+            logging.info(f"Budget: downgraded request of agent {agent_id} from {tried[0]} to {model}")
+        reservation = BudgetReservation(agent_id=agent_id, model=model, cost=cost, prompt_tokens=prompt_tokens, completion_tokens=completion_tokens)
+        for spend in (self.total, self._agent(agent_id)):
+            spend.reserved_cost += cost
+            spend.reserved_tokens += tokens
+        return reservation
+
+    def settle(self, reservation: Optional[BudgetReservation], agent_id: str, model: str, usage: Optional[Usage],
+               client: Optional[str] = None, billed: bool = True, batch: bool = False) -> float:
+        """
+        Releases the reservation of a finished request and charges its usage if the provider billed it.
+        A billed request without reported usage (e.g. a stream without a usage chunk) is charged its
+        reserved worst case. Returns the cost charged.
+        """
+        if reservation is not None:
+            for spend in (self.total, self._agent(reservation.agent_id)):
+                spend.reserved_cost -= reservation.cost
+                spend.reserved_tokens -= reservation.tokens
+                if spend.reserved_tokens == 0:
+                    # no rounding drift once nothing is in flight
+                    spend.reserved_cost = 0.0
+        if not billed:
+            return 0.0
+        if usage is None:
+            if reservation is None:
+                return 0.0
+            usage = Usage(prompt_tokens=reservation.prompt_tokens, completion_tokens=reservation.completion_tokens, total_tokens=reservation.tokens)
+        cost = self.cost(model, usage, client, batch)
+        cache_read = usage.cache_read_input_tokens or 0
+        # prompt_tokens is kept disjoint from the cache fields, as in PromptCacheSummary
+        prompt_tokens = usage.prompt_tokens if client == "anthropic" else usage.prompt_tokens - cache_read
+        for spend in (self.total, self._agent(agent_id), self.models.setdefault(model, Spend())):
+            spend.requests += 1
+            spend.cost += cost
+            spend.prompt_tokens += prompt_tokens
+            spend.completion_tokens += usage.completion_tokens
+            spend.cache_read_tokens += cache_read
+            spend.cache_write_tokens += usage.cache_creation_input_tokens or 0
+        return cost
+
+    def remaining_cost(self, agent_id: Optional[str] = None) -> Optional[float]:
+        """ USD left under the run cap, or the tighter of the run and agent caps for `agent_id`; None when uncapped. """
+        remaining = []
+        if self.config.max_cost is not None:
+            remaining.append(self.config.max_cost - self.total.cost - self.total.reserved_cost)
+        if agent_id is not None and self.config.max_cost_per_agent is not None:
+            agent = self._agent(agent_id)
+            remaining.append(self.config.max_cost_per_agent - agent.cost - agent.reserved_cost)
+        return max(min(remaining), 0.0) if remaining else None
+
+    def snapshot(self) -> Dict[str, Any]:
+        """ `{cost, tokens, ..., remaining_cost, rejected, downgraded, models: {model: {...}}, agents: {agent: {...}}}` """
+        return {
+            **self.total.to_dict(),
+            "max_cost": self.config.max_cost,
+            "max_tokens": self.config.max_tokens,
+            "remaining_cost": self.remaining_cost(),
+            "rejected": self.rejected,
+            "downgraded": self.downgraded,
+            "models": {model: spend.to_dict() for model, spend in sorted(self.models.items())},
+            "agents": {agent_id: spend.to_dict() for agent_id, spend in self.agents.items()},
+        }
+
+    def _agent(self, agent_id: str) -> Spend:
+        spend = self.agents.get(agent_id)
+        if spend is None:
+            spend = self.agents[agent_id] = Spend()
+        return spend
+
+    def _exceeded_cap(self, agent_id: str, cost: float, tokens: int) -> Optional[str]:
+        config = self.config
+        agent = self._agent(agent_id)
+        if config.max_cost is not None and self.total.cost + self.total.reserved_cost + cost > config.max_cost:
+            return f"run budget of ${config.max_cost:.4f}"
+        if config.max_tokens is not None and self.total.tokens + self.total.reserved_tokens + tokens > config.max_tokens:
+            return f"run budget of {config.max_tokens} tokens"
+        if config.max_cost_per_agent is not None and agent.cost + agent.reserved_cost + cost > config.max_cost_per_agent:
+            return f"agent budget of ${config.max_cost_per_agent:.4f}"
+        if config.max_tokens_per_agent is not None and agent.tokens + agent.reserved_tokens + tokens > config.max_tokens_per_agent:
+            return f"agent budget of {config.max_tokens_per_agent} tokens"
+        return None
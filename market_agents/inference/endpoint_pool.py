@@ -0,0 +1,278 @@
+import asyncio
+import logging
+import random
+import time
+from typing import Any, Callable, Dict, Hashable, List, Literal, Optional
+from urllib.parse import urlsplit
+
+import aiohttp
+from pydantic import BaseModel, Field
+
+from market_agents.inference.rate_limiter import (
+    AdaptiveConcurrencyLimiter,
+    LocalRateLimitBackend,
+    RateLimitBackend,
+    RateLimiter,
+    rate_limit_key,
+)
+from market_agents.inference.scheduling import FairLock
+
+
+class EndpointPoolConfig(BaseModel):
+    strategy: Literal["least_outstanding", "power_of_two"] = Field("least_outstanding", description="least_outstanding picks the replica with the fewest requests in flight, power_of_two the better of two random replicas")
+    health_check_path: Optional[str] = Field("/health", description="Path polled on each replica origin (vLLM serves /health, LiteLLM /health/liveliness), None disables active health checks")
+    health_check_interval: float = Field(10.0, description="Seconds between two health check rounds")
+    health_check_timeout: float = Field(2.0, description="Seconds before a health check counts as failed")
+    failure_threshold: int = Field(3, description="Consecutive failed requests after which a replica is ejected")
+    ejection_seconds: float = Field(30.0, description="First ejection period, doubled for every further ejection of the same replica")
+    max_ejection_seconds: float = Field(300.0, description="Upper bound of the ejection period")
+    adaptive_concurrency: bool = Field(False, description="Give every replica its own adaptive in-flight limit (opt-in, it caps the requests in flight)")
+
+
+class PoolEndpoint:
+    """
+    One replica of an `EndpointPool` with its own RPM/TPM budget, in-flight limit and health state.
+
+    `release` has the signature of `AdaptiveConcurrencyLimiter.release`, so the endpoint can be
+    handed to `APIRequest.call_api` as its concurrency limiter and learns from every outcome.
+
+    Attributes:
+    - url: The full request URL of the replica, e.g. `http://10.0.0.2:8000/v1/chat/completions`.
+    - rate_limiter: The replica's RPM/TPM budget.
+    - concurrency_limiter: The replica's adaptive in-flight limit, if enabled.
+    - outstanding: Requests currently in flight.
+    - consecutive_failures: Failed requests since the last success.
+    - ejected_until: Wall-clock time until which the replica receives no traffic.
+    - healthy: Result of the last active health check.
+    """
+
+    def __init__(self, pool: "EndpointPool", url: str, rate_limiter: RateLimiter, concurrency_limiter: Optional[AdaptiveConcurrencyLimiter]):
+        self.pool = pool
+        self.url = url
+        self.rate_limiter = rate_limiter
+        self.concurrency_limiter = concurrency_limiter
+        self.outstanding = 0
+        self.consecutive_failures = 0
+        self.ejections = 0
+        self.ejected_until = 0.0
+        self.healthy = True
+        self.requests = 0
+        self.failures = 0
+
+    @property
+    def origin(self) -> str:
+        parts = urlsplit(self.url)
+        return f"{parts.scheme}://{parts.netloc}"
+
+    def is_available(self, now: float) -> bool:
+        return self.healthy and now >= self.ejected_until
+
+    def has_capacity(self) -> bool:
+        return self.concurrency_limiter is None or self.concurrency_limiter.has_capacity()
+
+    def try_acquire(self) -> bool:
+        """ Takes an in-flight slot on the replica without waiting, e.g. for a hedge of a request already sent to it.
+        Its budget is taken separately from `rate_limiter`. """
+        if self.concurrency_limiter is not None and not self.concurrency_limiter.try_acquire():
+            return False
+        self.outstanding += 1
+        self.requests += 1
+        return True
+
+    def release(self, latency: Optional[float], status: Optional[int] = None, failed: bool = False) -> None:
+        self.outstanding = max(self.outstanding - 1, 0)
+        if self.concurrency_limiter is not None:
+            self.concurrency_limiter.release(latency, status=status, failed=failed)
+        if latency is not None or failed:
+            # 4xx other than 429 are the caller's fault, not the replica's
+            self.pool.record_outcome(self, success=not failed and status is not None and status < 500 and status != 429)
+        self.pool.wake()
+
+    def snapshot(self) -> Dict[str, Any]:
+        return {
+            "outstanding": self.outstanding,
+            "requests": self.requests,
+            "failures": self.failures,
+            "consecutive_failures": self.consecutive_failures,
+            "ejected": time.time() < self.ejected_until,
+            "healthy": self.healthy,
+            "concurrency_limit": self.concurrency_limiter.limit if self.concurrency_limiter is not None else None,
+        }
+
+
+class EndpointPool:
+    """
+    Client-side load balancer over several OpenAI-compatible replicas (vLLM, LiteLLM), replacing
+    a separate proxy in front of them.
+
+    `acquire` picks a replica by the configured strategy among those that are healthy, not
+    ejected, below their in-flight limit and within their own RPM/TPM budget, consuming that
+    budget; if none can take the request it waits for the first one that can. Replicas are
+    ejected after `failure_threshold` consecutive failures (429, 5xx, transport errors) for an
+    exponentially growing period and are tried again once it ends. When active health checks
+    are enabled a replica failing its health endpoint gets no traffic until it passes again.
+    If every replica is unavailable the pool fails open and uses all of them.
+
+    Parameters:
+    - urls: Full request URLs of the replicas.
+    - max_requests_per_minute: RPM budget of each replica.
+    - max_tokens_per_minute: TPM budget of each replica.
+    - config: Balancing strategy, health checks and ejection settings.
+    - api_key: Used to key the replicas' budgets in the rate limit backend.
+    - backend: Rate limit backend shared by the replica limiters.
+    - seed: Seed of the random choices, for reproducible tests.
+    """
+
+    def __init__(
+        self,
+        urls: List[str],
+        max_requests_per_minute: float,
+        max_tokens_per_minute: float,
+        config: Optional[EndpointPoolConfig] = None,
+        api_key: Optional[str] = None,
+        backend: Optional[RateLimitBackend] = None,
+        seed: Optional[int] = None,
+    ):
+        if not urls:
+            raise ValueError("EndpointPool needs at least one endpoint")
+        self.config = config if config else EndpointPoolConfig()
+        backend = backend if backend is not None else LocalRateLimitBackend()
+        self.endpoints = [
+            PoolEndpoint(
+                self,
+                url,
+                RateLimiter(max_requests_per_minute, max_tokens_per_minute, backend=backend, key=rate_limit_key(url, api_key)),
+                AdaptiveConcurrencyLimiter() if self.config.adaptive_concurrency else None,
+            )
+            for url in urls
+        ]
+        self._rng = random.Random(seed)
+        self._loop: Optional[asyncio.AbstractEventLoop] = None
+        self._wakeup = asyncio.Event()
+        self._lock = FairLock()
+        self._health_task: Optional[asyncio.Task] = None
+        self._first_health_check: Optional[asyncio.Future] = None
+
+    @property
+    def urls(self) -> List[str]:
+        return [endpoint.url for endpoint in self.endpoints]
+
+    def _bind_running_loop(self) -> None:
+        loop = asyncio.get_running_loop()
+        if self._loop is not loop:
+            self._loop = loop
+            self._wakeup = asyncio.Event()
+            self._lock = FairLock()
+            self._health_task = None
+            self._first_health_check = None
+
+    def wake(self) -> None:
+        self._wakeup.set()
+
+    def _ranked(self) -> List[PoolEndpoint]:
+        now = time.time()
+        candidates = [endpoint for endpoint in self.endpoints if endpoint.is_available(now)]
+        if not candidates:
+            candidates = list(self.endpoints)
+        if self.config.strategy == "power_of_two" and len(candidates) > 2:
+            first, second = self._rng.sample(candidates, 2)
+            best, other = (first, second) if first.outstanding <= second.outstanding else (second, first)
+            rest = [endpoint for endpoint in candidates if endpoint is not first and endpoint is not second]
+            self._rng.shuffle(rest)
+            return [best, other] + rest
+        # random tie-break so equally loaded replicas share the traffic
+        return sorted(candidates, key=lambda endpoint: (endpoint.outstanding, self._rng.random()))
+
+    async def acquire(self, tokens: float, priority: int = 0, flow: Optional[Hashable] = None) -> PoolEndpoint:
+        """ Waits for a replica able to take one request of `tokens` tokens, consumes its budget and returns it.
+        Waiters take turns by priority lane and fairly across flows (agents), see `FairLock`. """
+        self._bind_running_loop()
+        async with self._lock.hold(priority, flow, tokens):
+            while True:
+                self._wakeup.clear()
+                waits = []
+                for endpoint in self._ranked():
+                    if not endpoint.has_capacity():
+                        continue
+                    wait = endpoint.rate_limiter.try_acquire(tokens)
+                    if wait > 0:
+                        waits.append(wait)
+                        continue
+                    if endpoint.concurrency_limiter is not None:
+                        endpoint.concurrency_limiter.try_acquire()
+                    endpoint.outstanding += 1
+                    endpoint.requests += 1
+                    return endpoint
+                try:
+                    await asyncio.wait_for(self._wakeup.wait(), timeout=min(waits) if waits else None)
+                except asyncio.TimeoutError:
+                    pass
+
+    def record_outcome(self, endpoint: PoolEndpoint, success: bool) -> None:
+        if success:
+            endpoint.consecutive_failures = 0
+            return
+        endpoint.failures += 1
+        endpoint.consecutive_failures += 1
+        if endpoint.consecutive_failures >= self.config.failure_threshold:
+            endpoint.ejections += 1
+            period = min(self.config.ejection_seconds * 2 ** (endpoint.ejections - 1), self.config.max_ejection_seconds)
+            endpoint.ejected_until = time.time() + period
+            endpoint.consecutive_failures = 0
+            logging.warning(f"Ejecting {endpoint.url} for {period:.0f}s after {self.config.failure_threshold} consecutive failures")
+
+    async def check_health(self, get_session: Callable[[str], aiohttp.ClientSession]) -> None:
+        """ Polls every replica's health endpoint once, through the session `get_session` returns for the
+        replica's URL (e.g. `ClientSessionPool.get_session`, one session per origin). """
+        async def check(endpoint: PoolEndpoint) -> None:
+            try:
+                async with get_session(endpoint.url).get(
+                    f"{endpoint.origin}{self.config.health_check_path}",
+                    timeout=aiohttp.ClientTimeout(total=self.config.health_check_timeout),
+                ) as response:
+                    healthy = response.status < 400
+            except (aiohttp.ClientError, asyncio.TimeoutError):
+                healthy = False
+            if healthy != endpoint.healthy:
+                logging.warning(f"Endpoint {endpoint.url} is now {'healthy' if healthy else 'unhealthy'}")
+                if healthy:
+                    endpoint.ejected_until = 0.0
+            endpoint.healthy = healthy
+        await asyncio.gather(*(check(endpoint) for endpoint in self.endpoints))
+        self.wake()
+
+    async def ensure_health_checks(self, get_session: Callable[[str], aiohttp.ClientSession]) -> None:
+        """ Starts the background health check loop on the running event loop if enabled and not running yet.
+        The first round is awaited, so a replica that is down from the start gets no traffic at all. """
+        self._bind_running_loop()
+        if self.config.health_check_path is None:
+            return
+        if self._health_task is None or self._health_task.done():
+            # created before the first await, so concurrent callers share this one loop and wait for its first round
+            self._first_health_check = asyncio.get_running_loop().create_future()
+            self._health_task = asyncio.create_task(self._run_health_checks(get_session, self._first_health_check))
+        await asyncio.shield(self._first_health_check)
+
+    async def _run_health_checks(self, get_session: Callable[[str], aiohttp.ClientSession], first_round: asyncio.Future) -> None:
+        try:
+            await self.check_health(get_session)
+            first_round.set_result(None)
+            while True:
+                await asyncio.sleep(self.config.health_check_interval)
+                await self.check_health(get_session)
+        finally:
+            # never leave callers waiting on a loop that was closed or failed before its first round
+            if not first_round.done():
+                first_round.set_result(None)
+
+    async def close(self) -> None:
+        if self._health_task is not None:
+            self._health_task.cancel()
+            try:
+                await self._health_task
+            except (asyncio.CancelledError, Exception):
+                pass
+            self._health_task = None
+
+    def snapshot(self) -> Dict[str, Dict[str, Any]]:
+        return {endpoint.url: endpoint.snapshot() for endpoint in self.endpoints}
@@ -0,0 +1,208 @@
+"""
+Load test of `ParallelAIUtilities` against the local `MockLLMServer`.
+
+Each step of the sweep sends one batch of structured-output prompts of the given size through
+`run_parallel_ai_completion` and reports throughput and latency percentiles together with the
+429s and errors the server produced, which gives the throughput/latency curve of a
+`RequestLimits` / retry / concurrency setting against a server with known limits.
+
+Usage:
+    python -m market_agents.inference.load_test --client openai --batch-sizes 10 50 100 500 \\
+        --latency-mean 0.5 --server-rpm 3000 --client-rpm 2500
+"""
+
+import argparse
+import asyncio
+import os
+import time
+from dataclasses import dataclass
+from typing import Any, Dict, List, Literal, Optional
+
+from market_agents.inference.message_models import LLMConfig, LLMPromptContext, StructuredTool
+from market_agents.inference.mock_server import MockLLMServer, MockServerConfig
+from market_agents.inference.parallel_inference import ParallelAIUtilities, RequestLimits
+from market_agents.inference.rate_limiter import LatencyWindow
+
+ACTION_SCHEMA = {
+    "type": "object",
+    "properties": {
+        "action": {"type": "string", "enum": ["bid", "ask", "hold"]},
+        "price": {"type": "number", "minimum": 1, "maximum": 100},
+        "quantity": {"type": "integer", "minimum": 1, "maximum": 5},
+    },
+    "required": ["action", "price", "quantity"],
+}
+
+ENDPOINT_ENV = {
+    "openai": ("OPENAI_BASE_URL", ""),
+    "anthropic": ("ANTHROPIC_BASE_URL", ""),
+    "vllm": ("VLLM_ENDPOINT", "/chat/completions"),
+    "litellm": ("LITELLM_ENDPOINT", "/chat/completions"),
+}
+
+
+@dataclass
+class LoadTestResult:
+    """
+    Outcome of one batch of the sweep.
+
+    Attributes:
+    - batch_size: Prompts sent in the batch.
+    - seconds: Wall time of `run_parallel_ai_completion`.
+    - succeeded: Completions without error.
+    - failed: Completions that ended with an error.
+    - p50, p95, p99: Percentiles of the per-request latency, retries included.
+    - server_requests: HTTP requests the server received, retries included.
+    - rate_limited: 429s answered by the server.
+    """
+
+    batch_size: int
+    seconds: float
+    succeeded: int
+    failed: int
+    p50: Optional[float]
+    p95: Optional[float]
+    p99: Optional[float]
+    server_requests: int
+    rate_limited: int
+
+    @property
+    def throughput(self) -> float:
+        return self.succeeded / self.seconds if self.seconds else 0.0
+
+
+def load_test_prompts(batch_size: int, client: Literal["openai", "anthropic", "vllm", "litellm"], round_index: int = 0) -> List[LLMPromptContext]:
+    """ Market-agent shaped prompts asking for a structured action through a tool call. """
+    structured_output = StructuredTool(json_schema=ACTION_SCHEMA, schema_name="act", schema_description="Submit the next market action")
+    return [
+        LLMPromptContext(
+            id=f"agent_{i}",
+            system_string="You are a market agent in a double auction. Decide on your next bid or ask.",
+            new_message=f"Round {round_index}: agent {i} observes best bid {i % 50 + 1} and best ask {i % 50 + 3}.",
+            structured_output=structured_output,
+            llm_config=LLMConfig(client=client, model="mock-model", response_format="tool", max_tokens=100),
+        )
+        for i in range(batch_size)
+    ]
+
+
+async def run_load_test(
+    batch_sizes: List[int],
+    client: Literal["openai", "anthropic", "vllm", "litellm"] = "openai",
+    server_config: Optional[MockServerConfig] = None,
+    request_limits: Optional[RequestLimits] = None,
+    **utilities_kwargs: Any,
+) -> List[LoadTestResult]:
+    """
+    Starts a `MockLLMServer`, points the client's endpoint at it and runs one batch per entry of
+    `batch_sizes` through a single `ParallelAIUtilities`, so rate limiter and concurrency state
+    carry over between steps as they would between simulation rounds.
+
+    Parameters:
+    - batch_sizes: Prompts per step of the sweep.
+    - client: The provider whose request path is exercised.
+    - server_config: Latency, limits and error injection of the mock server.
+    - request_limits: Client-side RPM/TPM budget, defaults to the `ParallelAIUtilities` default for the client.
+    - utilities_kwargs: Passed to `ParallelAIUtilities`, e.g. retry_policy or adaptive_concurrency.
+    """
+    env_name, path_suffix = ENDPOINT_ENV[client]
+    previous_env = {name: os.environ.get(name) for name in (env_name, "OPENAI_KEY", "ANTHROPIC_API_KEY")}
+    results = []
+    async with MockLLMServer(config=server_config) as server:
+        os.environ[env_name] = server.base_url + path_suffix
+        os.environ.setdefault("OPENAI_KEY", "mock-key")
+        os.environ.setdefault("ANTHROPIC_API_KEY", "mock-key")
+        try:
+            limits_kwarg = {} if request_limits is None else {
+                {"openai": "oai_request_limits"}.get(client, f"{client}_request_limits"): request_limits
+            }
+            async with ParallelAIUtilities(local_cache=False, **limits_kwarg, **utilities_kwargs) as utilities:
+                for round_index, batch_size in enumerate(batch_sizes):
+                    prompts = load_test_prompts(batch_size, client, round_index)
+                    server_requests, rate_limited = server.stats.requests, server.stats.rate_limited
+                    start = time.perf_counter()
+                    outputs = await utilities.run_parallel_ai_completion(prompts, update_history=False)
+                    seconds = time.perf_counter() - start
+                    latencies = LatencyWindow(size=max(len(outputs), 1))
+                    failed = 0
+                    for output in outputs:
+                        if output.error is not None:
+                            failed += 1
+                        else:
+                            latencies.add(output.time_taken)
+                    results.append(LoadTestResult(
+                        batch_size=batch_size,
+                        seconds=seconds,
+                        succeeded=len(outputs) - failed,
+                        failed=failed,
+                        p50=latencies.percentile(0.5),
+                        p95=latencies.percentile(0.95),
+                        p99=latencies.percentile(0.99),
+                        server_requests=server.stats.requests - server_requests,
+                        rate_limited=server.stats.rate_limited - rate_limited,
+                    ))
+        finally:
+            for name, value in previous_env.items():
+                if value is None:
+                    os.environ.pop(name, None)
+                else:
+                    os.environ[name] = value
+    return results
+
+
+def _format_seconds(value: Optional[float]) -> str:
+    return f"{value:8.3f}" if value is not None else "       -"
+
+
+def print_load_test_results(results: List[LoadTestResult]) -> None:
+    print(f"{'batch':>6} {'seconds':>8} {'req/s':>8} {'ok':>6} {'failed':>6} {'p50':>8} {'p95':>8} {'p99':>8} {'http':>6} {'429':>6}")
+    for result in results:
+        print(f"{result.batch_size:>6} {result.seconds:8.2f} {result.throughput:8.1f} {result.succeeded:>6} {result.failed:>6} "
+              f"{_format_seconds(result.p50)} {_format_seconds(result.p95)} {_format_seconds(result.p99)} "
+              f"{result.server_requests:>6} {result.rate_limited:>6}")
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--client", default="openai", choices=list(ENDPOINT_ENV))
+    parser.add_argument("--batch-sizes", type=int, nargs="+", default=[10, 50, 100, 250, 500])
+    parser.add_argument("--latency-distribution", default="lognormal", choices=["constant", "uniform", "normal", "lognormal", "exponential"])
+    parser.add_argument("--latency-mean", type=float, default=0.5)
+    parser.add_argument("--latency-std", type=float, default=0.25)
+    parser.add_argument("--server-rpm", type=int, default=None, help="RPM limit enforced by the mock server")
+    parser.add_argument("--server-tpm", type=int, default=None, help="TPM limit enforced by the mock server")
+    parser.add_argument("--rate-limit-error-rate", type=float, default=0.0)
+    parser.add_argument("--server-error-rate", type=float, default=0.0)
+    parser.add_argument("--client-rpm", type=int, default=None, help="RequestLimits.max_requests_per_minute of the client")
+    parser.add_argument("--client-tpm", type=int, default=None, help="RequestLimits.max_tokens_per_minute of the client")
+    parser.add_argument("--token-estimation", default="exact", choices=["exact", "approximate"])
+    parser.add_argument("--adaptive-concurrency", action="store_true")
+    parser.add_argument("--seed", type=int, default=0)
+    args = parser.parse_args()
+
+    server_config = MockServerConfig(
+        latency_distribution=args.latency_distribution,
+        latency_mean=args.latency_mean,
+        latency_std=args.latency_std,
+        max_requests_per_minute=args.server_rpm,
+        max_tokens_per_minute=args.server_tpm,
+        rate_limit_error_rate=args.rate_limit_error_rate,
+        server_error_rate=args.server_error_rate,
+        seed=args.seed,
+    )
+    request_limits = None
+    if args.client_rpm or args.client_tpm:
+        limit_fields: Dict[str, Any] = {"provider": args.client}
+        if args.client_rpm:
+            limit_fields["max_requests_per_minute"] = args.client_rpm
+        if args.client_tpm:
+            limit_fields["max_tokens_per_minute"] = args.client_tpm
+        request_limits = RequestLimits(**limit_fields)
+    print_load_test_results(asyncio.run(run_load_test(
+        args.batch_sizes,
+        client=args.client,
+        server_config=server_config,
+        request_limits=request_limits,
+        token_estimation=args.token_estimation,
+        adaptive_concurrency=args.adaptive_concurrency,
+    )))
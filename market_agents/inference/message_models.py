@@ -1,5 +1,5 @@
-from pydantic import BaseModel, Field, computed_field, ValidationError, model_validator
-from typing import Literal, Optional, Union, Dict, Any, List, Iterable, Tuple
+from pydantic import BaseModel, Field, computed_field, ValidationError, model_validator, PrivateAttr
+from typing import Literal, Optional, Union, Dict, Any, List, Iterable, Tuple, Callable
 import json
 import time
 from typing_extensions import Self
@@ -41,6 +41,8 @@ from anthropic.types.beta.prompt_caching.prompt_caching_beta_cache_control_ephem
 from anthropic.types.model_param import ModelParam
 
 from market_agents.inference.utils import msg_dict_to_oai, msg_dict_to_anthropic, parse_json_string
+from market_agents.inference.oai_parallel import count_text_tokens
+from market_agents.inference.output_parsing import parse_structured_content, response_format_schema, schema_adapter, tool_schema
 
 
 
@@ -112,7 +114,70 @@ class LLMConfig(BaseModel):
         return self
 
 
-  
+
+class HistoryPolicy(BaseModel):
+    """ Bounds the chat history sent with each request, the stored history is left untouched.
+    A turn starts at a user message and runs up to the next one. The most recent turns are kept
+    within max_turns and max_tokens, the first turn can be pinned, and older turns are either
+    dropped or passed to the summarizer whose text is appended to the system message. """
+
+    max_turns: Optional[int] = Field(default=None, description="Most recent turns to keep besides the pinned first turn, None for no limit")
+    max_tokens: Optional[int] = Field(default=None, description="Token budget for the kept turns including the pinned first turn, None for no limit")
+    pin_first_turn: bool = Field(default=False, description="Always keep the first turn, e.g. the one that sets up the task")
+    summarizer: Optional[Callable[[List[Dict[str, Any]]], str]] = Field(default=None, exclude=True, description="Turns the dropped messages into a summary text, called once per distinct set of dropped messages")
+    summary_prefix: str = Field(default="Summary of the earlier conversation:", description="Heading placed before the summary in the system message")
+    token_encoding_name: str = Field(default="cl100k_base", description="tiktoken encoding used to count history tokens")
+    _last_summary: Optional[Tuple[Tuple[int, int], str]] = PrivateAttr(default=None)
+
+    @staticmethod
+    def split_turns(history: List[Dict[str, Any]]) -> List[List[Dict[str, Any]]]:
+        turns: List[List[Dict[str, Any]]] = []
+        for message in history:
+            if message.get("role") == "user" or not turns:
+                turns.append([message])
+            else:
+                turns[-1].append(message)
+        return turns
+
+    def turn_tokens(self, turn: List[Dict[str, Any]]) -> int:
+        # counts are memoized per message text by count_text_tokens, so re-windowing a long history is cheap
+        num_tokens = 0
+        for message in turn:
+            content = message.get("content")
+            text = content if isinstance(content, str) else json.dumps(content)
+            num_tokens += 4 + count_text_tokens(text, self.token_encoding_name)
+        return num_tokens
+
+    def apply(self, history: List[Dict[str, Any]]) -> Tuple[List[Dict[str, Any]], Optional[str]]:
+        """ Returns the messages to send and the summary of the dropped ones (None if nothing was summarized). """
+        turns = self.split_turns(history)
+        pinned = turns[:1] if self.pin_first_turn else []
+        candidates = turns[len(pinned):]
+        kept = candidates[max(len(candidates) - self.max_turns, 0):] if self.max_turns is not None else candidates
+        if self.max_tokens is not None:
+            budget = self.max_tokens - sum(self.turn_tokens(turn) for turn in pinned)
+            within_budget = []
+            for turn in reversed(kept):
+                budget -= self.turn_tokens(turn)
+                if budget < 0:
+                    break
+                within_budget.append(turn)
+            kept = within_budget[::-1]
+        dropped = candidates[:len(candidates) - len(kept)]
+        windowed = [message for turn in pinned + kept for message in turn]
+        if not dropped or self.summarizer is None:
+            return windowed, None
+        dropped_messages = [message for turn in dropped for message in turn]
+        # history only grows by appending, so the dropped prefix is identified by its length and last message
+        summary_key = (len(dropped_messages), id(dropped_messages[-1]))
+        if self._last_summary is None or self._last_summary[0] != summary_key:
+            self._last_summary = (summary_key, self.summarizer(dropped_messages))
+        return windowed, self._last_summary[1]
+
+
+# scheduling lanes of LLMPromptContext.priority, lower values are dispatched first when rate limits or concurrency are contended
+PRIORITY_LEVELS = {"action": 0, "perception": 1, "reflection": 2, "research_summary": 3}
+
 
 class LLMPromptContext(BaseModel):
     id: str
@@ -125,10 +190,60 @@ class LLMPromptContext(BaseModel):
     use_schema_instruction: bool = Field(default=False, description="Whether to use the schema instruction")
     llm_config: LLMConfig
     use_history: bool = Field(default=True, description="Whether to use the history")
-    
+    history_policy: Optional[HistoryPolicy] = Field(default=None, description="Windowing applied to the history when building messages, None sends the full history")
+    priority: Literal["action", "perception", "reflection", "research_summary"] = Field(default="action", description="Scheduling lane, see PRIORITY_LEVELS; requests of the same lane share capacity fairly across prompt context ids")
+    _computed_cache: Dict[str, Any] = PrivateAttr(default_factory=dict)
+    _cache_fingerprint: Optional[Tuple[Any, ...]] = PrivateAttr(default=None)
+    _cache_history: Optional[List[Dict[str, Any]]] = PrivateAttr(default=None)
+
+    def __setattr__(self, name: str, value: Any) -> None:
+        super().__setattr__(name, value)
+        if not name.startswith("_"):
+            self._invalidate_cache()
+
+    def _invalidate_cache(self) -> None:
+        # rebind instead of clearing, model_copy shares the private dict with the original
+        self._computed_cache = {}
+        self._cache_fingerprint = None
+        self._cache_history = None
+
+    def _current_fingerprint(self) -> Tuple[Any, ...]:
+        """ cheap snapshot of the state read by the message builders, catches in-place mutations
+        that bypass __setattr__ such as appending to or editing history entries, or editing the fields of
+        llm_config, structured_output or history_policy. Values are compared by reference one level deep,
+        so a nested object edited in place (e.g. a content block list) needs a new value or attribute assignment.
+        The history entries are compared against the copies taken in _cached instead of being snapshotted here """
+        return (
+            id(self.history),
+            id(self.llm_config),
+            tuple(self.llm_config.__dict__.values()),
+            id(self.structured_output),
+            tuple(self.structured_output.__dict__.values()) if self.structured_output is not None else None,
+            id(self.history_policy),
+            tuple(self.history_policy.__dict__.values()) if self.history_policy is not None else None,
+        )
+
+    def _cached(self, name: str, build: Callable[[], Any]) -> Any:
+        # private attributes are read through __pydantic_private__ directly, the BaseModel
+        # __getattr__ fallback costs more than the lookup it is guarding
+        private = self.__pydantic_private__
+        fingerprint = self._current_fingerprint()
+        history = self.history
+        if fingerprint != private["_cache_fingerprint"] or history != private["_cache_history"]:
+            private["_computed_cache"] = {}
+            private["_cache_fingerprint"] = fingerprint
+            private["_cache_history"] = [dict(entry) for entry in history] if history is not None else None
+        cache = private["_computed_cache"]
+        if name not in cache:
+            cache[name] = build()
+        return cache[name]
+
     @computed_field
     @property
     def oai_response_format(self) -> Optional[ResponseFormat]:
+        return self._cached("oai_response_format", self._build_oai_response_format)
+
+    def _build_oai_response_format(self) -> Optional[ResponseFormat]:
         if self.llm_config.response_format == "text":
             return ResponseFormatText(type="text")
         elif self.llm_config.response_format == "json_object":
@@ -161,6 +276,9 @@ class LLMPromptContext(BaseModel):
     @computed_field
     @property
     def system_message(self) -> Optional[Dict[str, str]]:
+        return self._cached("system_message", self._build_system_message)
+
+    def _build_system_message(self) -> Optional[Dict[str, str]]:
         content= self.system_string if self.system_string  else ""
         if self.use_schema_instruction and self.structured_output:
             content = "\n".join([content,self.structured_output.schema_instruction])
@@ -169,9 +287,23 @@ class LLMPromptContext(BaseModel):
     @computed_field
     @property
     def messages(self)-> List[Dict[str, Any]]:
+        # copies, the cached list must not be changed by the caller
+        return list(self._cached("messages", self._build_messages))
+
+    def _build_messages(self) -> List[Dict[str, Any]]:
         messages = [self.system_message] if self.system_message is not None else []
         if  self.use_history and self.history:
-            messages+=self.history
+            if self.history_policy is not None:
+                history, summary = self.history_policy.apply(self.history)
+                if summary:
+                    summary_text = f"{self.history_policy.summary_prefix}\n{summary}"
+                    if messages:
+                        messages[0] = {"role": "system", "content": f"{messages[0]['content']}\n\n{summary_text}"}
+                    else:
+                        messages = [{"role": "system", "content": summary_text}]
+                messages+=history
+            else:
+                messages+=self.history
         messages.append({"role":"user","content":self.new_message})
         if self.use_prefill:
             prefill_message = {"role":"assistant","content":self.prefill}
@@ -183,21 +315,23 @@ class LLMPromptContext(BaseModel):
     @computed_field
     @property
     def oai_messages(self)-> List[ChatCompletionMessageParam]:
-        return msg_dict_to_oai(self.messages)
+        return list(self._cached("oai_messages", lambda: msg_dict_to_oai(self.messages)))
     
     @computed_field
     @property
     def anthropic_messages(self) -> Tuple[List[PromptCachingBetaTextBlockParam],List[MessageParam]]:
-        return msg_dict_to_anthropic(self.messages, use_cache=self.llm_config.use_cache)
+        system, messages = self._cached("anthropic_messages", lambda: msg_dict_to_anthropic(self.messages, use_cache=self.llm_config.use_cache))
+        return list(system), list(messages)
     
     @computed_field
     @property
     def vllm_messages(self) -> List[ChatCompletionMessageParam]:
-        return msg_dict_to_oai(self.messages)
+        return list(self._cached("vllm_messages", lambda: msg_dict_to_oai(self.messages)))
         
     def update_llm_config(self,llm_config:LLMConfig) -> 'LLMPromptContext':
-        
-        return self.model_copy(update={"llm_config":llm_config})
+        updated = self.model_copy(update={"llm_config":llm_config})
+        updated._invalidate_cache()
+        return updated
        
     
 
@@ -208,6 +342,7 @@ class LLMPromptContext(BaseModel):
             raise ValueError(f"LLMOutput source_id {llm_output.source_id} does not match the prompt context id {self.id}")
         if self.history is None:
             self.history = []
+        self._invalidate_cache()
         self.history.append({"role": "user", "content": self.new_message})
         self.history.append({"role": "assistant", "content": llm_output.str_content or json.dumps(llm_output.json_object.object) if llm_output.json_object else "{}"})
     
@@ -240,6 +375,10 @@ class LLMOutput(BaseModel):
     end_time: float
     source_id: str
     client: Optional[Literal["openai", "anthropic","vllm","litellm"]] = Field(default=None)
+    time_to_first_token: Optional[float] = Field(default=None, description="Seconds until the first streamed token arrived, only set for streaming completions")
+    # every computed field needs the parsed result, it is computed once per raw_result
+    _parsed_result: Optional[Tuple[Any, ...]] = PrivateAttr(default=None)
+    _parsed_key: Optional[Tuple[int, int, Optional[str]]] = PrivateAttr(default=None)
 
     @property
     def time_taken(self) -> float:
@@ -330,10 +469,17 @@ class LLMOutput(BaseModel):
                 content = None  # Set content to None when we have a parsed JSON object
                 #print(f"parsed_json: {parsed_json} with name")
         if chat_completion.usage:
+            # automatic prompt caching (OpenAI, vLLM with prompt token details) reports the cached part of prompt_tokens here
+            prompt_tokens_details = getattr(chat_completion.usage, 'prompt_tokens_details', None)
+            if isinstance(prompt_tokens_details, dict):
+                cached_tokens = prompt_tokens_details.get('cached_tokens')
+            else:
+                cached_tokens = getattr(prompt_tokens_details, 'cached_tokens', None)
             usage = Usage(
                 prompt_tokens=chat_completion.usage.prompt_tokens,
                 completion_tokens=chat_completion.usage.completion_tokens,
-                total_tokens=chat_completion.usage.total_tokens
+                total_tokens=chat_completion.usage.total_tokens,
+                cache_read_input_tokens=cached_tokens
             )
 
         return content, json_object, usage, None
@@ -368,7 +514,94 @@ class LLMOutput(BaseModel):
         return content, json_object, usage, None
     
 
+    def _parse_oai_dict(self, raw_result: Dict[str, Any]) -> Tuple[Optional[str], Optional[GeneratedJsonObject], Optional[Usage], None]:
+        """ Same as `_parse_oai_completion` but reads the raw response dict directly. """
+        message = raw_result["choices"][0]["message"]
+        content = message.get("content")
+        json_object = None
+        usage = None
+
+        tool_calls = message.get("tool_calls")
+        if tool_calls:
+            function = tool_calls[0]["function"]
+            name = function["name"]
+            arguments = function.get("arguments") or ""
+            object_dict = parse_structured_content(arguments, tool_schema(self.completion_kwargs, name))
+            json_object = GeneratedJsonObject(name=name, object=object_dict if object_dict is not None else {"raw": arguments})
+        elif content is not None:
+            name, schema = response_format_schema(self.completion_kwargs)
+            parsed_json = parse_structured_content(content, schema)
+            if parsed_json:
+                json_object = GeneratedJsonObject(name="parsed_content" if name is None else name, object=parsed_json)
+                content = None  # Set content to None when we have a parsed JSON object
+        raw_usage = raw_result.get("usage")
+        if raw_usage:
+            prompt_tokens_details = raw_usage.get("prompt_tokens_details")
+            usage = Usage(
+                prompt_tokens=raw_usage["prompt_tokens"],
+                completion_tokens=raw_usage["completion_tokens"],
+                total_tokens=raw_usage["total_tokens"],
+                cache_read_input_tokens=prompt_tokens_details.get("cached_tokens") if isinstance(prompt_tokens_details, dict) else None
+            )
+        return content, json_object, usage, None
+
+    def _parse_anthropic_dict(self, raw_result: Dict[str, Any]) -> Tuple[Optional[str], Optional[GeneratedJsonObject], Optional[Usage], None]:
+        """ Same as `_parse_anthropic_message` but reads the raw response dict directly. """
+        content = None
+        json_object = None
+        usage = None
+
+        blocks = raw_result["content"]
+        if blocks:
+            first_content = blocks[0]
+            if first_content["type"] == "text":
+                content = first_content["text"]
+                parsed_json = parse_structured_content(content)
+                if parsed_json:
+                    json_object = GeneratedJsonObject(name="parsed_content", object=parsed_json)
+                    content = None  # Set content to None when we have a parsed JSON object
+            elif first_content["type"] == "tool_use":
+                name = first_content["name"]
+                input_dict = first_content["input"]
+                adapter = schema_adapter(tool_schema(self.completion_kwargs, name))
+                if adapter is not None:
+                    try:
+                        input_dict = adapter.validate_python(input_dict)
+                    except ValidationError:
+                        pass
+                json_object = GeneratedJsonObject(name=name, object=input_dict)
+        raw_usage = raw_result["usage"]
+        usage = Usage(
+            prompt_tokens=raw_usage["input_tokens"],
+            completion_tokens=raw_usage["output_tokens"],
+            total_tokens=raw_usage["input_tokens"] + raw_usage["output_tokens"],
+            cache_creation_input_tokens=raw_usage.get("cache_creation_input_tokens"),
+            cache_read_input_tokens=raw_usage.get("cache_read_input_tokens")
+        )
+        return content, json_object, usage, None
+
     def _parse_result(self) -> Tuple[Optional[str], Optional[GeneratedJsonObject], Optional[Usage],Optional[str]]:
+        private = self.__pydantic_private__
+        key = (id(self.raw_result), id(self.completion_kwargs), self.client)
+        if private["_parsed_key"] != key:
+            private["_parsed_result"] = self._parse_raw_result()
+            private["_parsed_key"] = key
+        return private["_parsed_result"]
+
+    def _parse_raw_result(self) -> Tuple[Optional[str], Optional[GeneratedJsonObject], Optional[Usage],Optional[str]]:
+        raw_result = self.raw_result
+        if isinstance(raw_result, dict):
+            if raw_result.get("error") is not None:
+                return None, None, None, str(raw_result["error"])
+            provider = self.result_provider
+            # fast path on the raw dict, responses of an unexpected shape go through the pydantic models below
+            try:
+                if provider in ("openai", "vllm", "litellm"):
+                    return self._parse_oai_dict(raw_result)
+                if provider == "anthropic":
+                    return self._parse_anthropic_dict(raw_result)
+            except (KeyError, IndexError, TypeError, AttributeError):
+                pass
         provider = self.result_provider
         if getattr(self.raw_result, "error", None):
             return None, None, None,  getattr(self.raw_result, "error", None)
@@ -387,4 +620,11 @@ class LLMOutput(BaseModel):
             raise ValueError(f"Unsupported result provider: {provider}")
 
     class Config:
-        arbitrary_types_allowed = True
\ No newline at end of file
+        arbitrary_types_allowed = True
+
+
+class LLMStreamChunk(BaseModel):
+    """ Incremental piece of a streaming completion, the last chunk carries the assembled LLMOutput """
+    source_id: str
+    delta: str = ""
+    output: Optional[LLMOutput] = None
@@ -0,0 +1,481 @@
+"""
+Local stand-ins for the provider APIs used by `ParallelAIUtilities`, built on `aiohttp.web`.
+
+`FakeBatchServer` implements the OpenAI Files/Batches endpoints and the Anthropic Message
+Batches endpoints so batch mode can be exercised without network access or cost:
+
+    async with FakeBatchServer() as server:
+        os.environ["OPENAI_BASE_URL"] = server.base_url
+        os.environ["ANTHROPIC_BASE_URL"] = server.base_url
+        ...
+
+`MockLLMServer` adds the online `/v1/chat/completions` (OpenAI, vLLM, LiteLLM) and `/v1/messages`
+(Anthropic) endpoints with a configurable latency distribution, RPM/TPM limits answered with 429
+and rate-limit headers, random error injection and token accounting, for tuning `RequestLimits`,
+retries and concurrency (see `load_test.py`). Tool calls and structured outputs are filled with
+values generated from the request's JSON schema.
+"""
+
+import asyncio
+import json
+import math
+import random
+import time
+import uuid
+from dataclasses import asdict, dataclass
+from typing import Any, Dict, List, Literal, Optional
+
+from aiohttp import web
+from pydantic import BaseModel, Field
+
+from market_agents.inference.rate_limiter import TokenBucket
+
+
+def _new_id(prefix: str) -> str:
+    return f"{prefix}{uuid.uuid4().hex[:24]}"
+
+
+def mock_value_from_schema(schema: Any, rng: Optional[random.Random] = None, root: Optional[Dict[str, Any]] = None, depth: int = 0) -> Any:
+    """ A value conforming to a JSON schema: every property is filled, enums pick a member, numbers respect their bounds. """
+    rng = rng if rng is not None else random.Random(0)
+    if not isinstance(schema, dict) or depth > 16:
+        return None
+    root = root if root is not None else schema
+    if "$ref" in schema:
+        target: Any = root
+        for part in schema["$ref"].lstrip("#/").split("/"):
+            target = target.get(part, {}) if isinstance(target, dict) else {}
+        return mock_value_from_schema(target, rng, root, depth + 1)
+    if schema.get("enum"):
+        return rng.choice(schema["enum"])
+    if "const" in schema:
+        return schema["const"]
+    for combinator in ("anyOf", "oneOf", "allOf"):
+        options = [option for option in schema.get(combinator, []) if option.get("type") != "null"]
+        if options:
+            return mock_value_from_schema(options[0], rng, root, depth + 1)
+    schema_type = schema.get("type")
+    if isinstance(schema_type, list):
+        schema_type = next((option for option in schema_type if option != "null"), "null")
+    if schema_type == "object" or "properties" in schema:
+        return {name: mock_value_from_schema(value, rng, root, depth + 1) for name, value in schema.get("properties", {}).items()}
+    if schema_type == "array":
+        return [mock_value_from_schema(schema.get("items"), rng, root, depth + 1) for _ in range(max(schema.get("minItems", 1), 1))]
+    if schema_type == "integer":
+        return rng.randint(int(schema.get("minimum", 0)), int(schema.get("maximum", 100)))
+    if schema_type == "number":
+        return round(rng.uniform(schema.get("minimum", 0.0), schema.get("maximum", 100.0)), 2)
+    if schema_type == "boolean":
+        return rng.random() < 0.5
+    if schema_type == "string":
+        return f"mock {schema.get('title', 'value').lower()}"
+    return None
+
+
+def _openai_tool_schema(request_json: Dict[str, Any], name: str) -> Optional[Dict[str, Any]]:
+    for tool in request_json.get("tools") or []:
+        if tool.get("function", {}).get("name") == name:
+            return tool["function"].get("parameters")
+    return None
+
+
+def mock_chat_completion(request_json: Dict[str, Any], rng: Optional[random.Random] = None) -> Dict[str, Any]:
+    """ A minimal `chat.completion` answer to an OpenAI-style request, structured outputs follow the request's schema. """
+    message: Dict[str, Any] = {"role": "assistant", "content": "This is a mock response."}
+    tool_choice = request_json.get("tool_choice")
+    response_format = request_json.get("response_format") or {}
+    if request_json.get("tools") and isinstance(tool_choice, dict):
+        name = tool_choice["function"]["name"]
+        message = {
+            "role": "assistant",
+            "content": None,
+            "tool_calls": [{
+                "id": _new_id("call_"),
+                "type": "function",
+                "function": {"name": name, "arguments": json.dumps(mock_value_from_schema(_openai_tool_schema(request_json, name), rng) or {})},
+            }],
+        }
+    elif response_format.get("type") == "json_schema":
+        message["content"] = json.dumps(mock_value_from_schema(response_format.get("json_schema", {}).get("schema"), rng) or {})
+    elif response_format.get("type") == "json_object":
+        message["content"] = "{}"
+    prompt_tokens = sum(len(str(m.get("content") or "")) // 4 + 4 for m in request_json.get("messages", []))
+    completion_tokens = len(str(message.get("content") or "")) // 4 + 1
+    return {
+        "id": _new_id("chatcmpl-"),
+        "object": "chat.completion",
+        "created": int(time.time()),
+        "model": request_json.get("model", "mock-model"),
+        "choices": [{"index": 0, "message": message, "finish_reason": "stop", "logprobs": None}],
+        "usage": {"prompt_tokens": prompt_tokens, "completion_tokens": completion_tokens, "total_tokens": prompt_tokens + completion_tokens},
+    }
+
+
+def mock_anthropic_message(request_json: Dict[str, Any], rng: Optional[random.Random] = None) -> Dict[str, Any]:
+    """ A minimal Messages API answer to an Anthropic request, tool inputs follow the tool's input_schema. """
+    tool_choice = request_json.get("tool_choice")
+    if request_json.get("tools") and isinstance(tool_choice, dict) and tool_choice.get("type") == "tool":
+        input_schema = next((tool.get("input_schema") for tool in request_json["tools"] if tool.get("name") == tool_choice["name"]), None)
+        content = [{"type": "tool_use", "id": _new_id("toolu_"), "name": tool_choice["name"], "input": mock_value_from_schema(input_schema, rng) or {}}]
+        stop_reason = "tool_use"
+    else:
+        content = [{"type": "text", "text": "This is a mock response."}]
+        stop_reason = "end_turn"
+    input_tokens = sum(len(json.dumps(m.get("content"))) // 4 for m in request_json.get("messages", []))
+    return {
+        "id": _new_id("msg_"),
+        "type": "message",
+        "role": "assistant",
+        "model": request_json.get("model", "mock-model"),
+        "content": content,
+        "stop_reason": stop_reason,
+        "stop_sequence": None,
+        "usage": {"input_tokens": input_tokens, "output_tokens": len(json.dumps(content)) // 4 + 1},
+    }
+
+
+class FakeBatchServer:
+    """
+    In-process fake of the OpenAI Batch and Anthropic Message Batches APIs.
+
+    Batches finish `processing_delay` seconds after submission and every request is answered with
+    `mock_chat_completion` / `mock_anthropic_message`. `base_url` (including `/v1`) is available
+    once the server is started; port 0 picks a free port.
+    """
+
+    def __init__(self, host: str = "localhost", port: int = 0, processing_delay: float = 0.0):
+        self.host = host
+        self.port = port
+        self.processing_delay = processing_delay
+        self.files: Dict[str, str] = {}
+        self.openai_batches: Dict[str, Dict[str, Any]] = {}
+        self.anthropic_batches: Dict[str, Dict[str, Any]] = {}
+        self.anthropic_results: Dict[str, List[Dict[str, Any]]] = {}
+        self._runner: Optional[web.AppRunner] = None
+        self._tasks = set()
+
+    @property
+    def base_url(self) -> str:
+        return f"http://{self.host}:{self.port}/v1"
+
+    def add_routes(self, app: web.Application) -> None:
+        app.router.add_post("/v1/files", self.create_file)
+        app.router.add_get("/v1/files/{file_id}/content", self.file_content)
+        app.router.add_post("/v1/batches", self.create_openai_batch)
+        app.router.add_get("/v1/batches/{batch_id}", self.retrieve_openai_batch)
+        app.router.add_post("/v1/messages/batches", self.create_anthropic_batch)
+        app.router.add_get("/v1/messages/batches/{batch_id}", self.retrieve_anthropic_batch)
+        app.router.add_get("/v1/messages/batches/{batch_id}/results", self.anthropic_batch_results)
+
+    async def start(self) -> "FakeBatchServer":
+        app = web.Application()
+        self.add_routes(app)
+        self._runner = web.AppRunner(app, access_log=None)
+        await self._runner.setup()
+        site = web.TCPSite(self._runner, self.host, self.port)
+        await site.start()
+        self.port = self._runner.addresses[0][1]
+        return self
+
+    async def stop(self) -> None:
+        for task in list(self._tasks):
+            task.cancel()
+        if self._runner is not None:
+            await self._runner.cleanup()
+            self._runner = None
+
+    async def __aenter__(self) -> "FakeBatchServer":
+        return await self.start()
+
+    async def __aexit__(self, *exc_info) -> None:
+        await self.stop()
+
+    def _schedule(self, coroutine) -> None:
+        task = asyncio.create_task(coroutine)
+        self._tasks.add(task)
+        task.add_done_callback(self._tasks.discard)
+
+    # OpenAI files and batches
+
+    async def create_file(self, request: web.Request) -> web.Response:
+        form = await request.post()
+        upload = form["file"]
+        content = upload.file.read().decode("utf-8") if hasattr(upload, "file") else str(upload)
+        file_id = _new_id("file-")
+        self.files[file_id] = content
+        return web.json_response({"id": file_id, "object": "file", "bytes": len(content), "created_at": int(time.time()),
+                                  "filename": getattr(upload, "filename", "upload.jsonl"), "purpose": form.get("purpose", "batch")})
+
+    async def file_content(self, request: web.Request) -> web.Response:
+        file_id = request.match_info["file_id"]
+        if file_id not in self.files:
+            return web.json_response({"error": {"message": f"No such file: {file_id}"}}, status=404)
+        return web.Response(text=self.files[file_id], content_type="application/jsonl")
+
+    async def create_openai_batch(self, request: web.Request) -> web.Response:
+        body = await request.json()
+        if body.get("input_file_id") not in self.files:
+            return web.json_response({"error": {"message": "input_file_id not found"}}, status=400)
+        batch_id = _new_id("batch_")
+        batch = {"id": batch_id, "object": "batch", "endpoint": body["endpoint"], "input_file_id": body["input_file_id"],
+                 "completion_window": body.get("completion_window", "24h"), "status": "in_progress",
+                 "output_file_id": None, "error_file_id": None, "created_at": int(time.time())}
+        self.openai_batches[batch_id] = batch
+        self._schedule(self._process_openai_batch(batch))
+        return web.json_response(batch)
+
+    async def _process_openai_batch(self, batch: Dict[str, Any]) -> None:
+        await asyncio.sleep(self.processing_delay)
+        output_lines = []
+        for line in self.files[batch["input_file_id"]].splitlines():
+            if not line.strip():
+                continue
+            entry = json.loads(line)
+            output_lines.append(json.dumps({
+                "id": _new_id("batch_req_"),
+                "custom_id": entry["custom_id"],
+                "response": {"status_code": 200, "request_id": _new_id("req_"), "body": mock_chat_completion(entry["body"])},
+                "error": None,
+            }))
+        output_file_id = _new_id("file-")
+        self.files[output_file_id] = "\n".join(output_lines) + "\n"
+        batch.update(status="completed", output_file_id=output_file_id, completed_at=int(time.time()))
+
+    async def retrieve_openai_batch(self, request: web.Request) -> web.Response:
+        batch = self.openai_batches.get(request.match_info["batch_id"])
+        if batch is None:
+            return web.json_response({"error": {"message": "batch not found"}}, status=404)
+        return web.json_response(batch)
+
+    # Anthropic message batches
+
+    async def create_anthropic_batch(self, request: web.Request) -> web.Response:
+        body = await request.json()
+        batch_id = _new_id("msgbatch_")
+        batch = {"id": batch_id, "type": "message_batch", "processing_status": "in_progress",
+                 "request_counts": {"processing": len(body["requests"]), "succeeded": 0, "errored": 0, "canceled": 0, "expired": 0},
+                 "results_url": None, "created_at": time.strftime("%Y-%m-%dT%H:%M:%SZ", time.gmtime())}
+        self.anthropic_batches[batch_id] = batch
+        self._schedule(self._process_anthropic_batch(batch, body["requests"]))
+        return web.json_response(batch)
+
+    async def _process_anthropic_batch(self, batch: Dict[str, Any], requests: List[Dict[str, Any]]) -> None:
+        await asyncio.sleep(self.processing_delay)
+        self.anthropic_results[batch["id"]] = [
+            {"custom_id": entry["custom_id"], "result": {"type": "succeeded", "message": mock_anthropic_message(entry["params"])}}
+            for entry in requests
+        ]
+        batch["request_counts"].update(processing=0, succeeded=len(requests))
+        batch.update(processing_status="ended", results_url=f"{self.base_url}/messages/batches/{batch['id']}/results")
+
+    async def retrieve_anthropic_batch(self, request: web.Request) -> web.Response:
+        batch = self.anthropic_batches.get(request.match_info["batch_id"])
+        if batch is None:
+            return web.json_response({"error": {"type": "not_found_error", "message": "batch not found"}}, status=404)
+        return web.json_response(batch)
+
+    async def anthropic_batch_results(self, request: web.Request) -> web.Response:
+        results = self.anthropic_results.get(request.match_info["batch_id"])
+        if results is None:
+            return web.json_response({"error": {"type": "not_found_error", "message": "results not ready"}}, status=404)
+        return web.Response(text="".join(json.dumps(entry) + "\n" for entry in results), content_type="application/jsonl")
+
+
+class MockServerConfig(BaseModel):
+    latency_distribution: Literal["constant", "uniform", "normal", "lognormal", "exponential"] = Field(default="lognormal", description="Distribution of the time before a response starts")
+    latency_mean: float = Field(default=0.5, description="Mean of the base latency in seconds")
+    latency_std: float = Field(default=0.25, description="Standard deviation of the base latency (half-width for uniform)")
+    seconds_per_output_token: float = Field(default=0.0, description="Generation time added per completion token")
+    max_requests_per_minute: Optional[int] = Field(default=None, description="Server-side RPM limit answered with 429, None for unlimited")
+    max_tokens_per_minute: Optional[int] = Field(default=None, description="Server-side TPM limit (prompt and max_tokens) answered with 429, None for unlimited")
+    rate_limit_error_rate: float = Field(default=0.0, description="Probability of answering any request with a 429")
+    server_error_rate: float = Field(default=0.0, description="Probability of answering any request with a 500 or 503")
+    retry_after: Optional[float] = Field(default=1.0, description="retry-after seconds sent with injected 429s, None to omit the header")
+    seed: Optional[int] = Field(default=None, description="Seed of the latency, error and structured output draws")
+
+
+@dataclass
+class MockServerStats:
+    """
+    Counters of a `MockLLMServer`, also served as JSON on `/stats`.
+
+    Attributes:
+    - requests: Requests received on the online endpoints.
+    - succeeded: Requests answered with a completion.
+    - rate_limited: Requests answered with 429, by the limits or by injection.
+    - server_errors: Requests answered with an injected 500 or 503.
+    - prompt_tokens: Prompt tokens of the answered requests.
+    - completion_tokens: Completion tokens of the answered requests.
+    - in_flight: Requests currently being answered.
+    - max_in_flight: Highest concurrency observed.
+    """
+
+    requests: int = 0
+    succeeded: int = 0
+    rate_limited: int = 0
+    server_errors: int = 0
+    prompt_tokens: int = 0
+    completion_tokens: int = 0
+    in_flight: int = 0
+    max_in_flight: int = 0
+
+
+class MockLLMServer(FakeBatchServer):
+    """
+    In-process fake of the online chat completion and messages endpoints, on top of the batch
+    endpoints of `FakeBatchServer`.
+
+    Every request first draws a 429 or 5xx according to the injection rates, then is checked
+    against the RPM/TPM buckets (prompt tokens plus max_tokens, as providers count them); rejected
+    requests get a 429 with `retry-after` and the OpenAI `x-ratelimit-*` or Anthropic
+    `anthropic-ratelimit-*` headers. Accepted requests sleep for a latency drawn from the configured
+    distribution plus `seconds_per_output_token` per completion token before being answered.
+    """
+
+    def __init__(self, host: str = "localhost", port: int = 0, config: Optional[MockServerConfig] = None, processing_delay: float = 0.0):
+        super().__init__(host, port, processing_delay)
+        self.config = config if config else MockServerConfig()
+        self.stats = MockServerStats()
+        self._rng = random.Random(self.config.seed)
+        self._request_bucket = TokenBucket(self.config.max_requests_per_minute) if self.config.max_requests_per_minute else None
+        self._token_bucket = TokenBucket(self.config.max_tokens_per_minute) if self.config.max_tokens_per_minute else None
+
+    def add_routes(self, app: web.Application) -> None:
+        super().add_routes(app)
+        app.router.add_post("/v1/chat/completions", self.chat_completions)
+        app.router.add_post("/v1/messages", self.messages)
+        app.router.add_get("/health", self.health)
+        app.router.add_get("/stats", self.get_stats)
+
+    def sample_latency(self) -> float:
+        mean, std, distribution = self.config.latency_mean, self.config.latency_std, self.config.latency_distribution
+        if distribution == "constant" or mean <= 0:
+            return max(mean, 0.0)
+        if distribution == "uniform":
+            return max(self._rng.uniform(mean - std, mean + std), 0.0)
+        if distribution == "normal":
+            return max(self._rng.gauss(mean, std), 0.0)
+        if distribution == "exponential":
+            return self._rng.expovariate(1.0 / mean)
+        # lognormal with the configured mean and standard deviation, the heavy right tail of real endpoints
+        sigma2 = math.log(1 + (std / mean) ** 2)
+        return self._rng.lognormvariate(math.log(mean) - sigma2 / 2, math.sqrt(sigma2))
+
+    def _rate_limit_headers(self, anthropic: bool) -> Dict[str, str]:
+        headers = {}
+        for kind, bucket in (("requests", self._request_bucket), ("tokens", self._token_bucket)):
+            if bucket is None:
+                continue
+            bucket.refill()
+            reset = (bucket.capacity - bucket.level) / bucket.refill_per_second if bucket.refill_per_second else 0.0
+            if anthropic:
+                headers[f"anthropic-ratelimit-{kind}-limit"] = str(int(bucket.capacity))
+                headers[f"anthropic-ratelimit-{kind}-remaining"] = str(max(int(bucket.level), 0))
+                headers[f"anthropic-ratelimit-{kind}-reset"] = time.strftime("%Y-%m-%dT%H:%M:%SZ", time.gmtime(time.time() + reset))
+            else:
+                headers[f"x-ratelimit-limit-{kind}"] = str(int(bucket.capacity))
+                headers[f"x-ratelimit-remaining-{kind}"] = str(max(int(bucket.level), 0))
+                headers[f"x-ratelimit-reset-{kind}"] = f"{reset:.3f}s"
+        return headers
+
+    def _admit(self, request_tokens: int) -> Optional[float]:
+        """ Consumes the request's budget and returns None, or returns the seconds until it would fit. """
+        wait = max(
+            self._request_bucket.seconds_until_available(1) if self._request_bucket else 0.0,
+            self._token_bucket.seconds_until_available(request_tokens) if self._token_bucket else 0.0,
+        )
+        if wait > 0:
+            return wait
+        if self._request_bucket:
+            self._request_bucket.consume(1)
+        if self._token_bucket:
+            self._token_bucket.consume(request_tokens)
+        return None
+
+    def _error_response(self, status: int, message: str, anthropic: bool, retry_after: Optional[float]) -> web.Response:
+        headers = self._rate_limit_headers(anthropic)
+        if retry_after is not None:
+            headers["retry-after"] = f"{retry_after:.3f}"
+        if anthropic:
+            error_type = "rate_limit_error" if status == 429 else "api_error"
+            body = {"type": "error", "error": {"type": error_type, "message": message}}
+        else:
+            body = {"error": {"message": message, "type": "rate_limit_exceeded" if status == 429 else "server_error", "code": status}}
+        return web.json_response(body, status=status, headers=headers)
+
+    async def _complete(self, request: web.Request, anthropic: bool) -> web.Response:
+        request_json = await request.json()
+        self.stats.requests += 1
+        draw = self._rng.random()
+        if draw < self.config.rate_limit_error_rate:
+            self.stats.rate_limited += 1
+            return self._error_response(429, "Rate limit reached (injected)", anthropic, self.config.retry_after)
+        if draw < self.config.rate_limit_error_rate + self.config.server_error_rate:
+            self.stats.server_errors += 1
+            return self._error_response(self._rng.choice([500, 503]), "The server had an error (injected)", anthropic, None)
+
+        response = mock_anthropic_message(request_json, self._rng) if anthropic else mock_chat_completion(request_json, self._rng)
+        usage = response["usage"]
+        prompt_tokens = usage["input_tokens"] if anthropic else usage["prompt_tokens"]
+        completion_tokens = usage["output_tokens"] if anthropic else usage["completion_tokens"]
+        wait = self._admit(prompt_tokens + int(request_json.get("max_tokens") or completion_tokens))
+        if wait is not None:
+            self.stats.rate_limited += 1
+            return self._error_response(429, "Rate limit reached for requests or tokens per minute", anthropic, wait)
+
+        self.stats.in_flight += 1
+        self.stats.max_in_flight = max(self.stats.max_in_flight, self.stats.in_flight)
+        try:
+            await asyncio.sleep(self.sample_latency() + completion_tokens * self.config.seconds_per_output_token)
+        finally:
+            self.stats.in_flight -= 1
+        self.stats.succeeded += 1
+        self.stats.prompt_tokens += prompt_tokens
+        self.stats.completion_tokens += completion_tokens
+        return web.json_response(response, headers=self._rate_limit_headers(anthropic))
+
+    async def chat_completions(self, request: web.Request) -> web.Response:
+        return await self._complete(request, anthropic=False)
+
+    async def messages(self, request: web.Request) -> web.Response:
+        return await self._complete(request, anthropic=True)
+
+    async def health(self, request: web.Request) -> web.Response:
+        return web.Response(text="ok")
+
+    async def get_stats(self, request: web.Request) -> web.Response:
+        return web.json_response(asdict(self.stats))
+
+
+if __name__ == "__main__":
+    import argparse
+
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--host", default="localhost")
+    parser.add_argument("--port", type=int, default=8010)
+    parser.add_argument("--processing_delay", type=float, default=1.0)
+    parser.add_argument("--latency_distribution", default="lognormal", choices=["constant", "uniform", "normal", "lognormal", "exponential"])
+    parser.add_argument("--latency_mean", type=float, default=0.5)
+    parser.add_argument("--latency_std", type=float, default=0.25)
+    parser.add_argument("--max_requests_per_minute", type=int, default=None)
+    parser.add_argument("--max_tokens_per_minute", type=int, default=None)
+    parser.add_argument("--rate_limit_error_rate", type=float, default=0.0)
+    parser.add_argument("--server_error_rate", type=float, default=0.0)
+    args = parser.parse_args()
+
+    config = MockServerConfig(
+        latency_distribution=args.latency_distribution,
+        latency_mean=args.latency_mean,
+        latency_std=args.latency_std,
+        max_requests_per_minute=args.max_requests_per_minute,
+        max_tokens_per_minute=args.max_tokens_per_minute,
+        rate_limit_error_rate=args.rate_limit_error_rate,
+        server_error_rate=args.server_error_rate,
+    )
+
+    async def serve():
+        async with MockLLMServer(args.host, args.port, config, args.processing_delay) as server:
+            print(f"Mock LLM server listening on {server.base_url}")
+            await asyncio.Event().wait()
+
+    asyncio.run(serve())
@@ -31,9 +31,11 @@ SOFTWARE.
 import aiohttp  # for making API calls concurrently
 import argparse  # for running script from command line
 import asyncio  # for running API calls concurrently
+import functools  # for caching encoders and token counts
 import json  # for saving results to a jsonl file
 import logging  # for logging rate limit warnings and other messages
 import os  # for reading API key
+import random  # for jittering retry backoff
 import re  # for matching endpoint from request URL
 import tiktoken  # for counting tokens
 import time  # for sleeping after rate limit is hit
@@ -41,19 +43,286 @@ from dataclasses import (
     dataclass,
     field,
 )  # for storing API inputs, outputs, and metadata
-from typing import List  # for type hints in functions
+from contextlib import nullcontext  # for optionally reusing a caller-owned session
+from typing import Any, AsyncIterator, Dict, List, Literal, Mapping, Optional, Set, Tuple  # for type hints in functions
+from urllib.parse import urlsplit  # for keying pooled sessions by origin
 from pydantic import BaseModel, Field
+from market_agents.inference.rate_limiter import RateLimiter, AdaptiveConcurrencyLimiter, LatencyWindow, parse_retry_after  # for event-driven rate and concurrency limiting
+from market_agents.inference.endpoint_pool import EndpointPool  # for balancing requests across replicas
+from market_agents.inference.scheduling import FairRequestQueue  # for priority lanes and per-agent fairness
+
+class RetryPolicy(BaseModel):
+    initial_backoff: float = Field(0.5, description="Seconds to wait before the first retry")
+    max_backoff: float = Field(30.0, description="Upper bound of the wait between two attempts")
+    backoff_multiplier: float = Field(2.0, description="Growth factor of the wait per failed attempt")
+    jitter: Literal["full", "equal", "none"] = Field("full", description="full: uniform in [0, backoff], equal: uniform in [backoff/2, backoff], none: exact backoff")
+    retryable_statuses: Set[int] = Field({408, 409, 425, 429, 500, 502, 503, 504, 529}, description="HTTP statuses worth retrying, other 4xx responses fail immediately")
+    attempt_timeout: Optional[float] = Field(None, description="Seconds before a single HTTP attempt is abandoned, None for the session default")
+    request_deadline: Optional[float] = Field(None, description="Seconds a request may take in total, retries and waits for capacity included")
+    batch_deadline: Optional[float] = Field(None, description="Seconds after which every unfinished request of a process_api_requests call fails")
+    hedge_quantile: Optional[float] = Field(None, description="Send a duplicate of an attempt running longer than this latency quantile (e.g. 0.95), None disables hedging")
+    hedge_min_samples: int = Field(20, description="Successful latencies to observe before hedging starts")
+
+    def is_retryable(self, status: Optional[int]) -> bool:
+        """ Transport errors (no status) and error bodies sent with a success status are retried, as are the listed statuses. """
+        return status is None or status < 400 or status in self.retryable_statuses
+
+    def backoff_seconds(self, failures: int, retry_after: Optional[float] = None) -> float:
+        if retry_after is not None:
+            return min(retry_after, self.max_backoff)
+        backoff = min(self.initial_backoff * self.backoff_multiplier ** max(failures - 1, 0), self.max_backoff)
+        if self.jitter == "full":
+            return random.uniform(0, backoff)
+        if self.jitter == "equal":
+            return backoff / 2 + random.uniform(0, backoff / 2)
+        return backoff
+
+    def hedge_delay(self, latency_window: Optional[LatencyWindow]) -> Optional[float]:
+        if self.hedge_quantile is None or latency_window is None or len(latency_window) < self.hedge_min_samples:
+            return None
+        return latency_window.percentile(self.hedge_quantile)
+
+
+class OAIApiConfig(BaseModel):
+    request_url: str = Field("https://api.openai.com/v1/embeddings", description="The url to use for generating embeddings")
+    api_key: str
+    max_requests_per_minute: float = Field(100, description="The maximum number of requests per minute")
+    max_tokens_per_minute: float = Field(1_000_000, description="The maximum number of tokens per minute")
+    max_attempts: int = Field(5, description="The maximum number of attempts to make for each request")
+    logging_level: int = Field(20, description="The logging level to use for the request")
+    token_encoding_name: str = Field("cl100k_base", description="The token encoding scheme to use for calculating request sizes")
+    token_estimation: Literal["exact", "approximate"] = Field("exact", description="Whether request sizes are tokenized exactly or estimated from their length")
+    chars_per_token: float = Field(4.0, description="Characters per token used by the approximate token estimation")
+    retry_policy: RetryPolicy = Field(default_factory=RetryPolicy, description="Backoff, error classification, deadlines and hedging of failed or slow requests")
+
+
+class OAIApiFromFileConfig(OAIApiConfig):
+    requests_filepath: str
+    save_filepath: str
+
+
+class ConnectionPoolConfig(BaseModel):
+    limit: int = Field(100, description="The maximum number of simultaneous connections per session, 0 for unlimited")
+    limit_per_host: int = Field(0, description="The maximum number of simultaneous connections to a single host, 0 for unlimited")
+    keepalive_timeout: float = Field(60.0, description="Seconds an idle connection is kept open for reuse")
+    use_dns_cache: bool = Field(True, description="Whether to cache DNS lookups")
+    ttl_dns_cache: Optional[int] = Field(300, description="Seconds a DNS lookup stays cached, None to cache forever")
+    enable_cleanup_closed: bool = Field(True, description="Whether to abort SSL connections that were not closed cleanly by the server")
+
+
+async def process_api_requests(
+        api_cfg: OAIApiConfig,
+        request_queue: asyncio.Queue,
+        sink: Optional["JsonlSink"] = None,
+        session: Optional[aiohttp.ClientSession] = None,
+        rate_limiter: Optional[RateLimiter] = None,
+        concurrency_limiter: Optional[AdaptiveConcurrencyLimiter] = None,
+        latency_window: Optional[LatencyWindow] = None,
+        endpoint_pool: Optional[EndpointPool] = None,
+        session_pool: Optional["ClientSessionPool"] = None,
+) -> AsyncIterator[List[Any]]:
+    """
+    Asynchronously processes in-memory API requests, executing them in parallel
+    while adhering to specified rate limits for requests and tokens per minute.
+
+    Requests are consumed from `request_queue` as `APIRequest` objects until a `None`
+    sentinel is received. Each finished request is yielded as soon as it completes as a
+    `[metadata, request_json, response]` list, where `response` is either the decoded
+    API response or `{"error": ...}` once all attempts are exhausted.
+    The metadata carries the request's timings for `TelemetryRegistry`: `queue_wait` (seconds
+    waiting for capacity), `wire_time` (seconds on the wire), `time_to_first_byte` of the last
+    attempt, `attempts`, the `endpoint` of the last attempt and `hedged`.
+
+    Parameters:
+    - api_cfg: Endpoint, credentials and rate limits to use for the requests.
+    - request_queue: Queue of `APIRequest` objects, terminated by `None`.
+    - sink: Optional `JsonlSink` that persists every result in the background.
+    - session: Optional long-lived `aiohttp.ClientSession` (see `ClientSessionPool`) to reuse
+      connections across calls. When omitted a session is opened and closed for this call only.
+    - rate_limiter: Optional `RateLimiter` shared with other calls against the same key. When
+      omitted a limiter is created from the config budgets for this call only.
+    - concurrency_limiter: Optional `AdaptiveConcurrencyLimiter` bounding the requests in flight
+      to the endpoint from observed latency and errors. When omitted concurrency is only bounded
+      by the rate limits and the session's connection pool.
+    - latency_window: Optional `LatencyWindow` of successful request latencies, shared across
+      calls so the hedging threshold of `api_cfg.retry_policy` survives between batches.
+    - endpoint_pool: Optional `EndpointPool` of replicas serving the same model. When given every
+      attempt is sent to the replica picked by the pool, under that replica's own rate limits and
+      in-flight limit, instead of `api_cfg.request_url`; `rate_limiter` and `concurrency_limiter`
+      are then ignored.
+    - session_pool: Optional `ClientSessionPool` used with `endpoint_pool`, so every attempt goes through
+      the session of the replica it was sent to and each replica keeps its own connections and
+      `ConnectionPoolMetrics`. Without it all replicas share `session`.
+
+    Failed attempts are classified by `api_cfg.retry_policy`: fatal errors (e.g. 400/401/404)
+    finish immediately, retryable ones are re-queued after a jittered exponential backoff (or
+    the server's retry-after). Requests past their request or batch deadline fail with a
+    deadline error instead of holding the batch.
+
+    Requests are dispatched by priority lane, and within a lane fairly across agents by their
+    token estimates (`FairRequestQueue`); the shared limiters order their waiters the same way.
+
+    Dispatching is event driven: the loop sleeps until a request (or retry) is queued and the
+    rate limiter has capacity for it, and wakes on completions instead of polling.
+
+    No files are read or written unless a sink is given, so the hot path does a single
+    JSON encode/decode per request (the HTTP body itself).
+    """
+    # extract variables from config
+    request_url = api_cfg.request_url
+    api_key = api_cfg.api_key
+    logging_level = api_cfg.logging_level
+
+    # initialize logging
+    logging.basicConfig(level=logging_level)
+    logging.debug(f"Logging initialized at level {logging_level}")
+
+    request_header = request_header_from_url(request_url, api_key)
+    retry_policy = api_cfg.retry_policy
+    if latency_window is None:
+        latency_window = LatencyWindow()
+    batch_deadline = time.time() + retry_policy.batch_deadline if retry_policy.batch_deadline is not None else None
+
+    # initialize trackers
+    if rate_limiter is None:
+        rate_limiter = RateLimiter(
+            max_requests_per_minute=api_cfg.max_requests_per_minute,
+            max_tokens_per_minute=api_cfg.max_tokens_per_minute,
+        )
+    work_queue = FairRequestQueue()  # new requests and retries waiting for capacity, by priority and agent
+    results_queue = asyncio.Queue()
+    status_tracker = (
+        StatusTracker()
+    )  # single instance to track a collection of variables
+    input_finished = False  # set once the None sentinel is read from request_queue
+
+    def wake_dispatcher_if_done(_=None):
+        if input_finished and status_tracker.num_tasks_in_progress == 0:
+            work_queue.put_nowait(None)
+
+    async def feed_requests():
+        nonlocal input_finished
+        while True:
+            request = await request_queue.get()
+            if request is None:
+                logging.debug("Request queue exhausted")
+                break
+            status_tracker.num_tasks_started += 1
+            status_tracker.num_tasks_in_progress += 1
+            deadlines = [deadline for deadline in (
+                request.deadline,
+                time.time() + retry_policy.request_deadline if retry_policy.request_deadline is not None else None,
+                batch_deadline,
+            ) if deadline is not None]
+            request.deadline = min(deadlines) if deadlines else None
+            request.queued_at = time.monotonic()
+            logging.debug(f"Reading request {request.task_id}: {request}")
+            work_queue.put_nowait(request)
+        input_finished = True
+        wake_dispatcher_if_done()
+
+    async def dispatch_requests():
+        in_flight = set()  # keep references to running tasks until they finish
+        feeder = asyncio.create_task(feed_requests())
+        logging.debug(f"Initialization complete. Entering main loop")
+        try:
+            async with (nullcontext(session) if session is not None else aiohttp.ClientSession()) as http_session:
+                while not (input_finished and status_tracker.num_tasks_in_progress == 0):
+                    # sleeps until a new request, a retry or a completion arrives
+                    next_request = await work_queue.get()
+                    if next_request is None:
+                        continue
+                    if next_request.result:
+                        logging.debug(f"Retrying request {next_request.task_id}: {next_request}")
+
+                    if next_request.is_past_deadline():
+                        next_request.fail("Deadline exceeded before the request could be sent", results_queue, status_tracker, deadline_exceeded=True)
+                        continue
+
+                    if endpoint_pool is not None:
+                        # the pool picks a replica with a free slot and budget, and takes both
+                        try:
+                            endpoint = await asyncio.wait_for(endpoint_pool.acquire(next_request.token_consumption, next_request.priority, next_request.flow), timeout=next_request.remaining_time())
+                        except asyncio.TimeoutError:
+                            next_request.fail("Deadline exceeded while waiting for an available endpoint", results_queue, status_tracker, deadline_exceeded=True)
+                            continue
+                        attempt_url, attempt_rate_limiter, attempt_concurrency_limiter = endpoint.url, endpoint.rate_limiter, endpoint
+                        attempt_session = session_pool.get_session(endpoint.url) if session_pool is not None else http_session
+                    else:
+                        # a slot first, so budget is not consumed by a request that then waits for the endpoint,
+                        # then sleep exactly until the rate limits have capacity for this request
+                        slot_taken = False
+                        try:
+                            if concurrency_limiter is not None:
+                                await asyncio.wait_for(concurrency_limiter.acquire(next_request.priority, next_request.flow), timeout=next_request.remaining_time())
+                                slot_taken = True
+                            await asyncio.wait_for(rate_limiter.acquire(next_request.token_consumption, next_request.priority, next_request.flow), timeout=next_request.remaining_time())
+                        except asyncio.TimeoutError:
+                            if slot_taken:
+                                concurrency_limiter.release(None)
+                            next_request.fail("Deadline exceeded while waiting for rate limit capacity", results_queue, status_tracker, deadline_exceeded=True)
+                            continue
+                        attempt_url, attempt_rate_limiter, attempt_concurrency_limiter = request_url, rate_limiter, concurrency_limiter
+                        attempt_session = http_session
+                    next_request.attempts_left -= 1
+                    next_request.metadata["queue_wait"] = next_request.metadata.get("queue_wait", 0.0) + time.monotonic() - next_request.queued_at
+                    next_request.metadata["endpoint"] = attempt_url
+
+                    # call API
+                    task = asyncio.create_task(
+                        next_request.call_api(
+                            session=attempt_session,
+                            request_url=attempt_url,
+                            request_header=request_header,
+                            retry_queue=work_queue,
+                            results_queue=results_queue,
+                            status_tracker=status_tracker,
+                            rate_limiter=attempt_rate_limiter,
+                            concurrency_limiter=attempt_concurrency_limiter,
+                            retry_policy=retry_policy,
+                            latency_window=latency_window,
+                        )
+                    )
+                    in_flight.add(task)
+                    task.add_done_callback(in_flight.discard)
+                    task.add_done_callback(wake_dispatcher_if_done)
+        finally:
+            feeder.cancel()
+            # only left running when the consumer stopped early
+            for task in in_flight:
+                task.cancel()
+            # also when the loop raised, so the consumer stops waiting and the error surfaces from `await dispatcher`
+            results_queue.put_nowait(None)
+
+    dispatcher = asyncio.create_task(dispatch_requests())
+    try:
+        while True:
+            result = await results_queue.get()
+            if result is None:
+                break
+            if sink is not None:
+                sink.write(result)
+            yield result
+        await dispatcher
+    finally:
+        if not dispatcher.done():
+            dispatcher.cancel()
+
+    # after finishing, log final status
+    logging.info("Parallel processing complete.")
+    if status_tracker.num_tasks_failed > 0:
+        logging.warning(
+            f"{status_tracker.num_tasks_failed} / {status_tracker.num_tasks_started} requests failed."
+        )
+    if status_tracker.num_rate_limit_errors > 0:
+        logging.warning(
+            f"{status_tracker.num_rate_limit_errors} rate limit errors received. Consider running at a lower rate."
+        )
+    if status_tracker.num_deadline_exceeded > 0:
+        logging.warning(f"{status_tracker.num_deadline_exceeded} requests exceeded their deadline.")
+    if status_tracker.num_hedged_requests > 0:
+        logging.info(f"{status_tracker.num_hedged_requests} slow requests were hedged.")
 
-class OAIApiFromFileConfig(BaseModel):
- requests_filepath: str
- save_filepath: str
- api_key: str
- request_url:str =  Field("https://api.openai.com/v1/embeddings",description="The url to use for generating embeddings")
- max_requests_per_minute: float = Field(100,description="The maximum number of requests per minute")
- max_tokens_per_minute: float = Field(1_000_000,description="The maximum number of tokens per minute")
- max_attempts:int = Field(5,description="The maximum number of attempts to make for each request")
- logging_level:int = Field(20,description="The logging level to use for the request")
- token_encoding_name: str = Field("cl100k_base",description="The token encoding scheme to use for calculating request sizes")
 
 async def process_api_requests_from_file(
         api_cfg: OAIApiFromFileConfig
@@ -77,179 +346,30 @@ async def process_api_requests_from_file(
     - max_attempts: The maximum number of attempts for each request in case of failures.
     - logging_level: The logging level to use for reporting the process's progress and issues.
     
-    The function initializes necessary tracking structures, sets up asynchronous HTTP sessions,
-    and manages request retries and rate limiting. It logs the progress and any issues encountered
-    during the process to facilitate monitoring and debugging.
+    This is a thin file-based wrapper around `process_api_requests`: the requests file is
+    loaded into an in-memory queue and results are persisted through a `JsonlSink`.
     """
-    #extract variables from config
-    requests_filepath = api_cfg.requests_filepath
-    save_filepath = api_cfg.save_filepath
-    request_url = api_cfg.request_url
-    api_key = api_cfg.api_key
-    max_requests_per_minute = api_cfg.max_requests_per_minute
-    max_tokens_per_minute = api_cfg.max_tokens_per_minute
-    token_encoding_name = api_cfg.token_encoding_name
-    max_attempts = api_cfg.max_attempts
-    logging_level = api_cfg.logging_level
-    # constants
-    seconds_to_pause_after_rate_limit_error = 15
-    seconds_to_sleep_each_loop = (
-        0.001  # 1 ms limits max throughput to 1,000 requests per second
-    )
-
-    # initialize logging
-    logging.basicConfig(level=logging_level)
-    logging.debug(f"Logging initialized at level {logging_level}")
-
-    # infer API endpoint and construct request header
-    api_endpoint = api_endpoint_from_url(request_url)
-    request_header = {"Authorization": f"Bearer {api_key}"}
-    # use api-key header for Azure deployments
-    if '/deployments' in request_url:
-        request_header = {"api-key": f"{api_key}"}
-    # Add Anthropic-specific headers
-    if 'anthropic.com' in request_url:
-        request_header = {
-            "x-api-key": api_key,
-            "anthropic-version": "2023-06-01",
-            "content-type": "application/json",
-            "anthropic-beta": "prompt-caching-2024-07-31"
-        }
-
-    # initialize trackers
-    queue_of_requests_to_retry = asyncio.Queue()
     task_id_generator = (
         task_id_generator_function()
     )  # generates integer IDs of 1, 2, 3, ...
-    status_tracker = (
-        StatusTracker()
-    )  # single instance to track a collection of variables
-    next_request = None  # variable to hold the next request to call
-
-    # initialize available capacity counts
-    available_request_capacity = max_requests_per_minute
-    available_token_capacity = max_tokens_per_minute
-    last_update_time = time.time()
-
-    # initialize flags
-    file_not_finished = True  # after file is empty, we'll skip reading it
-    logging.debug(f"Initialization complete.")
-
-    # initialize file reading
-    with open(requests_filepath) as file:
-        # `requests` will provide requests one at a time
-        requests = file.__iter__()
-        logging.debug(f"File opened. Entering main loop")
-        async with aiohttp.ClientSession() as session:  # Initialize ClientSession here
-            while True:
-                # get next request (if one is not already waiting for capacity)
-                if next_request is None:
-                    if not queue_of_requests_to_retry.empty():
-                        next_request = queue_of_requests_to_retry.get_nowait()
-                        logging.debug(
-                            f"Retrying request {next_request.task_id}: {next_request}"
-                        )
-                    elif file_not_finished:
-                        try:
-                            # get new request
-                            request_json = json.loads(next(requests))
-                            metadata, actual_request = request_json  # Unpack the list
-                            next_request = APIRequest(
-                                task_id=next(task_id_generator),
-                                request_json=actual_request,
-                                token_consumption=num_tokens_consumed_from_request(
-                                    actual_request, api_endpoint, token_encoding_name
-                                ),
-                                attempts_left=max_attempts,
-                                metadata=metadata,
-                            )
-                            status_tracker.num_tasks_started += 1
-                            status_tracker.num_tasks_in_progress += 1
-                            logging.debug(
-                                f"Reading request {next_request.task_id}: {next_request}"
-                            )
-                        except StopIteration:
-                            # if file runs out, set flag to stop reading it
-                            logging.debug("Read file exhausted")
-                            file_not_finished = False
-
-                # update available capacity
-                current_time = time.time()
-                seconds_since_update = current_time - last_update_time
-                available_request_capacity = min(
-                    available_request_capacity
-                    + max_requests_per_minute * seconds_since_update / 60.0,
-                    max_requests_per_minute,
-                )
-                available_token_capacity = min(
-                    available_token_capacity
-                    + max_tokens_per_minute * seconds_since_update / 60.0,
-                    max_tokens_per_minute,
-                )
-                last_update_time = current_time
-
-                # if enough capacity available, call API
-                if next_request:
-                    next_request_tokens = next_request.token_consumption
-                    if (
-                        available_request_capacity >= 1
-                        and available_token_capacity >= next_request_tokens
-                    ):
-                        # update counters
-                        available_request_capacity -= 1
-                        available_token_capacity -= next_request_tokens
-                        next_request.attempts_left -= 1
-
-                        # call API
-                        asyncio.create_task(
-                            next_request.call_api(
-                                session=session,
-                                request_url=request_url,
-                                request_header=request_header,
-                                retry_queue=queue_of_requests_to_retry,
-                                save_filepath=save_filepath,
-                                status_tracker=status_tracker,
-                            )
-                        )
-                        next_request = None  # reset next_request to empty
-
-                # if all tasks are finished, break
-                if status_tracker.num_tasks_in_progress == 0:
-                    break
-
-                # main loop sleeps briefly so concurrent tasks can run
-                await asyncio.sleep(seconds_to_sleep_each_loop)
-
-                # if a rate limit error was hit recently, pause to cool down
-                seconds_since_rate_limit_error = (
-                    time.time() - status_tracker.time_of_last_rate_limit_error
+    request_queue = asyncio.Queue()
+    with open(api_cfg.requests_filepath) as file:
+        for line in file:
+            metadata, actual_request = json.loads(line)  # Unpack the list
+            request_queue.put_nowait(
+                api_request_from_json(
+                    task_id=next(task_id_generator),
+                    request_json=actual_request,
+                    metadata=metadata,
+                    api_cfg=api_cfg,
                 )
-                if (
-                    seconds_since_rate_limit_error
-                    < seconds_to_pause_after_rate_limit_error
-                ):
-                    remaining_seconds_to_pause = (
-                        seconds_to_pause_after_rate_limit_error
-                        - seconds_since_rate_limit_error
-                    )
-                    await asyncio.sleep(remaining_seconds_to_pause)
-                    # ^e.g., if pause is 15 seconds and final limit was hit 5 seconds ago
-                    logging.warn(
-                        f"Pausing to cool down until {time.ctime(status_tracker.time_of_last_rate_limit_error + seconds_to_pause_after_rate_limit_error)}"
-                    )
-
-        # after finishing, log final status
-        logging.info(
-            f"""Parallel processing complete. Results saved to {save_filepath}"""
-        )
-        if status_tracker.num_tasks_failed > 0:
-            logging.warning(
-                f"{status_tracker.num_tasks_failed} / {status_tracker.num_tasks_started} requests failed. Errors logged to {save_filepath}."
-            )
-        if status_tracker.num_rate_limit_errors > 0:
-            logging.warning(
-                f"{status_tracker.num_rate_limit_errors} rate limit errors received. Consider running at a lower rate."
             )
+    request_queue.put_nowait(None)
+
+    async with JsonlSink(api_cfg.save_filepath) as sink:
+        async for _ in process_api_requests(api_cfg, request_queue, sink=sink):
+            pass
+    logging.info(f"Results saved to {api_cfg.save_filepath}")
 
 
 # dataclasses
@@ -275,6 +395,9 @@ class StatusTracker:
     - num_other_errors: The count of errors that are neither API errors nor rate limit errors.
     - time_of_last_rate_limit_error: A timestamp (as an integer) of the last time a rate limit error was encountered,
       used to implement a cooling-off period before making subsequent requests.
+    - num_fatal_errors: The count of errors with a non-retryable status that failed without further attempts.
+    - num_deadline_exceeded: The count of requests failed because their request or batch deadline passed.
+    - num_hedged_requests: The count of duplicate attempts sent because the first one was slower than the hedging quantile.
     
     The class is initialized with all counters set to 0, and the `time_of_last_rate_limit_error`
     set to 0 indicating no rate limit errors have occurred yet.
@@ -288,6 +411,9 @@ class StatusTracker:
     num_api_errors: int = 0  # excluding rate limit errors, counted above
     num_other_errors: int = 0
     time_of_last_rate_limit_error: float = 0  # used to cool off after hitting rate limits
+    num_fatal_errors: int = 0  # non-retryable statuses, failed without further attempts
+    num_deadline_exceeded: int = 0
+    num_hedged_requests: int = 0
 
 
 @dataclass
@@ -302,6 +428,10 @@ class APIRequest:
     - attempts_left (int): The number of retries left if the request fails.
     - metadata (dict): Additional metadata associated with the request.
     - result (list): A list to store the results or errors from the API call.
+    - deadline (float): Wall-clock time after which the request fails instead of being (re)sent, None for no deadline.
+    - priority (int): Scheduling lane, lower values are dispatched first (see `PRIORITY_LEVELS`).
+    - flow (str): The agent (prompt context id) the request belongs to, for fair sharing within a lane.
+    - queued_at (float): Monotonic time the request (or its retry) entered the dispatcher queue, for the queue wait telemetry.
     
     This class encapsulates the data and actions related to making an API request, including
     retry logic and error handling.
@@ -313,6 +443,139 @@ class APIRequest:
     attempts_left: int
     metadata: dict
     result: list = field(default_factory=list)
+    deadline: Optional[float] = None
+    priority: int = 0
+    flow: Optional[str] = None
+    queued_at: float = field(default_factory=time.monotonic)
+
+    def remaining_time(self) -> Optional[float]:
+        return max(self.deadline - time.time(), 0.0) if self.deadline is not None else None
+
+    def is_past_deadline(self, at: Optional[float] = None) -> bool:
+        return self.deadline is not None and (time.time() if at is None else at) >= self.deadline
+
+    def fail(self, error: Any, results_queue: asyncio.Queue, status_tracker: StatusTracker, deadline_exceeded: bool = False) -> None:
+        """ Finishes the request with `{"error": ...}` without further attempts. """
+        logging.error(
+            f"Request {self.request_json} failed after {len(self.result)} attempts. Saving errors: {self.result}"
+        )
+        if deadline_exceeded:
+            status_tracker.num_deadline_exceeded += 1
+        self.metadata["end_time"] = time.time()
+        self.metadata["total_time"] = self.metadata["end_time"] - self.metadata["start_time"]
+        self.metadata["attempts"] = len(self.result)
+        data = [self.metadata, self.request_json, {"error": str(error) or repr(error)}]
+        results_queue.put_nowait(data)
+        status_tracker.num_tasks_in_progress -= 1
+        status_tracker.num_tasks_failed += 1
+
+    async def _attempt(
+        self,
+        session: aiohttp.ClientSession,
+        request_url: str,
+        request_header: dict,
+        timeout: Optional[float],
+    ) -> Tuple[Optional[int], Optional[Mapping[str, str]], Any, Optional[Exception], float]:
+        """ One HTTP attempt, returns `(status, headers, response, exception, latency)` and never raises. """
+        status = None
+        headers = None
+        response = None
+        start = time.monotonic()
+        post_kwargs = {"timeout": aiohttp.ClientTimeout(total=timeout)} if timeout is not None else {}
+        try:
+            async with session.post(
+                url=request_url, headers=request_header, json=self.request_json, **post_kwargs
+            ) as http_response:
+                status = http_response.status
+                headers = http_response.headers
+                self.metadata["time_to_first_byte"] = time.monotonic() - start
+                response = await http_response.json(content_type=None)
+        except (
+            Exception
+        ) as e:  # catching naked exceptions is bad practice, but in this case we'll log & save them
+            return status, headers, response, e, time.monotonic() - start
+        return status, headers, response, None, time.monotonic() - start
+
+    @staticmethod
+    def _is_success(outcome: Tuple[Optional[int], Optional[Mapping[str, str]], Any, Optional[Exception], float]) -> bool:
+        status, _, response, exception, _ = outcome
+        return exception is None and status is not None and status < 400 and isinstance(response, dict) and "error" not in response
+
+    async def _send(
+        self,
+        session: aiohttp.ClientSession,
+        request_url: str,
+        request_header: dict,
+        status_tracker: StatusTracker,
+        retry_policy: RetryPolicy,
+        rate_limiter: Optional[RateLimiter],
+        latency_window: Optional[LatencyWindow],
+        concurrency_limiter: Optional[AdaptiveConcurrencyLimiter] = None,
+    ) -> Tuple[Optional[int], Optional[Mapping[str, str]], Any, Optional[Exception], float]:
+        """
+        Sends the request, hedging it when the attempt outlives the policy's latency quantile:
+        a duplicate is sent and the first successful answer wins, the other attempt is cancelled.
+        The duplicate needs a free in-flight slot right away (no hedge otherwise) and rate limit
+        capacity, which it waits for only as long as the first attempt is still running.
+        """
+        timeout = retry_policy.attempt_timeout
+        remaining = self.remaining_time()
+        if remaining is not None:
+            timeout = remaining if timeout is None else min(timeout, remaining)
+        hedge_delay = retry_policy.hedge_delay(latency_window)
+        if hedge_delay is None or (timeout is not None and hedge_delay >= timeout):
+            return await self._attempt(session, request_url, request_header, timeout)
+
+        attempts = {asyncio.create_task(self._attempt(session, request_url, request_header, timeout))}
+        hedge_slot_taken = False
+        admission = None
+        try:
+            done, _ = await asyncio.wait(attempts, timeout=hedge_delay)
+            if not done and concurrency_limiter is not None:
+                # a backend without a free slot is not helped by a duplicate
+                hedge_slot_taken = concurrency_limiter.try_acquire()
+            admitted = not done and (concurrency_limiter is None or hedge_slot_taken)
+            if admitted and rate_limiter is not None:
+                admission = asyncio.create_task(rate_limiter.acquire(self.token_consumption, self.priority, self.flow))
+                await asyncio.wait(attempts | {admission}, return_when=asyncio.FIRST_COMPLETED)
+                if not admission.done():
+                    # the first attempt answered while the hedge was waiting for capacity
+                    admission.cancel()
+                    admitted = False
+                elif admission.exception() is not None:
+                    logging.warning(f"Not hedging request {self.task_id}: {admission.exception()!r}")
+                    admitted = False
+                elif any(task.done() for task in attempts):
+                    rate_limiter.refund(self.token_consumption)
+                    admitted = False
+            if hedge_slot_taken and not admitted:
+                concurrency_limiter.release(None)
+                hedge_slot_taken = False
+            if admitted:
+                status_tracker.num_hedged_requests += 1
+                self.metadata["hedged"] = True
+                logging.debug(f"Hedging request {self.task_id} after {hedge_delay:.2f}s")
+                remaining = self.remaining_time()
+                hedge_timeout = retry_policy.attempt_timeout
+                if remaining is not None:
+                    hedge_timeout = remaining if hedge_timeout is None else min(hedge_timeout, remaining)
+                attempts.add(asyncio.create_task(self._attempt(session, request_url, request_header, hedge_timeout)))
+            outcome = None
+            while attempts:
+                done, attempts = await asyncio.wait(attempts, return_when=asyncio.FIRST_COMPLETED)
+                for task in done:
+                    outcome = task.result()
+                    if self._is_success(outcome):
+                        return outcome
+            return outcome
+        finally:
+            for task in attempts:
+                task.cancel()
+            if admission is not None and not admission.done():
+                admission.cancel()
+            if hedge_slot_taken:
+                # only frees the slot, the outcome is reported once by call_api for the slot it was dispatched with
+                concurrency_limiter.release(None)
 
     async def call_api(
         self,
@@ -320,8 +583,12 @@ class APIRequest:
         request_url: str,
         request_header: dict,
         retry_queue: asyncio.Queue,
-        save_filepath: str,
+        results_queue: asyncio.Queue,
         status_tracker: StatusTracker,
+        rate_limiter: Optional[RateLimiter] = None,
+        concurrency_limiter: Optional[AdaptiveConcurrencyLimiter] = None,
+        retry_policy: Optional[RetryPolicy] = None,
+        latency_window: Optional[LatencyWindow] = None,
     ):
         """
         Asynchronously sends the API request using aiohttp, handles errors, and manages retries.
@@ -331,67 +598,325 @@ class APIRequest:
         - request_url (str): The URL to which the request is sent.
         - request_header (dict): Headers for the request, including authorization.
         - retry_queue (asyncio.Queue): A queue for requests that need to be retried.
-        - save_filepath (str): The file path where results or errors should be logged.
+        - results_queue (asyncio.Queue): A queue receiving `[metadata, request_json, response]` for finished requests.
         - status_tracker (StatusTracker): A shared object for tracking the status of all API requests.
+        - rate_limiter (RateLimiter): Optional limiter notified of the response status and rate-limit
+          headers and refunded the tokens a successful request did not actually use.
+        - concurrency_limiter (AdaptiveConcurrencyLimiter): Optional limiter whose slot, taken by the
+          dispatcher, is released with the request's latency and outcome.
+        - retry_policy (RetryPolicy): Backoff, error classification, deadlines and hedging, defaults to `RetryPolicy()`.
+        - latency_window (LatencyWindow): Latencies of successful requests, fed by this call and used for hedging.
         
         This method attempts to post the request to the given URL. If the request encounters an error,
-        it determines whether to retry based on the remaining attempts and updates the status tracker
-        accordingly. Successful requests or final failures are logged to the specified file.
+        it determines whether to retry based on the HTTP status, the remaining attempts and the deadline,
+        and schedules the retry on the retry queue after a backoff. Successful requests or final failures
+        are pushed onto the results queue.
         """
         logging.info(f"Starting request #{self.task_id}")
-        error = None
+        retry_policy = retry_policy if retry_policy is not None else RetryPolicy()
+        status, headers, response, exception, latency = None, None, None, None, None
         try:
-            async with session.post(
-                url=request_url, headers=request_header, json=self.request_json
-            ) as response:
-                response = await response.json()
-            if "error" in response:
-                logging.warning(
-                    f"Request {self.task_id} failed with error {response['error']}"
-                )
-                status_tracker.num_api_errors += 1
-                error = response
-                if "Rate limit" in response["error"].get("message", ""):
-                    status_tracker.time_of_last_rate_limit_error = time.time()
-                    status_tracker.num_rate_limit_errors += 1
-                    status_tracker.num_api_errors -= (
-                        1  # rate limit errors are counted separately
-                    )
+            status, headers, response, exception, latency = await self._send(
+                session, request_url, request_header, status_tracker, retry_policy, rate_limiter, latency_window, concurrency_limiter
+            )
+        finally:
+            if concurrency_limiter is not None:
+                concurrency_limiter.release(latency, status=status, failed=status is None)
+        if latency is not None:
+            self.metadata["wire_time"] = self.metadata.get("wire_time", 0.0) + latency
 
-        except (
-            Exception
-        ) as e:  # catching naked exceptions is bad practice, but in this case we'll log & save them
-            logging.warning(f"Request {self.task_id} failed with Exception {e}")
+        if rate_limiter is not None and status is not None:
+            rate_limiter.observe_response(status, headers)
+
+        error = None
+        if exception is not None:
+            logging.warning(f"Request {self.task_id} failed with Exception {exception}")
             status_tracker.num_other_errors += 1
-            error = e
+            error = exception
+        elif status >= 400 or not isinstance(response, dict) or "error" in response:
+            error = response if isinstance(response, dict) and "error" in response else {"error": {"message": f"HTTP {status}: {response}"}}
+            logging.warning(
+                f"Request {self.task_id} failed with status {status} and error {error['error']}"
+            )
+            status_tracker.num_api_errors += 1
+            error_message = error["error"].get("message", "") if isinstance(error["error"], dict) else str(error["error"])
+            if status == 429 or "Rate limit" in error_message:
+                status_tracker.time_of_last_rate_limit_error = time.time()
+                status_tracker.num_rate_limit_errors += 1
+                status_tracker.num_api_errors -= (
+                    1  # rate limit errors are counted separately
+                )
+                if rate_limiter is not None and status != 429:
+                    # a 429 already paused the limiter in observe_response
+                    rate_limiter.register_rate_limit_error(parse_retry_after(headers))
 
         if error:
             self.result.append(error)
-            if self.attempts_left:
-                retry_queue.put_nowait(self)
+            if not retry_policy.is_retryable(status):
+                status_tracker.num_fatal_errors += 1
+                self.fail(error, results_queue, status_tracker)
+                return
+            backoff = retry_policy.backoff_seconds(len(self.result), parse_retry_after(headers))
+            if not self.attempts_left:
+                self.fail(error, results_queue, status_tracker)
+            elif self.is_past_deadline(time.time() + backoff):
+                self.fail(f"Deadline exceeded before retry, last error: {str(error) or repr(error)}", results_queue, status_tracker, deadline_exceeded=True)
             else:
-                logging.error(
-                    f"Request {self.request_json} failed after all attempts. Saving errors: {self.result}"
-                )
-                self.metadata["end_time"] = time.time()
-                self.metadata["total_time"] = self.metadata["end_time"] - self.metadata["start_time"]
-                data = [self.metadata, self.request_json, {"error": str(error)}]
-                append_to_jsonl(data, save_filepath)
-                status_tracker.num_tasks_in_progress -= 1
-                status_tracker.num_tasks_failed += 1
+                logging.debug(f"Retrying request {self.task_id} in {backoff:.2f}s")
+                self.queued_at = time.monotonic() + backoff
+                asyncio.get_running_loop().call_later(backoff, retry_queue.put_nowait, self)
         else:
+            if latency_window is not None:
+                latency_window.add(latency)
+            if rate_limiter is not None:
+                tokens_used = num_tokens_used_from_response(response)
+                if tokens_used is not None:
+                    rate_limiter.refund(self.token_consumption - tokens_used)
             self.metadata["end_time"] = time.time()
             self.metadata["total_time"] = self.metadata["end_time"] - self.metadata["start_time"]
+            self.metadata["attempts"] = len(self.result) + 1
             data = [self.metadata, self.request_json, response]
-            append_to_jsonl(data, save_filepath)
+            results_queue.put_nowait(data)
             status_tracker.num_tasks_in_progress -= 1
             status_tracker.num_tasks_succeeded += 1
-            logging.debug(f"Request {self.task_id} saved to {save_filepath}")
+            logging.debug(f"Request {self.task_id} completed")
+
+
+@dataclass
+class ConnectionPoolMetrics:
+    """
+    Connection reuse counters for a single pooled session, collected through aiohttp tracing.
+
+    Attributes:
+    - requests_sent: The total number of requests sent through the session.
+    - connections_created: The number of new TCP (and TLS) connections that had to be opened.
+    - connections_reused: The number of requests served by an already open keep-alive connection.
+    - dns_cache_hits: The number of host resolutions answered from the DNS cache.
+    - dns_cache_misses: The number of host resolutions that required a DNS lookup.
+    """
+
+    requests_sent: int = 0
+    connections_created: int = 0
+    connections_reused: int = 0
+    dns_cache_hits: int = 0
+    dns_cache_misses: int = 0
+
+    @property
+    def reuse_ratio(self) -> float:
+        total = self.connections_created + self.connections_reused
+        return self.connections_reused / total if total else 0.0
+
+
+class ClientSessionPool:
+    """
+    Owns one long-lived `aiohttp.ClientSession` per endpoint origin (scheme, host and port),
+    so keep-alive connections, TLS sessions and DNS lookups are reused across batches and
+    simulation rounds instead of being re-established for every call.
+
+    Sessions are created lazily on first use and are bound to the running event loop; if a
+    session was created on a loop that is no longer running it is transparently replaced.
+    Call `close` (or use the pool as an async context manager) on shutdown.
+
+    aiohttp speaks HTTP/1.1 only, so multiplexing comes from the keep-alive pool sized by
+    `ConnectionPoolConfig.limit` / `limit_per_host` rather than from HTTP/2 streams.
+    """
+
+    def __init__(self, config: Optional[ConnectionPoolConfig] = None):
+        self.config = config if config else ConnectionPoolConfig()
+        self._sessions: Dict[str, aiohttp.ClientSession] = {}
+        self._metrics: Dict[str, ConnectionPoolMetrics] = {}
+
+    async def __aenter__(self) -> "ClientSessionPool":
+        return self
+
+    async def __aexit__(self, *exc_info) -> None:
+        await self.close()
+
+    @staticmethod
+    def origin_from_url(request_url: str) -> str:
+        parts = urlsplit(request_url)
+        return f"{parts.scheme}://{parts.netloc}"
+
+    def get_session(self, request_url: str) -> aiohttp.ClientSession:
+        origin = self.origin_from_url(request_url)
+        session = self._sessions.get(origin)
+        loop = asyncio.get_running_loop()
+        if session is None or session.closed or session._loop is not loop:
+            session = self._create_session(origin)
+            self._sessions[origin] = session
+        return session
+
+    def _create_session(self, origin: str) -> aiohttp.ClientSession:
+        metrics = self._metrics.setdefault(origin, ConnectionPoolMetrics())
+        connector = aiohttp.TCPConnector(
+            limit=self.config.limit,
+            limit_per_host=self.config.limit_per_host,
+            keepalive_timeout=self.config.keepalive_timeout,
+            use_dns_cache=self.config.use_dns_cache,
+            ttl_dns_cache=self.config.ttl_dns_cache,
+            enable_cleanup_closed=self.config.enable_cleanup_closed,
+        )
+        return aiohttp.ClientSession(connector=connector, trace_configs=[self._trace_config(metrics)])
+
+    @staticmethod
+    def _trace_config(metrics: ConnectionPoolMetrics) -> aiohttp.TraceConfig:
+        trace_config = aiohttp.TraceConfig()
+
+        async def on_request_start(session, trace_config_ctx, params):
+            metrics.requests_sent += 1
+
+        async def on_connection_create_end(session, trace_config_ctx, params):
+            metrics.connections_created += 1
+
+        async def on_connection_reuseconn(session, trace_config_ctx, params):
+            metrics.connections_reused += 1
+
+        async def on_dns_cache_hit(session, trace_config_ctx, params):
+            metrics.dns_cache_hits += 1
+
+        async def on_dns_cache_miss(session, trace_config_ctx, params):
+            metrics.dns_cache_misses += 1
+
+        trace_config.on_request_start.append(on_request_start)
+        trace_config.on_connection_create_end.append(on_connection_create_end)
+        trace_config.on_connection_reuseconn.append(on_connection_reuseconn)
+        trace_config.on_dns_cache_hit.append(on_dns_cache_hit)
+        trace_config.on_dns_cache_miss.append(on_dns_cache_miss)
+        return trace_config
+
+    def get_metrics(self) -> Dict[str, ConnectionPoolMetrics]:
+        return dict(self._metrics)
+
+    async def close(self) -> None:
+        sessions, self._sessions = self._sessions, {}
+        loop = asyncio.get_running_loop()
+        for session in sessions.values():
+            # sessions left behind by a finished event loop cannot be awaited from this one
+            if not session.closed and session._loop is loop:
+                await session.close()
+
+
+class JsonlSink:
+    """
+    Batched, background writer that persists results to a JSON Lines (.jsonl) file.
+
+    `write` only appends to an in-memory buffer; a background task encodes and flushes the
+    buffer in a worker thread once `batch_size` entries are pending or every `flush_interval`
+    seconds, so the file is opened once per batch instead of once per result.
+
+    Use it as an async context manager (or call `start` / `aclose`) so the remaining
+    entries are flushed on exit.
+    """
+
+    def __init__(self, filename: str, batch_size: int = 100, flush_interval: float = 1.0):
+        self.filename = filename
+        self.batch_size = batch_size
+        self.flush_interval = flush_interval
+        self._buffer: List[Any] = []
+        self._wakeup = asyncio.Event()
+        self._closed = False
+        self._task: Optional[asyncio.Task] = None
+
+    async def __aenter__(self) -> "JsonlSink":
+        self.start()
+        return self
+
+    async def __aexit__(self, *exc_info) -> None:
+        await self.aclose()
+
+    def start(self) -> None:
+        if self._task is None:
+            self._task = asyncio.create_task(self._run())
+
+    def write(self, data) -> None:
+        if self._closed:
+            raise RuntimeError(f"JsonlSink for {self.filename} is closed")
+        self._buffer.append(data)
+        if len(self._buffer) >= self.batch_size:
+            self._wakeup.set()
+
+    async def aclose(self) -> None:
+        self._closed = True
+        self._wakeup.set()
+        if self._task is not None:
+            await self._task
+        else:
+            await self._flush()
+
+    async def _run(self) -> None:
+        while not self._closed:
+            try:
+                await asyncio.wait_for(self._wakeup.wait(), timeout=self.flush_interval)
+            except asyncio.TimeoutError:
+                pass
+            self._wakeup.clear()
+            await self._flush()
+        await self._flush()
+
+    async def _flush(self) -> None:
+        if not self._buffer:
+            return
+        batch, self._buffer = self._buffer, []
+        await asyncio.to_thread(append_many_to_jsonl, batch, self.filename)
 
 
 # functions
 
 
+def request_header_from_url(request_url: str, api_key: str) -> dict:
+    """
+    Builds the request headers expected by the provider serving `request_url`.
+
+    OpenAI-compatible endpoints (OpenAI, vLLM, LiteLLM) use a bearer token, Azure deployments
+    use the `api-key` header and Anthropic (`anthropic.com` or any `/messages` endpoint) uses
+    `x-api-key` plus its versioning headers.
+    """
+    request_header = {"Authorization": f"Bearer {api_key}"}
+    # use api-key header for Azure deployments
+    if '/deployments' in request_url:
+        request_header = {"api-key": f"{api_key}"}
+    # Add Anthropic-specific headers
+    if 'anthropic.com' in request_url or request_url.rstrip("/").endswith("/messages"):
+        request_header = {
+            "x-api-key": api_key,
+            "anthropic-version": "2023-06-01",
+            "content-type": "application/json",
+            "anthropic-beta": "prompt-caching-2024-07-31"
+        }
+    return request_header
+
+
+def api_request_from_json(
+    task_id: int,
+    request_json: dict,
+    metadata: dict,
+    api_cfg: OAIApiConfig,
+    priority: int = 0,
+    flow: Optional[str] = None,
+) -> "APIRequest":
+    """
+    Wraps a provider request payload into an `APIRequest` ready to be put on the queue
+    consumed by `process_api_requests`, estimating its token consumption for rate limiting.
+    `priority` and `flow` (the agent) decide its turn when capacity is contended.
+    """
+    return APIRequest(
+        task_id=task_id,
+        request_json=request_json,
+        token_consumption=num_tokens_consumed_from_request(
+            request_json,
+            api_endpoint_from_url(api_cfg.request_url),
+            api_cfg.token_encoding_name,
+            approximate=api_cfg.token_estimation == "approximate",
+            chars_per_token=api_cfg.chars_per_token,
+        ),
+        attempts_left=api_cfg.max_attempts,
+        metadata=metadata,
+        priority=priority,
+        flow=flow,
+    )
+
+
+@functools.lru_cache(maxsize=256)
 def api_endpoint_from_url(request_url: str) -> str:
     """
     Extracts the API endpoint from a given request URL.
@@ -420,8 +945,8 @@ def api_endpoint_from_url(request_url: str) -> str:
         # for Azure OpenAI deployment urls
         match = re.search(r"^https://[^/]+/openai/deployments/[^/]+/(.+?)(\?|$)", request_url)
         if match is None:
-            # for vLLM endpoints
-            match = re.search(r"^http://localhost:8000/v\d+/(.+)$", request_url)
+            # for vLLM endpoints and other plain http servers (local replicas, mock servers)
+            match = re.search(r"^http://[^/]+/v\d+/(.+)$", request_url)
             if match is None:
                 raise ValueError(f"Invalid URL: {request_url}")
     return match[1]
@@ -447,14 +972,75 @@ def append_to_jsonl(data, filename: str) -> None:
         f.write(json_string + "\n")
 
 
+def append_many_to_jsonl(data: List[Any], filename: str) -> None:
+    """
+    Appends a batch of JSON payloads to a JSON Lines (.jsonl) file with a single open/write.
+
+    Parameters:
+    - data: A list of JSON-serializable Python objects, one per line.
+    - filename (str): The path to the .jsonl file to which the data will be appended.
+    """
+    lines = "".join(json.dumps(item) + "\n" for item in data)
+    with open(filename, "a") as f:
+        f.write(lines)
+
+
+@functools.lru_cache(maxsize=None)
+def get_token_encoding(token_encoding_name: str) -> tiktoken.Encoding:
+    """Returns the tiktoken encoding for `token_encoding_name`, loaded once per process."""
+    return tiktoken.get_encoding(token_encoding_name)
+
+
+@functools.lru_cache(maxsize=16384)
+def count_text_tokens(text: str, token_encoding_name: str) -> int:
+    """
+    Counts the tokens of `text` with the given encoding, memoized on the text content.
+
+    System prompts, persona blocks and shared history turns repeat across every agent of a round,
+    so after the first request most messages are answered from this cache instead of re-running
+    the tokenizer.
+    """
+    return len(get_token_encoding(token_encoding_name).encode(text))
+
+
+def approximate_text_tokens(text: str, chars_per_token: float = 4.0) -> int:
+    """Cheap token estimate from the character count, see `calibrate_chars_per_token`."""
+    return int(len(text) / chars_per_token) + 1
+
+
+def calibrate_chars_per_token(samples: List[str], token_encoding_name: str = "cl100k_base") -> float:
+    """
+    Measures the average number of characters per token of `samples` with the exact tokenizer,
+    to be used as `chars_per_token` by the approximate estimator for similar prompts.
+    """
+    num_chars = sum(len(sample) for sample in samples)
+    num_tokens = sum(count_text_tokens(sample, token_encoding_name) for sample in samples)
+    return num_chars / num_tokens if num_tokens else 4.0
+
+
 def num_tokens_consumed_from_request(
     request_json: dict,
     api_endpoint: str,
     token_encoding_name: str,
+    approximate: bool = False,
+    chars_per_token: float = 4.0,
 ):
-    """Count the number of tokens in the request. Supports completion, embedding, and Anthropic message requests."""
-    encoding = tiktoken.get_encoding(token_encoding_name)
-    
+    """
+    Count the number of tokens in the request. Supports completion, embedding, and Anthropic message requests.
+
+    Exact counts use a cached encoder and a per-text memo. With `approximate=True` the text is never
+    tokenized and `len(text) / chars_per_token` is used instead, which is enough for rate-limit
+    budgeting of large batches.
+    """
+    def count(value) -> int:
+        if value is None:
+            return 0
+        if not isinstance(value, str):
+            value = json.dumps(value)
+        if approximate:
+            return approximate_text_tokens(value, chars_per_token)
+        return count_text_tokens(value, token_encoding_name)
+
     if api_endpoint.endswith("completions"):
         max_tokens = request_json.get("max_tokens", 15)
         n = request_json.get("n", 1)
@@ -466,7 +1052,7 @@ def num_tokens_consumed_from_request(
             for message in request_json["messages"]:
                 num_tokens += 4  # every message follows <im_start>{role/name}\n{content}<im_end>\n
                 for key, value in message.items():
-                    num_tokens += len(encoding.encode(value))
+                    num_tokens += count(value)
                     if key == "name":  # if there's a name, the role is omitted
                         num_tokens -= 1  # role is always required and always 1 token
             num_tokens += 2  # every reply is primed with <im_start>assistant
@@ -475,11 +1061,11 @@ def num_tokens_consumed_from_request(
         else:
             prompt = request_json["prompt"]
             if isinstance(prompt, str):  # single prompt
-                prompt_tokens = len(encoding.encode(prompt))
+                prompt_tokens = count(prompt)
                 num_tokens = prompt_tokens + completion_tokens
                 return num_tokens
             elif isinstance(prompt, list):  # multiple prompts
-                prompt_tokens = sum([len(encoding.encode(p)) for p in prompt])
+                prompt_tokens = sum([count(p) for p in prompt])
                 num_tokens = prompt_tokens + completion_tokens * len(prompt)
                 return num_tokens
             else:
@@ -489,26 +1075,33 @@ def num_tokens_consumed_from_request(
     elif api_endpoint == "embeddings":
         input = request_json["input"]
         if isinstance(input, str):  # single input
-            num_tokens = len(encoding.encode(input))
+            num_tokens = count(input)
             return num_tokens
         elif isinstance(input, list):  # multiple inputs
-            num_tokens = sum([len(encoding.encode(i)) for i in input])
+            num_tokens = sum([count(i) for i in input])
             return num_tokens
         else:
             raise TypeError(
                 'Expecting either string or list of strings for "inputs" field in embedding request'
             )
     elif api_endpoint == "messages":  # Anthropic API
-        messages = request_json.get("messages", [])
         num_tokens = 0
+        system = request_json.get("system")
+        if isinstance(system, str):
+            num_tokens += count(system)
+        elif isinstance(system, list):
+            for item in system:
+                if isinstance(item, dict) and "text" in item:
+                    num_tokens += count(item["text"])
+        messages = request_json.get("messages", [])
         for message in messages:
             content = message.get("content", "")
             if isinstance(content, str):
-                num_tokens += len(encoding.encode(content))
+                num_tokens += count(content)
             elif isinstance(content, list):
                 for item in content:
                     if isinstance(item, dict) and "text" in item:
-                        num_tokens += len(encoding.encode(item["text"]))
+                        num_tokens += count(item["text"])
         
         max_tokens = request_json.get("max_tokens", 0)
         num_tokens += max_tokens  # Add the max_tokens to account for the response
@@ -520,6 +1113,18 @@ def num_tokens_consumed_from_request(
         )
 
 
+def num_tokens_used_from_response(response: dict) -> Optional[int]:
+    """Reads the tokens actually billed from the usage block of an OpenAI-style or Anthropic response, if present."""
+    usage = response.get("usage") if isinstance(response, dict) else None
+    if not isinstance(usage, dict):
+        return None
+    if "total_tokens" in usage:
+        return usage["total_tokens"]
+    if "input_tokens" in usage or "output_tokens" in usage:
+        return usage.get("input_tokens", 0) + usage.get("output_tokens", 0)
+    return None
+
+
 def task_id_generator_function():
     """
     Generates a sequence of integer task IDs, starting from 0 and incrementing by 1 each time.
@@ -549,6 +1154,7 @@ if __name__ == "__main__":
     parser.add_argument("--max_requests_per_minute", type=int, default=3_000 * 0.5)
     parser.add_argument("--max_tokens_per_minute", type=int, default=250_000 * 0.5)
     parser.add_argument("--token_encoding_name", default="cl100k_base")
+    parser.add_argument("--token_estimation", choices=["exact", "approximate"], default="exact")
     parser.add_argument("--max_attempts", type=int, default=5)
     parser.add_argument("--logging_level", default=logging.INFO)
     args = parser.parse_args()
@@ -565,6 +1171,7 @@ if __name__ == "__main__":
         max_requests_per_minute=float(args.max_requests_per_minute),
         max_tokens_per_minute=float(args.max_tokens_per_minute),
         token_encoding_name=args.token_encoding_name,
+        token_estimation=args.token_estimation,
         max_attempts=int(args.max_attempts),
         logging_level=int(args.logging_level),
     )
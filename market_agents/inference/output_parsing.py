@@ -0,0 +1,147 @@
+"""
+Fast path for turning raw provider responses into `LLMOutput` fields.
+
+`LLMOutput` used to rebuild the `ChatCompletion` / Anthropic `Message` pydantic objects for
+every result and run the lenient `parse_json_string` (json, then `ast.literal_eval`, then
+regexes) on every text answer. Parsing a round of a thousand agents is on the critical path of
+the simulation, so for raw dict results:
+
+- content, tool arguments and usage are read directly from the dict,
+- JSON is decoded with orjson when it is installed,
+- the decoded object is validated against the request's JSON schema (response_format or tool
+  parameters) with a `TypeAdapter` compiled once per schema,
+- only content that fails to decode or validate goes through `parse_json_string`.
+"""
+
+import json
+from functools import lru_cache
+from typing import Any, Dict, List, Literal, Optional, Tuple, Union
+
+from pydantic import ConfigDict, TypeAdapter, ValidationError
+from typing_extensions import NotRequired, TypedDict
+
+from market_agents.inference.utils import parse_json_string
+
+try:
+    import orjson
+except ImportError:  # optional speed-up, the standard library is used without it
+    orjson = None
+
+
+def json_loads(text: Union[str, bytes]) -> Any:
+    """ `json.loads` through orjson when available; raises `ValueError` (incl. `json.JSONDecodeError`) on invalid JSON. """
+    if orjson is not None:
+        return orjson.loads(text)
+    return json.loads(text)
+
+
+def _schema_key(schema: Dict[str, Any]) -> str:
+    if orjson is not None:
+        return orjson.dumps(schema, option=orjson.OPT_SORT_KEYS).decode()
+    return json.dumps(schema, sort_keys=True)
+
+
+def _schema_to_type(schema: Any, root: Dict[str, Any], name: str, depth: int = 0) -> Any:
+    if not isinstance(schema, dict) or depth > 32:
+        return Any
+    if "$ref" in schema:
+        ref = schema["$ref"]
+        if not ref.startswith("#/"):
+            return Any
+        target: Any = root
+        for part in ref[2:].split("/"):
+            target = target.get(part, {}) if isinstance(target, dict) else {}
+        return _schema_to_type(target, root, part, depth + 1)
+    if "enum" in schema:
+        return Literal[tuple(schema["enum"])] if schema["enum"] else Any
+    if "const" in schema:
+        return Literal[schema["const"]]
+    for combinator in ("anyOf", "oneOf"):
+        if combinator in schema:
+            options = tuple(_schema_to_type(option, root, name, depth + 1) for option in schema[combinator])
+            return Union[options] if options else Any
+    schema_type = schema.get("type")
+    if isinstance(schema_type, list):
+        options = tuple(_schema_to_type(dict(schema, type=option), root, name, depth + 1) for option in schema_type)
+        return Union[options] if options else Any
+    if schema_type == "object" or "properties" in schema:
+        properties = schema.get("properties")
+        if not properties:
+            additional = schema.get("additionalProperties")
+            return Dict[str, _schema_to_type(additional, root, name, depth + 1) if isinstance(additional, dict) else Any]
+        required = set(schema.get("required", []))
+        fields = {
+            key: _schema_to_type(value, root, key, depth + 1) if key in required else NotRequired[_schema_to_type(value, root, key, depth + 1)]
+            for key, value in properties.items()
+        }
+        typed_dict = TypedDict(str(schema.get("title", name)), fields)
+        # keys outside the schema are kept, as the lenient parser would keep them
+        typed_dict.__pydantic_config__ = ConfigDict(extra="allow")
+        return typed_dict
+    if schema_type == "array":
+        return List[_schema_to_type(schema.get("items"), root, name, depth + 1)]
+    # integers are valid numbers, the union keeps them as int instead of coercing to float
+    return {"string": str, "integer": int, "number": Union[int, float], "boolean": bool, "null": type(None)}.get(schema_type, Any)
+
+
+@lru_cache(maxsize=256)
+def _adapter_for_key(key: str) -> Optional[TypeAdapter]:
+    schema = json.loads(key)
+    try:
+        return TypeAdapter(_schema_to_type(schema, schema, "structured_output"))
+    except Exception:
+        # schemas using constructs we cannot express are simply not validated
+        return None
+
+
+def schema_adapter(schema: Optional[Dict[str, Any]]) -> Optional[TypeAdapter]:
+    """ The compiled validator of a JSON schema, built once per distinct schema. """
+    if not schema:
+        return None
+    return _adapter_for_key(_schema_key(schema))
+
+
+def parse_structured_content(content: str, schema: Optional[Dict[str, Any]] = None) -> Optional[Dict[str, Any]]:
+    """
+    Decodes a JSON object answer. Well-formed JSON matching `schema` (or any JSON object when no
+    schema is known) is returned directly; anything else goes through the lenient `parse_json_string`.
+    Text without a brace cannot hold an object and is rejected without parsing.
+    """
+    if "{" not in content:
+        return None
+    try:
+        parsed = json_loads(content)
+    except ValueError:
+        parsed = None
+    if isinstance(parsed, dict):
+        adapter = schema_adapter(schema)
+        if adapter is None:
+            return parsed
+        try:
+            return adapter.validate_python(parsed)
+        except ValidationError:
+            pass
+    parsed = parse_json_string(content)
+    return parsed if isinstance(parsed, dict) else None
+
+
+def response_format_schema(completion_kwargs: Optional[Dict[str, Any]]) -> Tuple[Optional[str], Optional[Dict[str, Any]]]:
+    """ Name and schema of an OpenAI-style json_schema response_format in the request, if any. """
+    response_format = (completion_kwargs or {}).get("response_format")
+    if not isinstance(response_format, dict):
+        return None, None
+    json_schema = response_format.get("json_schema")
+    if not isinstance(json_schema, dict):
+        return None, None
+    return json_schema.get("name"), json_schema.get("schema")
+
+
+def tool_schema(completion_kwargs: Optional[Dict[str, Any]], tool_name: str) -> Optional[Dict[str, Any]]:
+    """ Parameters schema of the named tool in an OpenAI or Anthropic request. """
+    for tool in (completion_kwargs or {}).get("tools") or []:
+        function = tool.get("function")
+        if isinstance(function, dict) and function.get("name") == tool_name:
+            return function.get("parameters")
+        if tool.get("name") == tool_name:
+            return tool.get("input_schema")
+    return None
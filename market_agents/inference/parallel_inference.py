@@ -1,16 +1,27 @@
 import asyncio
 import json
-from typing import List, Dict, Any, Optional, Literal
-from pydantic import BaseModel, Field, ValidationError
-from .message_models import LLMPromptContext, LLMOutput
-from .clients_models import AnthropicRequest, OpenAIRequest, VLLMRequest
-from .oai_parallel import process_api_requests_from_file, OAIApiFromFileConfig
+import logging
+import aiohttp
+from typing import List, Dict, Any, Optional, Literal, AsyncIterator, Tuple
+from pydantic import BaseModel, Field
+from .message_models import LLMPromptContext, LLMOutput, LLMStreamChunk, PRIORITY_LEVELS
+from .oai_parallel import process_api_requests, api_request_from_json, JsonlSink, OAIApiConfig, ClientSessionPool, ConnectionPoolConfig, ConnectionPoolMetrics, RetryPolicy, request_header_from_url, num_tokens_used_from_response, num_tokens_consumed_from_request, api_endpoint_from_url
+from .streaming import iter_sse_events, stream_assembler_for_client, StreamError
+from .batch_api import BatchJobConfig, OpenAIBatchClient, AnthropicBatchClient, run_batch_job
+from .rate_limiter import RateLimiter, RateLimitBackend, LocalRateLimitBackend, AdaptiveConcurrencyLimiter, LatencyWindow, rate_limit_key
+from .endpoint_pool import EndpointPool, EndpointPoolConfig
+from .response_cache import ResponseCache, request_hash
+from .replay import TraceRecorder, TraceReplayer
+from .telemetry import RequestSpan, TelemetryRegistry, TelemetryServer
+from .budget import BudgetManager, BudgetExceededError
+from .request_builder import RequestBuilder
+from .request_coalescing import InflightRequests
+from .prefix_sharing import order_by_shared_prefix, shared_prefix_lengths, summarize_prompt_cache, PromptCacheSummary
 import os
 from dotenv import load_dotenv
 import time
 from openai.types.chat import ChatCompletionToolParam
 from anthropic.types.beta.prompt_caching import PromptCachingBetaToolParam
-from anthropic.types.message_create_params import ToolChoiceToolChoiceTool
 
 import openai
 import anthropic
@@ -27,7 +38,24 @@ class ParallelAIUtilities:
                  vllm_request_limits: Optional[RequestLimits] = None,
                  litellm_request_limits: Optional[RequestLimits] = None,
                  local_cache: bool = True,
-                 cache_folder: Optional[str] = None):
+                 cache_folder: Optional[str] = None,
+                 connection_pool_config: Optional[ConnectionPoolConfig] = None,
+                 rate_limit_backend: Optional[RateLimitBackend] = None,
+                 response_cache: Optional[ResponseCache] = None,
+                 token_estimation: Literal["exact", "approximate"] = "exact",
+                 prefix_sharing: bool = True,
+                 coalesce_requests: bool = False,
+                 coalesce_nonzero_temperature: bool = False,
+                 adaptive_concurrency: bool = False,
+                 retry_policy: Optional[RetryPolicy] = None,
+                 vllm_endpoints: Optional[List[str]] = None,
+                 litellm_endpoints: Optional[List[str]] = None,
+                 endpoint_pool_config: Optional[EndpointPoolConfig] = None,
+                 inference_mode: Literal["live", "record", "replay"] = "live",
+                 trace_path: Optional[str] = None,
+                 replay_strict: bool = False,
+                 telemetry: Optional[TelemetryRegistry] = None,
+                 budget: Optional[BudgetManager] = None):
         load_dotenv()
         self.openai_key = os.getenv("OPENAI_KEY")
         self.anthropic_key = os.getenv("ANTHROPIC_API_KEY")
@@ -35,6 +63,10 @@ class ParallelAIUtilities:
         self.vllm_endpoint = os.getenv("VLLM_ENDPOINT", "http://localhost:8000/v1/chat/completions")
         self.litellm_endpoint = os.getenv("LITELLM_ENDPOINT", "http://localhost:8000/v1/chat/completions")
         self.litellm_key = os.getenv("LITELLM_API_KEY")
+        self.openai_base_url = os.getenv("OPENAI_BASE_URL", "https://api.openai.com/v1").rstrip("/")
+        self.anthropic_base_url = os.getenv("ANTHROPIC_BASE_URL", "https://api.anthropic.com").rstrip("/")
+        if not self.anthropic_base_url.endswith("/v1"):
+            self.anthropic_base_url += "/v1"
         self.oai_request_limits = oai_request_limits if oai_request_limits else RequestLimits(max_requests_per_minute=500,max_tokens_per_minute=200000,provider="openai")
         self.anthropic_request_limits = anthropic_request_limits if anthropic_request_limits else RequestLimits(max_requests_per_minute=50,max_tokens_per_minute=40000,provider="anthropic")
         self.vllm_request_limits = vllm_request_limits if vllm_request_limits else RequestLimits(max_requests_per_minute=500,max_tokens_per_minute=200000,provider="vllm")
@@ -42,6 +74,125 @@ class ParallelAIUtilities:
         self.local_cache = local_cache
         self.cache_folder = self._setup_cache_folder(cache_folder)
         self.all_requests = []
+        self.session_pool = ClientSessionPool(connection_pool_config)
+        self.rate_limit_backend = rate_limit_backend if rate_limit_backend is not None else LocalRateLimitBackend()
+        self._rate_limiters: Dict[str, RateLimiter] = {}
+        self.response_cache = response_cache
+        self.token_estimation = token_estimation
+        self.prefix_sharing = prefix_sharing
+        self.request_builder = RequestBuilder()
+        self.last_cache_summary: Optional[PromptCacheSummary] = None
+        self.inflight = InflightRequests(coalesce_nonzero_temperature) if coalesce_requests else None
+        self.adaptive_concurrency = adaptive_concurrency
+        self._concurrency_limiters: Dict[str, AdaptiveConcurrencyLimiter] = {}
+        self.retry_policy = retry_policy if retry_policy else RetryPolicy()
+        self._latency_windows: Dict[str, LatencyWindow] = {}
+        # several replicas of the same model, e.g. VLLM_ENDPOINTS=http://gpu1:8000/v1/chat/completions,http://gpu2:8000/v1/chat/completions
+        self.endpoint_urls: Dict[str, List[str]] = {
+            "vllm": vllm_endpoints if vllm_endpoints else self._endpoints_from_env("VLLM_ENDPOINTS"),
+            "litellm": litellm_endpoints if litellm_endpoints else self._endpoints_from_env("LITELLM_ENDPOINTS"),
+        }
+        self.endpoint_pool_config = endpoint_pool_config if endpoint_pool_config else EndpointPoolConfig()
+        self._endpoint_pools: Dict[str, EndpointPool] = {}
+        # record appends every response to the trace, replay answers from it without any network access
+        self.inference_mode = inference_mode
+        if inference_mode != "live" and not trace_path:
+            raise ValueError(f"inference_mode '{inference_mode}' needs a trace_path")
+        self.trace_recorder = TraceRecorder(trace_path) if inference_mode == "record" else None
+        self.trace_replayer = TraceReplayer(trace_path, strict=replay_strict) if inference_mode == "replay" else None
+        # a span per LLMOutput, aggregated into rolling percentiles per provider/model, see serve_telemetry
+        self.telemetry = telemetry if telemetry else TelemetryRegistry()
+        self.telemetry_server: Optional[TelemetryServer] = None
+        # hard caps on spend, shared with other instances to cap the whole simulation, see budget.py
+        self.budget = budget
+
+    async def __aenter__(self) -> "ParallelAIUtilities":
+        return self
+
+    async def __aexit__(self, *exc_info) -> None:
+        await self.close()
+
+    async def close(self):
+        """ Closes the pooled HTTP sessions, stops the endpoint health checks and the telemetry server and closes the trace, call once at the end of the simulation """
+        if self.trace_recorder is not None:
+            self.trace_recorder.close()
+        if self.telemetry_server is not None:
+            await self.telemetry_server.stop()
+            self.telemetry_server = None
+        for pool in self._endpoint_pools.values():
+            await pool.close()
+        await self.session_pool.close()
+
+    def get_connection_metrics(self) -> Dict[str, ConnectionPoolMetrics]:
+        return self.session_pool.get_metrics()
+
+    def get_telemetry(self) -> Dict[str, Dict[str, Dict[str, Any]]]:
+        """ Counters and rolling p50/p95/p99 of latency, queue wait, wire time and time to first byte per client and model. """
+        return self.telemetry.snapshot()
+
+    async def serve_telemetry(self, host: str = "localhost", port: int = 0) -> TelemetryServer:
+        """ Serves /metrics (Prometheus), /stats, /spans and /budget for the rest of the run, until close(). """
+        if self.telemetry_server is None:
+            self.telemetry_server = await TelemetryServer(self.telemetry, host, port, budget=self.budget).start()
+        return self.telemetry_server
+
+    def get_budget(self) -> Optional[Dict[str, Any]]:
+        """ Live spend and token totals per model and agent with the remaining budget, None without a budget. """
+        return self.budget.snapshot() if self.budget is not None else None
+
+    def get_rate_limiter(self, client: str, config: OAIApiConfig) -> RateLimiter:
+        """ One limiter per client shared by every batch, so RPM/TPM budgets carry over between rounds.
+        The budget is keyed by endpoint and API key in the rate_limit_backend, pass a FileRateLimitBackend
+        to share it with other processes on the host. """
+        limiter = self._rate_limiters.get(client)
+        if limiter is None:
+            limiter = RateLimiter(
+                max_requests_per_minute=config.max_requests_per_minute,
+                max_tokens_per_minute=config.max_tokens_per_minute,
+                backend=self.rate_limit_backend,
+                key=rate_limit_key(config.request_url, config.api_key),
+            )
+            self._rate_limiters[client] = limiter
+        return limiter
+
+    def get_concurrency_limiter(self, client: str) -> Optional[AdaptiveConcurrencyLimiter]:
+        """ One adaptive in-flight limit per client endpoint, kept across rounds so the learned limit carries over. """
+        if not self.adaptive_concurrency:
+            return None
+        limiter = self._concurrency_limiters.get(client)
+        if limiter is None:
+            limiter = AdaptiveConcurrencyLimiter()
+            self._concurrency_limiters[client] = limiter
+        return limiter
+
+    def get_concurrency_metrics(self) -> Dict[str, Dict[str, Any]]:
+        return {client: limiter.snapshot() for client, limiter in self._concurrency_limiters.items()}
+
+    @staticmethod
+    def _endpoints_from_env(name: str) -> List[str]:
+        return [url.strip() for url in os.getenv(name, "").split(",") if url.strip()]
+
+    def get_endpoint_pool(self, client: str, config: OAIApiConfig) -> Optional[EndpointPool]:
+        """ The load-balanced pool of replicas configured for the client, None for a single endpoint.
+        Every replica gets the client's RequestLimits as its own budget. """
+        urls = self.endpoint_urls.get(client)
+        if not urls:
+            return None
+        pool = self._endpoint_pools.get(client)
+        if pool is None:
+            pool = EndpointPool(
+                urls,
+                max_requests_per_minute=config.max_requests_per_minute,
+                max_tokens_per_minute=config.max_tokens_per_minute,
+                config=self.endpoint_pool_config.model_copy(update={"adaptive_concurrency": self.adaptive_concurrency}),
+                api_key=config.api_key,
+                backend=self.rate_limit_backend,
+            )
+            self._endpoint_pools[client] = pool
+        return pool
+
+    def get_endpoint_metrics(self) -> Dict[str, Dict[str, Dict[str, Any]]]:
+        return {client: pool.snapshot() for client, pool in self._endpoint_pools.items()}
 
     def _setup_cache_folder(self, cache_folder: Optional[str]) -> str:
         if cache_folder:
@@ -64,102 +215,297 @@ class ParallelAIUtilities:
         return list(prompt_hashmap.values())
 
     async def run_parallel_ai_completion(self, prompts: List[LLMPromptContext], update_history:bool=True) -> List[LLMOutput]:
-        openai_prompts = [p for p in prompts if p.llm_config.client == "openai"]
-        anthropic_prompts = [p for p in prompts if p.llm_config.client == "anthropic"]
-        vllm_prompts = [p for p in prompts if p.llm_config.client == "vllm"] 
-        litellm_prompts = [p for p in prompts if p.llm_config.client == "litellm"]
-        tasks = []
-        if openai_prompts:
-            tasks.append(self._run_openai_completion(openai_prompts))
-        if anthropic_prompts:
-            tasks.append(self._run_anthropic_completion(anthropic_prompts))
-        if vllm_prompts:
-            tasks.append(self._run_vllm_completion(vllm_prompts))
-        if litellm_prompts:
-            tasks.append(self._run_litellm_completion(litellm_prompts))
+        return [output async for output in self.run_parallel_ai_completion_as_completed(prompts, update_history)]
 
-        results = await asyncio.gather(*tasks)
-        flattened_results = [item for sublist in results for item in sublist]
-        
-        # Track  requests
-        self.all_requests.extend(flattened_results)
-        
-        if update_history:
-            prompts = self._update_prompt_history(prompts, flattened_results)
-        
-        return flattened_results
-    
-    def get_all_requests(self):
-        requests = self.all_requests
-        self.all_requests = []  
-        return requests
+    async def run_parallel_ai_completion_as_completed(self, prompts: List[LLMPromptContext], update_history: bool = True) -> AsyncIterator[LLMOutput]:
+        """ Like run_parallel_ai_completion, but yields each LLMOutput as soon as it lands, whichever provider it comes
+        from, so the caller can act on the first agents' answers (step the environment, send follow-up prompts) while
+        stragglers finish. The prompt's history is updated before its output is yielded.
+        Leaving the loop early cancels the requests still in flight. """
+        prompts_by_client: Dict[str, List[LLMPromptContext]] = {}
+        for prompt in prompts:
+            prompts_by_client.setdefault(prompt.llm_config.client, []).append(prompt)
+        prompt_hashmap = self._create_prompt_hashmap(prompts) if update_history else {}
+        streams = [self._stream_client_completion(client_prompts, client)
+                   for client, client_prompts in prompts_by_client.items() if client in ("openai", "anthropic", "vllm", "litellm")]
+        outputs = []
+        merged = self._merge_output_streams(streams)
+        try:
+            async for output in merged:
+                outputs.append(output)
+                # Track  requests
+                self.all_requests.append(output)
+                prompt = prompt_hashmap.get(output.source_id)
+                if prompt is not None and self._succeeded(output):
+                    prompt.add_chat_turn_history(output)
+                yield output
+        finally:
+            # on an early exit, cancels the requests in flight and releases their budget now rather than whenever the
+            # abandoned generators are collected
+            await merged.aclose()
 
-    async def _run_openai_completion(self, prompts: List[LLMPromptContext]) -> List[LLMOutput]:
-        timestamp = time.strftime("%Y-%m-%d_%H-%M-%S")
-        requests_file = os.path.join(self.cache_folder, f'openai_requests_{timestamp}.jsonl')
-        results_file = os.path.join(self.cache_folder, f'openai_results_{timestamp}.jsonl')
-        self._prepare_requests_file(prompts, "openai", requests_file)
-        config = self._create_oai_completion_config(prompts[0], requests_file, results_file)
-        if config:
-            try:
-                await process_api_requests_from_file(config)
-                return self._parse_results_file(results_file,client="openai")
-            finally:
-                if not self.local_cache:
-                    self._delete_files(requests_file, results_file)
-        return []
-
-    async def _run_anthropic_completion(self, prompts: List[LLMPromptContext]) -> List[LLMOutput]:
-        timestamp = time.strftime("%Y-%m-%d_%H-%M-%S")
-        requests_file = os.path.join(self.cache_folder, f'anthropic_requests_{timestamp}.jsonl')
-        results_file = os.path.join(self.cache_folder, f'anthropic_results_{timestamp}.jsonl')
-        self._prepare_requests_file(prompts, "anthropic", requests_file)
-        config = self._create_anthropic_completion_config(prompts[0], requests_file, results_file)
-        if config:
+        self.last_cache_summary = summarize_prompt_cache(outputs)
+        if self.last_cache_summary.requests:
+            logging.info(f"Prompt cache: {self.last_cache_summary}")
+
+    @staticmethod
+    def _succeeded(output: LLMOutput) -> bool:
+        """ Whether the output parses without error, failed turns are kept out of the chat history as in the streaming and batch paths. """
+        try:
+            return output.error is None
+        except Exception:
+            return False
+
+    @staticmethod
+    async def _merge_output_streams(streams: List[AsyncIterator[LLMOutput]]) -> AsyncIterator[LLMOutput]:
+        """ Interleaves the outputs of several streams in arrival order, re-raising the first error of any of them. """
+        if len(streams) == 1:
             try:
-                await process_api_requests_from_file(config)
-                return self._parse_results_file(results_file,client="anthropic")
+                async for output in streams[0]:
+                    yield output
             finally:
-                if not self.local_cache:
-                    self._delete_files(requests_file, results_file)
-        return []
-    
-    async def _run_vllm_completion(self, prompts: List[LLMPromptContext]) -> List[LLMOutput]:
-        timestamp = time.strftime("%Y-%m-%d_%H-%M-%S")
-        requests_file = os.path.join(self.cache_folder, f'vllm_requests_{timestamp}.jsonl')
-        results_file = os.path.join(self.cache_folder, f'vllm_results_{timestamp}.jsonl')
-        self._prepare_requests_file(prompts, "vllm", requests_file)
-        config = self._create_vllm_completion_config(prompts[0], requests_file, results_file)
-        if config:
+                await streams[0].aclose()
+            return
+        arrivals: asyncio.Queue = asyncio.Queue()
+        done = object()
+
+        async def pump(stream: AsyncIterator[LLMOutput]) -> None:
             try:
-                await process_api_requests_from_file(config)
-                return self._parse_results_file(results_file,client="vllm")
+                async for output in stream:
+                    arrivals.put_nowait(output)
             finally:
-                if not self.local_cache:
-                    self._delete_files(requests_file, results_file)
-        return []
-    
-    async def _run_litellm_completion(self, prompts: List[LLMPromptContext]) -> List[LLMOutput]:
-        timestamp = time.strftime("%Y-%m-%d_%H-%M-%S")
-        requests_file = os.path.join(self.cache_folder, f'litellm_requests_{timestamp}.jsonl')
-        results_file = os.path.join(self.cache_folder, f'litellm_results_{timestamp}.jsonl')
-        self._prepare_requests_file(prompts, "litellm", requests_file)
-        config = self._create_litellm_completion_config(prompts[0], requests_file, results_file)
-        if config:
+                arrivals.put_nowait(done)
+
+        pumps = [asyncio.create_task(pump(stream)) for stream in streams]
+        try:
+            remaining = len(pumps)
+            while remaining:
+                output = await arrivals.get()
+                if output is done:
+                    remaining -= 1
+                    continue
+                yield output
+            for task in pumps:
+                # surfaces the exception of a stream that failed
+                task.result()
+        finally:
+            for task in pumps:
+                task.cancel()
+            await asyncio.gather(*pumps, return_exceptions=True)
+
+    async def stream_ai_completion(self, prompt: LLMPromptContext, update_history: bool = True) -> AsyncIterator[LLMStreamChunk]:
+        """ Streams a single completion over server-sent events.
+        Yields a chunk per text (or tool argument) fragment as it arrives; the last chunk carries the assembled
+        LLMOutput, built from the same request and response shape as the non-streaming path, with time_to_first_token set.
+        Streaming requests go through the same rate limiter and session pool but are not retried. """
+        client = prompt.llm_config.client
+        config = self._create_completion_config(prompt, client)
+        request = self._convert_prompt_to_request(prompt, client) if config else None
+        if request is None:
+            return
+        if self.trace_replayer is not None:
+            start_time = time.time()
+            raw_result = self.trace_replayer.get(client, request, source_id=prompt.id)
+            output = self._safe_convert_result_to_llm_output(
+                [{"prompt_context_id": prompt.id, "start_time": start_time, "end_time": time.time(), "replayed": True}, request, raw_result],
+                client,
+            )
+            self.all_requests.append(output)
+            if update_history and "error" not in raw_result and output.source_id == prompt.id:
+                prompt.add_chat_turn_history(output)
+            yield LLMStreamChunk(source_id=prompt.id, delta=output.str_content or "")
+            yield LLMStreamChunk(source_id=prompt.id, output=output)
+            return
+        budget_metadata: Dict[str, Any] = {}
+        if self.budget is not None:
+            request, budget_error = self._apply_budget(prompt.id, client, config, request, budget_metadata)
+            if budget_error is not None:
+                output = self._budget_rejected_output(dict(budget_metadata, prompt_context_id=prompt.id), request, budget_error, client)
+                self.all_requests.append(output)
+                yield LLMStreamChunk(source_id=prompt.id, output=output)
+                return
+        try:
+            stream_request = dict(request, stream=True)
+            if client != "anthropic":
+                stream_request["stream_options"] = {"include_usage": True}
+            api_request = api_request_from_json(task_id=0, request_json=stream_request, metadata={}, api_cfg=config,
+                                                priority=PRIORITY_LEVELS[prompt.priority], flow=prompt.id)
+            endpoint_pool = self.get_endpoint_pool(client, config)
+            queued_at = time.monotonic()
+            if endpoint_pool is not None:
+                await endpoint_pool.ensure_health_checks(self.session_pool.get_session)
+                endpoint = await endpoint_pool.acquire(api_request.token_consumption, api_request.priority, api_request.flow)
+                request_url, rate_limiter, concurrency_limiter = endpoint.url, endpoint.rate_limiter, endpoint
+            else:
+                request_url = config.request_url
+                rate_limiter = self.get_rate_limiter(client, config)
+                concurrency_limiter = self.get_concurrency_limiter(client)
+                if concurrency_limiter is not None:
+                    await concurrency_limiter.acquire(api_request.priority, api_request.flow)
+                await rate_limiter.acquire(api_request.token_consumption, api_request.priority, api_request.flow)
+            queue_wait = time.monotonic() - queued_at
+
+            session = self.session_pool.get_session(request_url)
+            assembler = stream_assembler_for_client(client)
+            start_time = time.time()
+            time_to_first_token = None
+            status = None
             try:
-                await process_api_requests_from_file(config)
-                return self._parse_results_file(results_file,client="litellm")
+                async with session.post(url=request_url, headers=request_header_from_url(request_url, config.api_key), json=stream_request) as response:
+                    status = response.status
+                    rate_limiter.observe_response(response.status, response.headers)
+                    if response.status >= 400:
+                        # error bodies are not always JSON (proxy error pages) nor shaped {"error": ...} (vLLM)
+                        body = await response.text()
+                        try:
+                            body = json.loads(body)
+                        except ValueError:
+                            pass
+                        if isinstance(body, dict) and body.get("error") is not None:
+                            body = body["error"]
+                        raw_result = {"error": f"HTTP {response.status}: {body}"}
+                    else:
+                        async for event, data in iter_sse_events(response):
+                            delta = assembler.add(event, data)
+                            if delta:
+                                if time_to_first_token is None:
+                                    time_to_first_token = time.time() - start_time
+                                yield LLMStreamChunk(source_id=prompt.id, delta=delta)
+                        raw_result = assembler.build()
+                        tokens_used = num_tokens_used_from_response(raw_result)
+                        if tokens_used is not None:
+                            rate_limiter.refund(api_request.token_consumption - tokens_used)
+            except (aiohttp.ClientError, asyncio.TimeoutError, StreamError, ValueError) as e:
+                # ValueError covers malformed JSON in an SSE event
+                raw_result = {"error": f"{type(e).__name__}: {e}"}
             finally:
-                if not self.local_cache:
-                    self._delete_files(requests_file, results_file)
-        return []
+                if concurrency_limiter is not None:
+                    # the time to first token is what reflects backend queueing for a stream
+                    concurrency_limiter.release(time_to_first_token if time_to_first_token is not None else time.time() - start_time,
+                                                status=status, failed=status is None)
+            failed = status is None or status >= 400 or (isinstance(raw_result, dict) and "error" in raw_result)
+            if failed:
+                raw_result = {"error": str(raw_result["error"]) if isinstance(raw_result, dict) and "error" in raw_result else f"HTTP {status}"}
+                # streams are not retried, so the estimate taken for this one goes back to the budget
+                rate_limiter.refund(api_request.token_consumption)
 
-    
+            end_time = time.time()
+            # the reservation is settled out of this dict, so the finally below finds nothing left to release
+            metadata = budget_metadata
+            metadata.update({"prompt_context_id": prompt.id, "start_time": start_time, "end_time": end_time, "queue_wait": queue_wait,
+                             "wire_time": end_time - start_time, "time_to_first_byte": time_to_first_token, "attempts": 1, "endpoint": request_url})
+            output = self._safe_convert_result_to_llm_output([metadata, request, raw_result], client)
+            output.time_to_first_token = time_to_first_token
+            self.all_requests.append(output)
+            if update_history and not failed and output.source_id == prompt.id:
+                prompt.add_chat_turn_history(output)
+            yield LLMStreamChunk(source_id=prompt.id, output=output)
+        finally:
+            # closed early, cancelled or failed before the output was built
+            self._release_budget([budget_metadata])
+
+    async def run_batch_ai_completion(self, prompts: List[LLMPromptContext], update_history: bool = True, batch_config: Optional[BatchJobConfig] = None) -> List[LLMOutput]:
+        """ Runs the prompts through the providers' offline batch APIs (OpenAI Batch, Anthropic Message Batches),
+        which are billed at about half price and are not subject to the online rate limits, but may take up to the
+        completion window to finish. Results are mapped back to LLMOutputs by prompt_context_id.
+        Only openai and anthropic prompts are supported. """
+        unsupported = {p.llm_config.client for p in prompts} - {"openai", "anthropic"}
+        if unsupported:
+            raise ValueError(f"Batch mode is only available for openai and anthropic, got: {sorted(unsupported)}")
+        tasks = []
+        for client in ("openai", "anthropic"):
+            client_prompts = [p for p in prompts if p.llm_config.client == client]
+            if client_prompts:
+                tasks.append(self._run_client_batch(client_prompts, client, batch_config))
+        results = await asyncio.gather(*tasks)
+        flattened_results = [item for sublist in results for item in sublist]
+
+        self.all_requests.extend(flattened_results)
+
+        if update_history:
+            self._update_prompt_history(prompts, [output for output in flattened_results if "error" not in output.raw_result])
 
-    def _prepare_requests_file(self, prompts: List[LLMPromptContext], client: str, filename: str):
-        requests = []
+        return flattened_results
+
+    async def _run_client_batch(self, prompts: List[LLMPromptContext], client: Literal["openai", "anthropic"], batch_config: Optional[BatchJobConfig]) -> List[LLMOutput]:
+        config = self._create_completion_config(prompts[0], client)
+        if config is None:
+            return []
+        # prompts may share an id (an agent's prompts all carry the agent id), so each request gets its own
+        # custom_id in the batch and is mapped back to the prompt it came from
+        requests: Dict[str, Tuple[str, Dict[str, Any]]] = {}
         for prompt in prompts:
             request = self._convert_prompt_to_request(prompt, client)
+            if request:
+                requests[f"request-{len(requests)}"] = (prompt.id, request)
+        if self.trace_replayer is not None:
+            start_time = time.time()
+            metadata = {"start_time": start_time, "end_time": start_time, "replayed": True}
+            return [self._safe_convert_result_to_llm_output([dict(metadata, prompt_context_id=prompt_id), request, self.trace_replayer.get(client, request, source_id=prompt_id)], client)
+                    for prompt_id, request in requests.values()]
+        budget_metadata: Dict[str, Dict[str, Any]] = {}
+        rejected = []
+        if self.budget is not None:
+            for custom_id, (prompt_id, request) in list(requests.items()):
+                budget_metadata[custom_id] = {"prompt_context_id": prompt_id, "batch": True}
+                request, budget_error = self._apply_budget(prompt_id, client, config, request, budget_metadata[custom_id], batch=True)
+                if budget_error is not None:
+                    del requests[custom_id]
+                    rejected.append(self._budget_rejected_output(budget_metadata[custom_id], request, budget_error, client))
+                else:
+                    requests[custom_id] = (prompt_id, request)
+            if not requests:
+                return rejected
+        if client == "openai":
+            batch_client = OpenAIBatchClient(self.session_pool.get_session(self.openai_base_url), config.api_key, self.openai_base_url)
+        else:
+            batch_client = AnthropicBatchClient(self.session_pool.get_session(self.anthropic_base_url), config.api_key, self.anthropic_base_url)
+        start_time = time.time()
+        try:
+            responses = await run_batch_job(batch_client, [(custom_id, request) for custom_id, (_, request) in requests.items()], batch_config)
+        except BaseException:
+            self._release_budget(list(budget_metadata.values()))
+            raise
+        end_time = time.time()
+        outputs = rejected
+        for custom_id, (prompt_id, request) in requests.items():
+            response = responses.get(custom_id, {"error": "No result returned for this request by the batch job"})
+            metadata = {**budget_metadata.get(custom_id, {}), "prompt_context_id": prompt_id, "start_time": start_time, "end_time": end_time, "batch": True}
+            outputs.append(self._safe_convert_result_to_llm_output([metadata, request, response], client))
+        return outputs
+
+    def get_all_requests(self):
+        requests = self.all_requests
+        self.all_requests = []  
+        return requests
+
+    async def _stream_client_completion(self, prompts: List[LLMPromptContext], client: Literal["openai", "anthropic", "vllm", "litellm"]) -> AsyncIterator[LLMOutput]:
+        """ Runs the prompts through the in-memory request engine and yields each LLMOutput as soon as it lands.
+        Requests found in the response cache are answered first without touching the network; in replay mode every
+        request is answered from the recorded trace and nothing is sent.
+        With prefix_sharing the prompts are dispatched grouped by shared prefix so the provider prompt cache is warm
+        for the followers, and Anthropic cache breakpoints are placed at the end of each prompt's shared prefix.
+        With coalesce_requests identical requests in flight (in this batch or a concurrent one) are sent once and the
+        response is fanned out to every waiting prompt, see InflightRequests.
+        When local_cache is enabled the raw results are persisted in the background to a timestamped JSONL file. """
+        config = self._create_completion_config(prompts[0], client)
+        if config is None:
+            return
+        if self.prefix_sharing:
+            prompts = order_by_shared_prefix(prompts)
+            shared_lengths = shared_prefix_lengths(prompts)
+        else:
+            shared_lengths = [None] * len(prompts)
+        request_queue = asyncio.Queue()
+        cached_results = []
+        rejected_results = []
+        # followers of requests led by this batch, and of requests led by a concurrent one
+        own_waiters: Dict[str, List[List[Dict[str, Any]]]] = {}
+        external_waiters = []
+        # metadata of the admitted requests, whatever budget reservation is left in them on exit was never settled
+        reserved: List[Dict[str, Any]] = []
+        for task_id, (prompt, shared_length) in enumerate(zip(prompts, shared_lengths)):
+            request = self._convert_prompt_to_request(prompt, client, shared_prefix_length=shared_length)
             if request:
                 metadata = {
                     "prompt_context_id": prompt.id,
@@ -167,194 +513,306 @@ class ParallelAIUtilities:
                     "end_time": None,
                     "total_time": None
                 }
-                requests.append([metadata, request])
-        
-        with open(filename, 'w') as f:
-            for request in requests:
-                json.dump(request, f)
-                f.write('\n')
+                if self.trace_replayer is not None:
+                    replayed_response = self.trace_replayer.get(client, request, source_id=prompt.id)
+                    metadata["end_time"] = time.time()
+                    metadata["total_time"] = metadata["end_time"] - metadata["start_time"]
+                    metadata["replayed"] = True
+                    cached_results.append([metadata, request, replayed_response])
+                    continue
+                cached_response = self.response_cache.get(client, request) if self.response_cache is not None else None
+                if cached_response is not None:
+                    metadata["end_time"] = time.time()
+                    metadata["total_time"] = metadata["end_time"] - metadata["start_time"]
+                    metadata["cache_hit"] = True
+                    cached_results.append([metadata, request, cached_response])
+                    continue
+                if self.budget is not None:
+                    # admitted before coalescing so a downgraded request joins requests for the model it is sent to
+                    request, budget_error = self._apply_budget(prompt.id, client, config, request, metadata)
+                    if budget_error is not None:
+                        rejected_results.append((metadata, request, budget_error))
+                        continue
+                    reserved.append(metadata)
+                if self.inflight is not None and self.inflight.is_eligible(request):
+                    key, leader = self.inflight.join(client, request)
+                    if leader is not None:
+                        if key in own_waiters:
+                            own_waiters[key].append([metadata, request])
+                        else:
+                            external_waiters.append((leader, metadata, request))
+                        continue
+                    own_waiters[key] = []
+                    metadata["request_hash"] = key
+                request_queue.put_nowait(api_request_from_json(task_id=task_id, request_json=request, metadata=metadata, api_cfg=config,
+                                                               priority=PRIORITY_LEVELS[prompt.priority], flow=prompt.id))
+        request_queue.put_nowait(None)
 
-    def _validate_anthropic_request(self, request: Dict[str, Any]) -> bool:
+        sink = None
         try:
-            anthropic_request = AnthropicRequest(**request)
-            return True
-        except Exception as e:
-            raise ValidationError(f"Error validating Anthropic request: {e} with request: {request}")
-    
-    def _validate_openai_request(self, request: Dict[str, Any]) -> bool:
+            for result in cached_results:
+                yield self._safe_convert_result_to_llm_output(result, client)
+            for metadata, request, budget_error in rejected_results:
+                yield self._budget_rejected_output(metadata, request, budget_error, client)
+            if request_queue.qsize() == 1 and not external_waiters:
+                # everything was answered from the cache or the trace, no session or dispatcher needed
+                return
+
+            if self.local_cache and request_queue.qsize() > 1:
+                timestamp = time.strftime("%Y-%m-%d_%H-%M-%S")
+                sink = JsonlSink(os.path.join(self.cache_folder, f'{client}_results_{timestamp}.jsonl'))
+                sink.start()
+
+            async def dispatched() -> AsyncIterator[LLMOutput]:
+                endpoint_pool = self.get_endpoint_pool(client, config)
+                # with a pool every attempt picks the session of its replica, see process_api_requests
+                session = self.session_pool.get_session(endpoint_pool.urls[0] if endpoint_pool is not None else config.request_url)
+                if endpoint_pool is not None:
+                    await endpoint_pool.ensure_health_checks(self.session_pool.get_session)
+                    rate_limiter, concurrency_limiter = None, None
+                else:
+                    rate_limiter = self.get_rate_limiter(client, config)
+                    concurrency_limiter = self.get_concurrency_limiter(client)
+                latency_window = self._latency_windows.setdefault(client, LatencyWindow())
+                async for result in process_api_requests(config, request_queue, sink=sink, session=session, rate_limiter=rate_limiter,
+                                                         concurrency_limiter=concurrency_limiter, latency_window=latency_window,
+                                                         endpoint_pool=endpoint_pool, session_pool=self.session_pool):
+                    if self.response_cache is not None:
+                        self.response_cache.put(client, result[1], result[2])
+                    key = result[0].get("request_hash")
+                    followers = []
+                    if key is not None:
+                        self.inflight.resolve(key, result[2])
+                        followers = own_waiters.pop(key, [])
+                    yield self._safe_convert_result_to_llm_output(result, client)
+                    for metadata, request in followers:
+                        yield self._coalesced_output(metadata, request, result[2], client)
+
+            # followers of a concurrent batch's leaders are yielded as soon as their leader resolves, not after this batch
+            streams = []
+            if request_queue.qsize() > 1:
+                streams.append(dispatched())
+            if external_waiters:
+                streams.append(self._await_external_leaders(external_waiters, client))
+            merged = self._merge_output_streams(streams)
+            try:
+                async for output in merged:
+                    yield output
+            finally:
+                await merged.aclose()
+        finally:
+            if sink is not None:
+                await sink.aclose()
+            # leaders that never got a result (error or early exit) must not leave followers waiting forever
+            for key in own_waiters:
+                self.inflight.cancel(key)
+            self._release_budget(reserved)
+
+    async def _await_external_leaders(self, waiters: List[Tuple[asyncio.Future, Dict[str, Any], Dict[str, Any]]], client: str) -> AsyncIterator[LLMOutput]:
+        """ Yields the outputs of requests coalesced with a leader of a concurrent batch, in the order the leaders resolve. """
+        # shielded, leaving early must not cancel a leader other batches are waiting on
+        pending = {asyncio.shield(leader): (metadata, request) for leader, metadata, request in waiters}
         try:
-            openai_request = OpenAIRequest(**request)
-            return True
-        except Exception as e:
-            raise ValidationError(f"Error validating OpenAI request: {e} with request: {request}")
-        
-    def _validate_vllm_request(self, request: Dict[str, Any]) -> bool:
+            while pending:
+                done, _ = await asyncio.wait(pending, return_when=asyncio.FIRST_COMPLETED)
+                for arrival in done:
+                    metadata, request = pending.pop(arrival)
+                    if arrival.cancelled():
+                        response = {"error": "The identical in-flight request this one was coalesced with was cancelled"}
+                    else:
+                        response = arrival.result()
+                    yield self._coalesced_output(metadata, request, response, client)
+        finally:
+            for arrival in pending:
+                arrival.cancel()
+
+    def _coalesced_output(self, metadata: Dict[str, Any], request: Dict[str, Any], response: Any, client: str) -> LLMOutput:
+        metadata["end_time"] = time.time()
+        metadata["total_time"] = metadata["end_time"] - metadata["start_time"]
+        metadata["coalesced"] = True
+        return self._safe_convert_result_to_llm_output([metadata, request, response], client)
+
+    def _apply_budget(self, prompt_id: str, client: str, config: OAIApiConfig, request: Dict[str, Any], metadata: Dict[str, Any],
+                      batch: bool = False) -> Tuple[Dict[str, Any], Optional[Dict[str, Any]]]:
+        """ Reserves the worst-case cost of the request in the budget, keeping the reservation in its metadata for
+        _settle_budget. Returns the request to send, with its model replaced if the budget downgraded it, and the
+        error response to answer it with instead when the budget rejected it. """
+        total_tokens = num_tokens_consumed_from_request(request, api_endpoint_from_url(config.request_url), config.token_encoding_name,
+                                                        approximate=config.token_estimation == "approximate", chars_per_token=config.chars_per_token)
+        completion_tokens = request.get("max_tokens") or 0
         try:
-            vllm_request = VLLMRequest(**request)
-            return True
-        except Exception as e:
-            # Instead of raising ValidationError, we'll return False
-            raise ValidationError(f"Error validating VLLM request: {e} with request: {request}")
-        
+            reservation = self.budget.admit(prompt_id, request["model"], max(total_tokens - completion_tokens, 0), completion_tokens, batch=batch)
+        except BudgetExceededError as e:
+            return request, {"error": str(e)}
+        metadata["budget_reservation"] = reservation
+        if reservation.model != request["model"]:
+            if self.trace_recorder is not None:
+                # replay looks the request up as built, before the budget step
+                metadata["trace_key"] = request_hash(client, request)
+            # the request may be a shared template copy, never mutate it
+            request = dict(request, model=reservation.model)
+        return request, None
 
-    
-    def _get_openai_request(self, prompt: LLMPromptContext) -> Optional[Dict[str, Any]]:
-        messages = prompt.oai_messages
-        request = {
-            "model": prompt.llm_config.model,
-            "messages": messages,
-            "max_tokens": prompt.llm_config.max_tokens,
-            "temperature": prompt.llm_config.temperature,
-        }
-        if prompt.oai_response_format:
-            request["response_format"] = prompt.oai_response_format
-        if prompt.llm_config.response_format == "tool" and prompt.structured_output:
-            tool = prompt.get_tool()
-            if tool:
-                request["tools"] = [tool]
-                request["tool_choice"] = {"type": "function", "function": {"name": prompt.structured_output.schema_name}}
-        if self._validate_openai_request(request):
-            return request
-        else:
-            return None
-    
-    def _get_anthropic_request(self, prompt: LLMPromptContext) -> Optional[Dict[str, Any]]:
-        system_content, messages = prompt.anthropic_messages    
-        request = {
-            "model": prompt.llm_config.model,
-            "max_tokens": prompt.llm_config.max_tokens,
-            "temperature": prompt.llm_config.temperature,
-            "messages": messages,
-            "system": system_content if system_content else None
-        }
-        if prompt.llm_config.response_format == "tool" and prompt.structured_output:
-            tool = prompt.get_tool()
-            if tool:
-                request["tools"] = [tool]
-                request["tool_choice"] = ToolChoiceToolChoiceTool(name=prompt.structured_output.schema_name, type="tool")
-
-        if self._validate_anthropic_request(request):
-            return request
-        else:
-            return None
-        
-    def _get_vllm_request(self, prompt: LLMPromptContext) -> Optional[Dict[str, Any]]:
-        messages = prompt.vllm_messages  # Use vllm_messages instead of oai_messages
-        request = {
-            "model": prompt.llm_config.model,
-            "messages": messages,
-            "max_tokens": prompt.llm_config.max_tokens,
-            "temperature": prompt.llm_config.temperature,
-        }
-        if prompt.llm_config.response_format == "tool" and prompt.structured_output:
-            tool = prompt.get_tool()
-            if tool:
-                request["tools"] = [tool]
-                request["tool_choice"] = {"type": "function", "function": {"name": prompt.structured_output.schema_name}}
-        if prompt.llm_config.response_format == "json_object":
-            raise ValueError("VLLM does not support json_object response format otherwise infinite whitespaces are returned")
-        if prompt.oai_response_format and prompt.oai_response_format:
-            request["response_format"] = prompt.oai_response_format
-        
-        if self._validate_vllm_request(request):
-            return request
-        else:
-            return None
-        
-    def _get_litellm_request(self, prompt: LLMPromptContext) -> Optional[Dict[str, Any]]:
-        if prompt.llm_config.response_format == "json_object":
-            raise ValueError("VLLM does not support json_object response format otherwise infinite whitespaces are returned")
-        return self._get_openai_request(prompt)
-        
-    def _convert_prompt_to_request(self, prompt: LLMPromptContext, client: str) -> Optional[Dict[str, Any]]:
+    def _budget_rejected_output(self, metadata: Dict[str, Any], request: Dict[str, Any], budget_error: Dict[str, Any], client: str) -> LLMOutput:
+        now = time.time()
+        metadata.setdefault("start_time", now)
+        metadata["end_time"] = now
+        metadata["budget_rejected"] = True
+        return self._safe_convert_result_to_llm_output([metadata, request, budget_error], client)
+
+    def _convert_prompt_to_request(self, prompt: LLMPromptContext, client: str, shared_prefix_length: Optional[int] = None) -> Optional[Dict[str, Any]]:
+        return self.request_builder.build(prompt, client, shared_prefix_length)
+
+    def _create_completion_config(self, prompt: LLMPromptContext, client: str) -> Optional[OAIApiConfig]:
         if client == "openai":
-            return self._get_openai_request(prompt)
+            return self._create_oai_completion_config(prompt)
         elif client == "anthropic":
-            return self._get_anthropic_request(prompt)
+            return self._create_anthropic_completion_config(prompt)
         elif client == "vllm":
-            return self._get_vllm_request(prompt)
-        elif client =="litellm":
-            return self._get_litellm_request(prompt)
+            return self._create_vllm_completion_config(prompt)
+        elif client == "litellm":
+            return self._create_litellm_completion_config(prompt)
         else:
             raise ValueError(f"Invalid client: {client}")
 
-
-    def _create_oai_completion_config(self, prompt: LLMPromptContext, requests_file: str, results_file: str) -> Optional[OAIApiFromFileConfig]:
+    def _create_oai_completion_config(self, prompt: LLMPromptContext) -> Optional[OAIApiConfig]:
         if prompt.llm_config.client == "openai" and self.openai_key:
-            return OAIApiFromFileConfig(
-                requests_filepath=requests_file,
-                save_filepath=results_file,
-                request_url="https://api.openai.com/v1/chat/completions",
+            return OAIApiConfig(
+                request_url=f"{self.openai_base_url}/chat/completions",
                 api_key=self.openai_key,
                 max_requests_per_minute=self.oai_request_limits.max_requests_per_minute,
                 max_tokens_per_minute=self.oai_request_limits.max_tokens_per_minute,
                 token_encoding_name="cl100k_base",
+                token_estimation=self.token_estimation,
+                retry_policy=self.retry_policy,
                 max_attempts=5,
                 logging_level=20,
             )
         return None
 
-    def _create_anthropic_completion_config(self, prompt: LLMPromptContext, requests_file: str, results_file: str) -> Optional[OAIApiFromFileConfig]:
+    def _create_anthropic_completion_config(self, prompt: LLMPromptContext) -> Optional[OAIApiConfig]:
         if prompt.llm_config.client == "anthropic" and self.anthropic_key:
-            return OAIApiFromFileConfig(
-                requests_filepath=requests_file,
-                save_filepath=results_file,
-                request_url="https://api.anthropic.com/v1/messages",
+            return OAIApiConfig(
+                request_url=f"{self.anthropic_base_url}/messages",
                 api_key=self.anthropic_key,
                 max_requests_per_minute=self.anthropic_request_limits.max_requests_per_minute,
                 max_tokens_per_minute=self.anthropic_request_limits.max_tokens_per_minute,
                 token_encoding_name="cl100k_base",
+                token_estimation=self.token_estimation,
+                retry_policy=self.retry_policy,
                 max_attempts=5,
                 logging_level=20,
             )
         return None
     
-    def _create_vllm_completion_config(self, prompt: LLMPromptContext, requests_file: str, results_file: str) -> Optional[OAIApiFromFileConfig]:
+    def _create_vllm_completion_config(self, prompt: LLMPromptContext) -> Optional[OAIApiConfig]:
         if prompt.llm_config.client == "vllm":
-            return OAIApiFromFileConfig(
-                requests_filepath=requests_file,
-                save_filepath=results_file,
+            return OAIApiConfig(
                 request_url=self.vllm_endpoint,
                 api_key=self.vllm_key if self.vllm_key else "",
                 max_requests_per_minute=self.vllm_request_limits.max_requests_per_minute,
                 max_tokens_per_minute=self.vllm_request_limits.max_tokens_per_minute,
                 token_encoding_name="cl100k_base",
+                token_estimation=self.token_estimation,
+                retry_policy=self.retry_policy,
                 max_attempts=5,
                 logging_level=20,
             )
         return None
     
-    def _create_litellm_completion_config(self, prompt: LLMPromptContext, requests_file: str, results_file: str) -> Optional[OAIApiFromFileConfig]:
+    def _create_litellm_completion_config(self, prompt: LLMPromptContext) -> Optional[OAIApiConfig]:
         if prompt.llm_config.client == "litellm":
-            return OAIApiFromFileConfig(
-                requests_filepath=requests_file,
-                save_filepath=results_file,
+            return OAIApiConfig(
                 request_url=self.litellm_endpoint,
                 api_key=self.litellm_key if self.litellm_key else "",
                 max_requests_per_minute=self.litellm_request_limits.max_requests_per_minute,
                 max_tokens_per_minute=self.litellm_request_limits.max_tokens_per_minute,
                 token_encoding_name="cl100k_base",
+                token_estimation=self.token_estimation,
+                retry_policy=self.retry_policy,
                 max_attempts=5,
                 logging_level=20,
             )
         return None
     
 
-    def _parse_results_file(self, filepath: str,client: Literal["openai", "anthropic", "vllm", "litellm"]) -> List[LLMOutput]:
-        results = []
-        with open(filepath, 'r') as f:
-            for line in f:
-                try:
-                    result = json.loads(line)
-                    llm_output = self._convert_result_to_llm_output(result,client)
-                    results.append(llm_output)
-                except json.JSONDecodeError:
-                    print(f"Error decoding JSON: {line}")
-                    results.append(LLMOutput(raw_result={"error": "JSON decode error"}, completion_kwargs={}, start_time=time.time(), end_time=time.time(), source_id="error"))
-                except Exception as e:
-                    print(f"Error processing result: {e}")
-                    results.append(LLMOutput(raw_result={"error": str(e)}, completion_kwargs={}, start_time=time.time(), end_time=time.time(), source_id="error"))
-        return results
+    def _safe_convert_result_to_llm_output(self, result: List[Dict[str, Any]], client: Literal["openai", "anthropic", "vllm", "litellm"]) -> LLMOutput:
+        if self.trace_recorder is not None:
+            metadata = result[0]
+            self.trace_recorder.record(client, result[1], result[2], source_id=metadata.get("prompt_context_id"),
+                                       latency=(metadata.get("end_time") or time.time()) - metadata["start_time"], key=metadata.get("trace_key"))
+        try:
+            output = self._convert_result_to_llm_output(result, client)
+        except Exception as e:
+            print(f"Error processing result: {e}")
+            if self.budget is not None:
+                self._settle_budget(result[0], result[1], None, client)
+            return LLMOutput(raw_result={"error": str(e)}, completion_kwargs={}, start_time=time.time(), end_time=time.time(), source_id="error")
+        self._record_telemetry(result[0], result[1], output, client)
+        if self.budget is not None:
+            self._settle_budget(result[0], result[1], output, client)
+        return output
+
+    def _settle_budget(self, metadata: Dict[str, Any], request: Dict[str, Any], output: Optional[LLMOutput], client: str) -> None:
+        """ Releases the request's reservation and charges its usage, unless it failed or was answered without calling the provider.
+        A response that cannot be parsed is charged its reserved worst case, the provider billed it all the same. """
+        billed = output is not None and not (
+            metadata.get("replayed") or metadata.get("cache_hit") or metadata.get("coalesced") or metadata.get("budget_rejected"))
+        usage = None
+        if billed:
+            try:
+                billed = output.error is None
+                usage = output.usage
+            except Exception:
+                usage = None
+        self.budget.settle(metadata.pop("budget_reservation", None), metadata.get("prompt_context_id"), str(request.get("model")), usage,
+                           client=client, billed=billed, batch=bool(metadata.get("batch")))
+
+    def _release_budget(self, metadatas: List[Dict[str, Any]]) -> None:
+        """ Releases, unbilled, the reservations still held by requests that never got a response: in flight when the
+        caller stopped early, followers of a leader that failed, or the whole batch when the batch job raised. """
+        if self.budget is None:
+            return
+        for metadata in metadatas:
+            reservation = metadata.pop("budget_reservation", None)
+            if reservation is not None:
+                self.budget.settle(reservation, reservation.agent_id, reservation.model, None, billed=False)
+
+    def _record_telemetry(self, metadata: Dict[str, Any], request: Dict[str, Any], output: LLMOutput, client: str) -> None:
+        if metadata.get("budget_rejected"):
+            source = "budget"
+        elif metadata.get("replayed"):
+            source = "replay"
+        elif metadata.get("cache_hit"):
+            source = "cache"
+        elif metadata.get("coalesced"):
+            source = "coalesced"
+        elif metadata.get("batch"):
+            source = "batch"
+        else:
+            source = "network"
+        try:
+            usage, error = output.usage, output.error
+        except Exception as e:
+            # a response of an unexpected shape must not abort the batch it belongs to
+            usage, error = None, f"Unparseable response: {e}"
+        self.telemetry.record(RequestSpan(
+            source_id=output.source_id,
+            client=client,
+            model=str(request.get("model")),
+            endpoint=metadata.get("endpoint"),
+            start_time=output.start_time,
+            end_time=output.end_time,
+            queue_wait=metadata.get("queue_wait"),
+            wire_time=metadata.get("wire_time"),
+            time_to_first_byte=metadata.get("time_to_first_byte"),
+            prompt_tokens=usage.prompt_tokens if usage is not None else None,
+            completion_tokens=usage.completion_tokens if usage is not None else None,
+            attempts=metadata.get("attempts", 0),
+            hedged=metadata.get("hedged", False),
+            source=source,
+            error=error,
+        ))
 
     def _convert_result_to_llm_output(self, result: List[Dict[str, Any]],client: Literal["openai", "anthropic", "vllm", "litellm"]) -> LLMOutput:
         metadata, request_data, response_data = result
@@ -367,10 +825,3 @@ class ParallelAIUtilities:
             source_id=metadata["prompt_context_id"],
             client=client
         )
-
-    def _delete_files(self, *files):
-        for file in files:
-            try:
-                os.remove(file)
-            except OSError as e:
-                print(f"Error deleting file {file}: {e}")
\ No newline at end of file
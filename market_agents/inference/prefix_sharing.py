@@ -0,0 +1,140 @@
+"""
+Prompt-prefix sharing across a batch of `LLMPromptContext`s.
+
+Agents in the same round usually share a long prefix (system prompt template, tool schema,
+environment description) and differ only in their persona, history and latest observation.
+Provider prompt caches (Anthropic cache_control, OpenAI automatic caching, vLLM automatic
+prefix caching) can only reuse a prefix once it has been computed, so:
+
+- `order_by_shared_prefix` sorts the batch so that prompts with identical prefixes are
+  dispatched back to back and the first request warms the cache for the next ones,
+- `shared_prefix_lengths` finds, for every prompt, how many leading messages it shares with
+  another prompt of the batch,
+- `anthropic_cache_breakpoints` places the Anthropic cache breakpoints at the end of that shared
+  prefix and at the end of the prompt, instead of at fixed positions,
+- `summarize_prompt_cache` aggregates the cache-read and cache-write tokens reported in `Usage`
+  for a round.
+"""
+
+import json
+from dataclasses import dataclass
+from typing import Any, Dict, List, Optional, Sequence, Tuple
+
+from market_agents.inference.message_models import LLMOutput, LLMPromptContext
+
+
+def _message_fingerprint(message: Dict[str, Any]) -> int:
+    content = message.get("content")
+    if not isinstance(content, str):
+        content = json.dumps(content, sort_keys=True, default=str)
+    # str hashes are cached on the string object, so re-fingerprinting the same history each round is cheap
+    return hash((message.get("role"), content))
+
+
+def prefix_fingerprints(prompt: LLMPromptContext) -> Tuple[Any, ...]:
+    """
+    The sort key of a prompt: model and tool schema first, since a cached prefix is only reused by
+    requests to the same model with the same tools, then one fingerprint per message.
+    """
+    tool_fingerprint = 0
+    if prompt.structured_output is not None and prompt.llm_config.response_format == "tool":
+        tool_fingerprint = hash(json.dumps(prompt.structured_output.json_schema, sort_keys=True, default=str))
+    return (prompt.llm_config.model or "", tool_fingerprint) + tuple(_message_fingerprint(message) for message in prompt.messages)
+
+
+def order_by_shared_prefix(prompts: Sequence[LLMPromptContext]) -> List[LLMPromptContext]:
+    """ Stable lexicographic sort on the message fingerprints, which places prompts sharing a prefix next to each other. """
+    keyed = [(prefix_fingerprints(prompt), index, prompt) for index, prompt in enumerate(prompts)]
+    keyed.sort(key=lambda entry: (entry[0], entry[1]))
+    return [prompt for _, _, prompt in keyed]
+
+
+def _common_prefix_length(left: Tuple[Any, ...], right: Tuple[Any, ...]) -> int:
+    length = 0
+    for a, b in zip(left, right):
+        if a != b:
+            break
+        length += 1
+    return length
+
+
+def shared_prefix_lengths(ordered_prompts: Sequence[LLMPromptContext]) -> List[int]:
+    """
+    For prompts already sorted by `order_by_shared_prefix`, returns the number of leading messages
+    each prompt shares with at least one other prompt (0 if even the model or tools differ).
+    In sorted order the longest common prefix with any other prompt is the one with a neighbour.
+    """
+    fingerprints = [prefix_fingerprints(prompt) for prompt in ordered_prompts]
+    neighbour_prefixes = [0] * (len(fingerprints) + 1)
+    for i in range(1, len(fingerprints)):
+        neighbour_prefixes[i] = _common_prefix_length(fingerprints[i - 1], fingerprints[i])
+    # the first two entries of a fingerprint are model and tools, not messages
+    return [max(max(neighbour_prefixes[i], neighbour_prefixes[i + 1]) - 2, 0) for i in range(len(fingerprints))]
+
+
+def anthropic_cache_breakpoints(messages: List[Dict[str, Any]], shared_prefix_length: int, max_breakpoints: int = 2) -> List[int]:
+    """
+    Message indices to mark with cache_control, by priority: the last message, so this agent's next
+    turn reads its own history from the cache; the last message of the prefix shared with the rest of
+    the batch, so the other agents read it from the cache; and the third to last message, the end of
+    the previous turn. Anthropic allows four breakpoints per request and the system message and tool
+    definition take one each, hence `max_breakpoints`.
+    """
+    candidates = [len(messages) - 1, shared_prefix_length - 1, len(messages) - 3]
+    breakpoints: List[int] = []
+    for index in candidates:
+        if len(breakpoints) >= max_breakpoints:
+            break
+        if 0 <= index < len(messages) and messages[index]["role"] != "system" and index not in breakpoints:
+            breakpoints.append(index)
+    return sorted(breakpoints)
+
+
+@dataclass
+class PromptCacheSummary:
+    """
+    Prompt-cache usage of one round of completions, aggregated from `LLMOutput.usage`.
+
+    Attributes:
+    - requests: Completions with a usage report.
+    - prompt_tokens: Input tokens billed at the normal rate.
+    - cache_read_tokens: Input tokens served from the provider's prompt cache.
+    - cache_creation_tokens: Input tokens written to the prompt cache (Anthropic only).
+    """
+
+    requests: int = 0
+    prompt_tokens: int = 0
+    cache_read_tokens: int = 0
+    cache_creation_tokens: int = 0
+
+    @property
+    def cache_read_ratio(self) -> float:
+        total = self.prompt_tokens + self.cache_read_tokens + self.cache_creation_tokens
+        return self.cache_read_tokens / total if total else 0.0
+
+    def __str__(self) -> str:
+        return (f"{self.requests} requests, {self.prompt_tokens} uncached prompt tokens, {self.cache_read_tokens} cache read tokens, "
+                f"{self.cache_creation_tokens} cache write tokens ({self.cache_read_ratio:.1%} of the prompt read from cache)")
+
+
+def summarize_prompt_cache(outputs: Sequence[LLMOutput], client: Optional[str] = None) -> PromptCacheSummary:
+    """
+    Sums the usage of the outputs. Anthropic reports cached tokens separately from input_tokens while
+    OpenAI and vLLM include them in prompt_tokens, so the latter are subtracted to keep the fields disjoint.
+    """
+    summary = PromptCacheSummary()
+    for output in outputs:
+        if client is not None and output.client != client:
+            continue
+        try:
+            usage = output.usage
+        except Exception:
+            continue
+        if usage is None:
+            continue
+        cache_read = usage.cache_read_input_tokens or 0
+        summary.requests += 1
+        summary.cache_read_tokens += cache_read
+        summary.cache_creation_tokens += usage.cache_creation_input_tokens or 0
+        summary.prompt_tokens += usage.prompt_tokens if output.client == "anthropic" else usage.prompt_tokens - cache_read
+    return summary
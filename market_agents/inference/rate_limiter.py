@@ -0,0 +1,593 @@
+import asyncio
+import hashlib
+import heapq
+import json
+import logging
+import os
+import re
+import tempfile
+import time
+from abc import ABC, abstractmethod
+from collections import deque
+from datetime import datetime
+from email.utils import parsedate_to_datetime
+from typing import Any, Dict, Hashable, List, Mapping, Optional, Tuple
+
+from market_agents.inference.scheduling import FairLock, FairShare, OrderKey
+
+try:
+    import fcntl
+except ImportError:  # not available on Windows
+    fcntl = None
+
+
+class TokenBucket:
+    """
+    A token bucket that refills continuously at `capacity` units per minute.
+
+    Attributes:
+    - capacity (float): The maximum number of units the bucket can hold (the per-minute budget).
+    - level (float): The number of units currently available.
+    - last_update (float): The wall-clock timestamp of the last refill.
+    """
+
+    def __init__(self, capacity: float):
+        self.capacity = float(capacity)
+        self.level = float(capacity)
+        self.last_update = time.time()
+
+    @property
+    def refill_per_second(self) -> float:
+        return self.capacity / 60.0
+
+    def refill(self, now: Optional[float] = None) -> None:
+        now = time.time() if now is None else now
+        self.level = min(self.capacity, self.level + (now - self.last_update) * self.refill_per_second)
+        self.last_update = now
+
+    def seconds_until_available(self, amount: float, now: Optional[float] = None) -> float:
+        """ Seconds to wait until `amount` units are available. Requests larger than the whole
+        bucket only wait for a full bucket so they can never deadlock the scheduler. """
+        self.refill(now)
+        amount = min(amount, self.capacity)
+        if self.level >= amount:
+            return 0.0
+        if self.refill_per_second <= 0:
+            return float("inf")
+        return (amount - self.level) / self.refill_per_second
+
+    def consume(self, amount: float) -> None:
+        self.level -= amount
+
+    def refund(self, amount: float) -> None:
+        self.level = min(self.capacity, self.level + amount)
+
+
+def rate_limit_key(request_url: str, api_key: Optional[str]) -> str:
+    """ Stable identifier for a provider key, hashed so secrets never end up in shared state. """
+    return hashlib.sha256(f"{request_url}|{api_key or ''}".encode()).hexdigest()[:32]
+
+
+class RateLimitBackend(ABC):
+    """
+    Storage for the request and token buckets of each rate-limit key.
+
+    The backend decides how far the budget is shared: `LocalRateLimitBackend` keeps it inside
+    one process, `FileRateLimitBackend` coordinates every process on the host. Stores such as
+    Redis can be plugged in by implementing the three methods atomically (e.g. with a script
+    or a transaction), keeping timestamps in wall-clock seconds.
+    """
+
+    @abstractmethod
+    def try_acquire(self, key: str, max_requests_per_minute: float, max_tokens_per_minute: float, tokens: float) -> float:
+        """ Consumes one request and `tokens` tokens and returns 0, or returns the seconds to wait without consuming anything. """
+
+    @abstractmethod
+    def refund(self, key: str, max_tokens_per_minute: float, tokens: float) -> None:
+        """ Returns unused tokens to the key's token bucket. """
+
+    @abstractmethod
+    def pause(self, key: str, seconds: float) -> float:
+        """ Blocks acquisitions on the key for `seconds` and returns the wall-clock time the pause ends. """
+
+
+def _try_acquire_buckets(
+    request_bucket: TokenBucket,
+    token_bucket: TokenBucket,
+    paused_until: float,
+    tokens: float,
+    now: float,
+) -> float:
+    wait = max(
+        request_bucket.seconds_until_available(1, now),
+        token_bucket.seconds_until_available(tokens, now),
+        paused_until - now,
+        0.0,
+    )
+    if wait <= 0:
+        request_bucket.consume(1)
+        token_bucket.consume(tokens)
+    return wait
+
+
+class LocalRateLimitBackend(RateLimitBackend):
+    """ In-process buckets, the budget is only shared by limiters living in the same process. """
+
+    def __init__(self):
+        self._buckets: Dict[str, Tuple[TokenBucket, TokenBucket]] = {}
+        self._paused_until: Dict[str, float] = {}
+
+    def _get_buckets(self, key: str, max_requests_per_minute: float, max_tokens_per_minute: float) -> Tuple[TokenBucket, TokenBucket]:
+        buckets = self._buckets.get(key)
+        if buckets is None:
+            buckets = (TokenBucket(max_requests_per_minute), TokenBucket(max_tokens_per_minute))
+            self._buckets[key] = buckets
+        else:
+            # budgets can be raised or lowered at runtime from the provider's rate-limit headers
+            buckets[0].capacity = float(max_requests_per_minute)
+            buckets[1].capacity = float(max_tokens_per_minute)
+        return buckets
+
+    def try_acquire(self, key: str, max_requests_per_minute: float, max_tokens_per_minute: float, tokens: float) -> float:
+        request_bucket, token_bucket = self._get_buckets(key, max_requests_per_minute, max_tokens_per_minute)
+        now = time.time()
+        return _try_acquire_buckets(request_bucket, token_bucket, self._paused_until.get(key, 0.0), tokens, now)
+
+    def refund(self, key: str, max_tokens_per_minute: float, tokens: float) -> None:
+        buckets = self._buckets.get(key)
+        if buckets is not None:
+            token_bucket = buckets[1]
+            token_bucket.refill(time.time())
+            token_bucket.refund(tokens)
+
+    def pause(self, key: str, seconds: float) -> float:
+        paused_until = max(self._paused_until.get(key, 0.0), time.time() + seconds)
+        self._paused_until[key] = paused_until
+        return paused_until
+
+
+class FileRateLimitBackend(RateLimitBackend):
+    """
+    Host-wide buckets stored in one small JSON state file per key and updated under an
+    exclusive `fcntl` lock, so several orchestrator processes using the same API key share a
+    single RPM/TPM budget and a rate-limit cool-down hit by one process pauses all of them.
+
+    Parameters:
+    - directory: Where state files are kept, defaults to `<tmp>/market_agents_rate_limits`.
+    """
+
+    def __init__(self, directory: Optional[str] = None):
+        if fcntl is None:
+            raise RuntimeError("FileRateLimitBackend requires fcntl, which is not available on this platform")
+        self.directory = directory if directory else os.path.join(tempfile.gettempdir(), "market_agents_rate_limits")
+        os.makedirs(self.directory, exist_ok=True)
+
+    def _state_path(self, key: str) -> str:
+        return os.path.join(self.directory, f"{key}.json")
+
+    def _update(self, key: str, update) -> float:
+        with open(self._state_path(key), "a+") as f:
+            fcntl.flock(f, fcntl.LOCK_EX)
+            try:
+                f.seek(0)
+                raw = f.read()
+                state = json.loads(raw) if raw else {}
+                result = update(state, time.time())
+                f.seek(0)
+                f.truncate()
+                f.write(json.dumps(state))
+                f.flush()
+            finally:
+                fcntl.flock(f, fcntl.LOCK_UN)
+        return result
+
+    @staticmethod
+    def _load_bucket(state: dict, name: str, capacity: float, now: float) -> TokenBucket:
+        bucket = TokenBucket(capacity)
+        if name in state:
+            bucket.level = min(state[name]["level"], bucket.capacity)
+            bucket.last_update = state[name]["last_update"]
+        else:
+            bucket.last_update = now
+        return bucket
+
+    @staticmethod
+    def _store_bucket(state: dict, name: str, bucket: TokenBucket) -> None:
+        state[name] = {"level": bucket.level, "last_update": bucket.last_update}
+
+    def try_acquire(self, key: str, max_requests_per_minute: float, max_tokens_per_minute: float, tokens: float) -> float:
+        def update(state: dict, now: float) -> float:
+            request_bucket = self._load_bucket(state, "requests", max_requests_per_minute, now)
+            token_bucket = self._load_bucket(state, "tokens", max_tokens_per_minute, now)
+            wait = _try_acquire_buckets(request_bucket, token_bucket, state.get("paused_until", 0.0), tokens, now)
+            self._store_bucket(state, "requests", request_bucket)
+            self._store_bucket(state, "tokens", token_bucket)
+            return wait
+        return self._update(key, update)
+
+    def refund(self, key: str, max_tokens_per_minute: float, tokens: float) -> None:
+        def update(state: dict, now: float) -> float:
+            token_bucket = self._load_bucket(state, "tokens", max_tokens_per_minute, now)
+            token_bucket.refill(now)
+            token_bucket.refund(tokens)
+            self._store_bucket(state, "tokens", token_bucket)
+            return 0.0
+        self._update(key, update)
+
+    def pause(self, key: str, seconds: float) -> float:
+        def update(state: dict, now: float) -> float:
+            state["paused_until"] = max(state.get("paused_until", 0.0), now + seconds)
+            return state["paused_until"]
+        return self._update(key, update)
+
+
+_DURATION_PART = re.compile(r"(\d+(?:\.\d+)?)(ms|h|m|s)")
+
+
+def parse_reset_seconds(value: Optional[str], now: Optional[float] = None) -> Optional[float]:
+    """
+    Seconds until a rate-limit window resets, from either an OpenAI style duration
+    (`"1s"`, `"6m0s"`, `"20ms"`) or an Anthropic style RFC 3339 timestamp.
+    """
+    if not value:
+        return None
+    value = value.strip()
+    parts = _DURATION_PART.findall(value)
+    if parts and "".join(number + unit for number, unit in parts) == value:
+        scale = {"ms": 0.001, "s": 1.0, "m": 60.0, "h": 3600.0}
+        return sum(float(number) * scale[unit] for number, unit in parts)
+    try:
+        reset_at = datetime.fromisoformat(value.replace("Z", "+00:00")).timestamp()
+    except ValueError:
+        return None
+    return max(reset_at - (time.time() if now is None else now), 0.0)
+
+
+def parse_retry_after(headers: Optional[Mapping[str, str]], now: Optional[float] = None) -> Optional[float]:
+    """ Seconds the server asked us to wait, from `retry-after-ms` or `retry-after` (seconds or an HTTP date). """
+    if not headers:
+        return None
+    retry_after_ms = headers.get("retry-after-ms")
+    if retry_after_ms:
+        try:
+            return float(retry_after_ms) / 1000.0
+        except ValueError:
+            pass
+    retry_after = headers.get("retry-after")
+    if not retry_after:
+        return None
+    try:
+        return max(float(retry_after), 0.0)
+    except ValueError:
+        pass
+    try:
+        return max(parsedate_to_datetime(retry_after).timestamp() - (time.time() if now is None else now), 0.0)
+    except (TypeError, ValueError):
+        return None
+
+
+def _header_number(headers: Mapping[str, str], *names: str) -> Optional[float]:
+    for name in names:
+        value = headers.get(name)
+        if value is not None:
+            try:
+                return float(value)
+            except ValueError:
+                return None
+    return None
+
+
+class RateLimiter:
+    """
+    Async scheduler enforcing a requests-per-minute and a tokens-per-minute budget.
+
+    `acquire` suspends the caller exactly until both buckets can cover the request instead of
+    polling, and wakes early whenever capacity is handed back (`refund`) or the cool-down
+    changes. Waiters are served by priority lane and, within a lane, fairly across agents (see
+    `FairLock`), so action prompts overtake queued reflections and one chatty agent cannot take
+    the whole token budget. One limiter is meant to be shared by every
+    request going to the same provider key, whichever provider it is.
+
+    The buckets themselves live in a `RateLimitBackend` under `key`; pass a shared backend such
+    as `FileRateLimitBackend` to co-ordinate one budget across processes.
+
+    `observe_response` feeds the provider's answer back into the limiter: a 429 pauses for the
+    server's `retry-after` when given, otherwise for an exponentially growing cool-down capped at
+    `seconds_to_pause_after_rate_limit_error`; an exhausted `x-ratelimit-remaining-*` /
+    `anthropic-ratelimit-*-remaining` window pauses until its reset; and with
+    `adopt_provider_limits` the advertised per-minute limits replace the configured budgets.
+
+    Parameters:
+    - max_requests_per_minute: The requests-per-minute budget.
+    - max_tokens_per_minute: The tokens-per-minute budget.
+    - seconds_to_pause_after_rate_limit_error: Longest cool-down applied by `register_rate_limit_error`
+      when the server gives no retry-after.
+    - backend: Where bucket state is kept, defaults to a private `LocalRateLimitBackend`.
+    - key: The budget identifier within the backend, see `rate_limit_key`.
+    - initial_cooldown: First cool-down of a series of rate limit errors without retry-after, doubled per error.
+    - adopt_provider_limits: Follow the per-minute limits advertised in the response headers.
+    """
+
+    def __init__(
+        self,
+        max_requests_per_minute: float,
+        max_tokens_per_minute: float,
+        seconds_to_pause_after_rate_limit_error: float = 15,
+        backend: Optional[RateLimitBackend] = None,
+        key: str = "default",
+        initial_cooldown: float = 1.0,
+        adopt_provider_limits: bool = False,
+    ):
+        self.max_requests_per_minute = max_requests_per_minute
+        self.max_tokens_per_minute = max_tokens_per_minute
+        self.seconds_to_pause_after_rate_limit_error = seconds_to_pause_after_rate_limit_error
+        self.backend = backend if backend is not None else LocalRateLimitBackend()
+        self.key = key
+        self.initial_cooldown = initial_cooldown
+        self.adopt_provider_limits = adopt_provider_limits
+        self._consecutive_rate_limit_errors = 0
+        self._paused_until = 0.0
+        self._loop: Optional[asyncio.AbstractEventLoop] = None
+        self._lock = FairLock()
+        self._wakeup = asyncio.Event()
+
+    def _bind_running_loop(self) -> None:
+        # asyncio primitives are tied to one loop; a limiter reused across asyncio.run calls
+        # keeps its bucket levels but gets fresh primitives
+        loop = asyncio.get_running_loop()
+        if self._loop is not loop:
+            self._loop = loop
+            self._lock = FairLock()
+            self._wakeup = asyncio.Event()
+
+    async def acquire(self, tokens: float, priority: int = 0, flow: Optional[Hashable] = None) -> None:
+        """ Waits until one request and `tokens` tokens are available, then consumes them.
+        Waiters of a lower `priority` value go first, and waiters of the same priority are interleaved by `flow` (agent). """
+        self._bind_running_loop()
+        async with self._lock.hold(priority, flow, tokens):
+            while True:
+                self._wakeup.clear()
+                wait = self.backend.try_acquire(self.key, self.max_requests_per_minute, self.max_tokens_per_minute, tokens)
+                if wait <= 0:
+                    return
+                try:
+                    await asyncio.wait_for(self._wakeup.wait(), timeout=wait)
+                except asyncio.TimeoutError:
+                    pass
+
+    def try_acquire(self, tokens: float) -> float:
+        """ Non-blocking acquire: consumes and returns 0 if one request and `tokens` tokens are available now,
+        otherwise returns the seconds to wait. Used to pick among several limiters without queueing on one. """
+        return self.backend.try_acquire(self.key, self.max_requests_per_minute, self.max_tokens_per_minute, tokens)
+
+    def refund(self, tokens: float) -> None:
+        """ Hands back over-estimated tokens (e.g. unused max_tokens) and wakes the waiter. """
+        if tokens > 0:
+            self.backend.refund(self.key, self.max_tokens_per_minute, tokens)
+            self._wakeup.set()
+
+    def pause_for(self, seconds: float) -> None:
+        paused_until = self.backend.pause(self.key, seconds)
+        if paused_until > self._paused_until:
+            logging.warning(f"Pausing to cool down until {time.ctime(paused_until)}")
+        self._paused_until = paused_until
+        self._wakeup.set()
+
+    def register_rate_limit_error(self, retry_after: Optional[float] = None) -> None:
+        """ Pauses for `retry_after` if the server gave one, otherwise for a cool-down that doubles with every
+        rate limit error received after the previous cool-down ended (errors from one burst count once). """
+        if retry_after is not None:
+            self.pause_for(retry_after)
+            return
+        if time.time() >= self._paused_until:
+            self._consecutive_rate_limit_errors += 1
+        cooldown = self.initial_cooldown * 2 ** (self._consecutive_rate_limit_errors - 1)
+        self.pause_for(min(cooldown, self.seconds_to_pause_after_rate_limit_error))
+
+    def observe_response(self, status: Optional[int], headers: Optional[Mapping[str, str]]) -> None:
+        """ Updates the cool-down and budgets from a response's status code and rate-limit headers. """
+        retry_after = parse_retry_after(headers)
+        if status == 429:
+            self.register_rate_limit_error(retry_after)
+        elif retry_after is not None and status is not None and status >= 500:
+            self.pause_for(retry_after)
+        elif status is not None and status < 400:
+            self._consecutive_rate_limit_errors = 0
+        if not headers:
+            return
+        for kind in ("requests", "tokens"):
+            remaining = _header_number(headers, f"x-ratelimit-remaining-{kind}", f"anthropic-ratelimit-{kind}-remaining")
+            if remaining is not None and remaining <= 0:
+                reset = parse_reset_seconds(headers.get(f"x-ratelimit-reset-{kind}") or headers.get(f"anthropic-ratelimit-{kind}-reset"))
+                if reset:
+                    self.pause_for(reset)
+        if self.adopt_provider_limits:
+            request_limit = _header_number(headers, "x-ratelimit-limit-requests", "anthropic-ratelimit-requests-limit")
+            token_limit = _header_number(headers, "x-ratelimit-limit-tokens", "anthropic-ratelimit-tokens-limit")
+            if request_limit:
+                self.max_requests_per_minute = request_limit
+            if token_limit:
+                self.max_tokens_per_minute = token_limit
+
+
+class LatencyWindow:
+    """ The last `size` latencies of an endpoint with percentile lookups, sorted lazily after new samples. """
+
+    def __init__(self, size: int = 200):
+        self._samples: deque = deque(maxlen=size)
+        self._sorted: Optional[list] = None
+
+    def add(self, latency: float) -> None:
+        self._samples.append(latency)
+        self._sorted = None
+
+    def percentile(self, quantile: float) -> Optional[float]:
+        if not self._samples:
+            return None
+        if self._sorted is None:
+            self._sorted = sorted(self._samples)
+        return self._sorted[min(int(len(self._sorted) * quantile), len(self._sorted) - 1)]
+
+    def __len__(self) -> int:
+        return len(self._samples)
+
+
+class AdaptiveConcurrencyLimiter:
+    """
+    Bounds the number of requests in flight to one endpoint and adapts the bound (AIMD):
+
+    - every success while the windowed p95 latency stays within `latency_tolerance` times the
+      baseline p50 grows the limit by about one per round trip (additive increase),
+    - a 429, a 5xx or a transport error shrinks it by `backoff_ratio`, and a p95 latency above
+      the tolerance (the backend is queueing) by `latency_backoff_ratio`, at most once per p50
+      latency so one congestion event is only counted once (multiplicative decrease).
+
+    The baseline is the lowest p50 seen, drifting slowly upwards so it can follow a genuine
+    change of workload (e.g. longer completions). This complements the RPM/TPM `RateLimiter`:
+    the budgets bound what the provider allows, the concurrency limit what the backend can
+    currently serve without queueing, which matters most for self-hosted vLLM.
+
+    Freed slots go to the waiter of the highest priority lane, fairly across agents within it,
+    see `FairShare`.
+
+    Parameters:
+    - initial_limit: Starting number of requests allowed in flight.
+    - min_limit: The limit never drops below this.
+    - max_limit: The limit never grows above this.
+    - latency_window: Number of recent latencies used for the percentiles.
+    - latency_tolerance: Allowed ratio between the p95 latency and the baseline p50 latency.
+    - backoff_ratio: Multiplier applied on 429/5xx/transport errors.
+    - latency_backoff_ratio: Multiplier applied when latency exceeds the tolerance.
+    - baseline_drift: Relative upward drift of the baseline per adjustment.
+    """
+
+    def __init__(
+        self,
+        initial_limit: float = 32,
+        min_limit: float = 1,
+        max_limit: float = 1024,
+        latency_window: int = 100,
+        latency_tolerance: float = 2.0,
+        backoff_ratio: float = 0.5,
+        latency_backoff_ratio: float = 0.9,
+        baseline_drift: float = 0.01,
+    ):
+        self.limit = float(initial_limit)
+        self.min_limit = float(min_limit)
+        self.max_limit = float(max_limit)
+        self.latency_tolerance = latency_tolerance
+        self.backoff_ratio = backoff_ratio
+        self.latency_backoff_ratio = latency_backoff_ratio
+        self.baseline_drift = baseline_drift
+        self.in_flight = 0
+        self.num_errors = 0
+        self.baseline_latency: Optional[float] = None
+        self._latencies: deque = deque(maxlen=latency_window)
+        self._percentiles: Tuple[Optional[float], Optional[float]] = (None, None)
+        self._samples_since_percentiles = 0
+        self._last_decrease = 0.0
+        self._loop: Optional[asyncio.AbstractEventLoop] = None
+        self._share = FairShare()
+        self._waiters: List[Tuple[OrderKey, asyncio.Future]] = []
+
+    def _bind_running_loop(self) -> None:
+        loop = asyncio.get_running_loop()
+        if self._loop is not loop:
+            self._loop = loop
+            self._waiters = []
+
+    async def acquire(self, priority: int = 0, flow: Optional[Hashable] = None) -> None:
+        """ Waits until fewer requests than the current limit are in flight and takes a slot. """
+        self._bind_running_loop()
+        key = self._share.order_key(priority, flow)
+        if self.has_capacity() and not self._waiters:
+            self.in_flight += 1
+            self._share.served(key)
+            return
+        waiter = self._loop.create_future()
+        heapq.heappush(self._waiters, (key, waiter))
+        self._grant()
+        try:
+            await waiter
+        except asyncio.CancelledError:
+            if waiter.done() and not waiter.cancelled():
+                # the slot was granted just as we were cancelled, hand it on
+                self.in_flight -= 1
+                self._grant()
+            raise
+        self._share.served(key)
+
+    def _grant(self) -> None:
+        # slots are taken on behalf of the waiters so no newcomer can overtake them
+        while self._waiters and self.has_capacity():
+            _, waiter = heapq.heappop(self._waiters)
+            if not waiter.done():
+                self.in_flight += 1
+                waiter.set_result(None)
+
+    def has_capacity(self) -> bool:
+        return self.in_flight < max(int(self.limit), 1)
+
+    def try_acquire(self) -> bool:
+        """ Takes a slot without waiting if one is free and nobody is waiting for it. """
+        if not self.has_capacity() or self._waiters:
+            return False
+        self.in_flight += 1
+        return True
+
+    def release(self, latency: Optional[float], status: Optional[int] = None, failed: bool = False) -> None:
+        """ Frees the slot taken by `acquire` and adjusts the limit from the request's outcome. """
+        self.in_flight = max(self.in_flight - 1, 0)
+        now = time.time()
+        if failed or status == 429 or (status is not None and status >= 500):
+            self.num_errors += 1
+            self._decrease(self.backoff_ratio, now)
+        elif latency is not None:
+            self._record_latency(latency)
+            p50, p95 = self._percentiles
+            if p50 is not None and self.baseline_latency is not None and p95 > self.latency_tolerance * self.baseline_latency:
+                self._decrease(self.latency_backoff_ratio, now)
+            else:
+                self.limit = min(self.max_limit, self.limit + 1.0 / max(self.limit, 1.0))
+        self._grant()
+
+    def _decrease(self, ratio: float, now: float) -> None:
+        p50 = self._percentiles[0] or 0.0
+        if now - self._last_decrease >= p50:
+            self.limit = max(self.min_limit, self.limit * ratio)
+            self._last_decrease = now
+
+    def _record_latency(self, latency: float) -> None:
+        self._latencies.append(latency)
+        self._samples_since_percentiles += 1
+        # sorting the window on every completion is wasteful, refresh every few samples
+        if self._samples_since_percentiles < max(len(self._latencies) // 10, 1) and self._percentiles[0] is not None:
+            return
+        self._samples_since_percentiles = 0
+        ordered = sorted(self._latencies)
+        p50 = ordered[len(ordered) // 2]
+        p95 = ordered[min(int(len(ordered) * 0.95), len(ordered) - 1)]
+        self._percentiles = (p50, p95)
+        if len(ordered) >= min(10, self._latencies.maxlen):
+            if self.baseline_latency is None:
+                self.baseline_latency = p50
+            else:
+                self.baseline_latency = min(self.baseline_latency * (1 + self.baseline_drift), p50)
+
+    @property
+    def p50_latency(self) -> Optional[float]:
+        return self._percentiles[0]
+
+    @property
+    def p95_latency(self) -> Optional[float]:
+        return self._percentiles[1]
+
+    def snapshot(self) -> Dict[str, Any]:
+        return {
+            "limit": self.limit,
+            "in_flight": self.in_flight,
+            "p50_latency": self.p50_latency,
+            "p95_latency": self.p95_latency,
+            "baseline_latency": self.baseline_latency,
+            "errors": self.num_errors,
+        }
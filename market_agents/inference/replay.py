@@ -0,0 +1,128 @@
+"""
+Record/replay of provider responses, so simulations can be re-run without live endpoints.
+
+In record mode `ParallelAIUtilities` appends every raw response it turns into an `LLMOutput`
+(live, cached, coalesced, streamed or batched, errors included) to a JSONL trace, one line per
+response keyed by `request_hash`:
+
+    {"key": "<sha256>", "client": "openai", "source_id": "agent_3", "response": {...}, "latency": 0.84}
+
+In replay mode requests are answered from the trace instead of the network, so a whole
+`MultiAgentEnvironment` run re-executes at CPU speed with the same completions, which makes it
+usable for profiling, regression tests and benchmarks of everything around the LLM calls.
+Traces ending in `.gz` are compressed.
+"""
+
+import gzip
+import json
+import logging
+import os
+from collections import defaultdict
+from typing import IO, Any, Dict, List, Optional
+
+from market_agents.inference.output_parsing import json_loads
+from market_agents.inference.response_cache import request_hash
+
+
+class ReplayMissError(KeyError):
+    """ Raised by a strict `TraceReplayer` for a request that is not in the trace. """
+
+
+def _open_trace(path: str, mode: str) -> IO[str]:
+    if path.endswith(".gz"):
+        return gzip.open(path, mode + "t", encoding="utf-8")
+    return open(path, mode, encoding="utf-8")
+
+
+class TraceRecorder:
+    """
+    Appends raw responses to a JSONL trace.
+
+    Parameters:
+    - path: The trace file, appended to if it exists.
+    - include_requests: Also store the request payloads, which makes traces larger but readable.
+    """
+
+    def __init__(self, path: str, include_requests: bool = False):
+        self.path = path
+        self.include_requests = include_requests
+        self.num_recorded = 0
+        directory = os.path.dirname(os.path.abspath(path))
+        os.makedirs(directory, exist_ok=True)
+        self._file: Optional[IO[str]] = _open_trace(path, "a")
+
+    def record(self, client: str, request_json: Dict[str, Any], response: Any, source_id: Optional[str] = None, latency: Optional[float] = None,
+               key: Optional[str] = None) -> None:
+        """ Appends the response under `key`, by default the hash of `request_json`. A request rewritten before
+        it was sent (e.g. downgraded by the budget) is keyed by the request as built, which is what replay looks up. """
+        if self._file is None:
+            return
+        entry: Dict[str, Any] = {"key": key if key is not None else request_hash(client, request_json), "client": client, "source_id": source_id, "response": response}
+        if latency is not None:
+            entry["latency"] = round(latency, 4)
+        if self.include_requests:
+            entry["request"] = request_json
+        self._file.write(json.dumps(entry, separators=(",", ":"), ensure_ascii=False, default=str) + "\n")
+        self.num_recorded += 1
+
+    def flush(self) -> None:
+        if self._file is not None:
+            self._file.flush()
+
+    def close(self) -> None:
+        if self._file is not None:
+            self._file.close()
+            self._file = None
+
+
+class TraceReplayer:
+    """
+    Serves raw responses from a trace written by `TraceRecorder`.
+
+    A request recorded several times (the same prompt sent by several agents, or in several
+    rounds) gets its recorded responses in recording order, preferring those recorded for the
+    same prompt context id so every agent gets back its own answer whatever order the responses
+    arrived in; once they are used up the last one is served again. Requests missing from the
+    trace get an error response, or raise `ReplayMissError` when `strict` is set, which is what
+    regression tests want.
+
+    Parameters:
+    - path: The trace file.
+    - strict: Raise instead of answering unknown requests with an error response.
+    """
+
+    def __init__(self, path: str, strict: bool = False):
+        self.path = path
+        self.strict = strict
+        self.num_served = 0
+        self.num_missed = 0
+        # per request key: [source_id, response, served] in recording order
+        self._responses: Dict[str, List[List[Any]]] = defaultdict(list)
+        with _open_trace(path, "r") as file:
+            for line in file:
+                if not line.strip():
+                    continue
+                entry = json_loads(line)
+                self._responses[entry["key"]].append([entry.get("source_id"), entry["response"], False])
+        logging.info(f"Loaded {sum(len(entries) for entries in self._responses.values())} recorded responses from {path}")
+
+    def __len__(self) -> int:
+        return len(self._responses)
+
+    def __contains__(self, key: str) -> bool:
+        return key in self._responses
+
+    def get(self, client: str, request_json: Dict[str, Any], source_id: Optional[str] = None) -> Any:
+        """ The next recorded response to the request, for the prompt context `source_id` if given. """
+        key = request_hash(client, request_json)
+        entries = self._responses.get(key)
+        if not entries:
+            self.num_missed += 1
+            if self.strict:
+                raise ReplayMissError(f"No recorded response for {client} request {key} in {self.path}")
+            return {"error": f"No recorded response for this request in the trace {self.path}"}
+        unserved = [entry for entry in entries if not entry[2]]
+        entry = next((entry for entry in unserved if entry[0] == source_id), unserved[0] if unserved else entries[-1])
+        entry[2] = True
+        self.num_served += 1
+        return entry[1]
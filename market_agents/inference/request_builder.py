@@ -0,0 +1,153 @@
+"""
+Provider request construction for `ParallelAIUtilities`.
+
+Every agent of a simulation usually shares one `LLMConfig` and one `StructuredTool`, so the part
+of a request that does not depend on the conversation (model, sampling parameters, tools,
+tool_choice, response_format) is identical across thousands of prompts. `RequestBuilder` builds
+that part once per (client, config, structured output) as a template, validates it once against
+the provider request model, and stamps each prompt's messages into a shallow copy of it. The
+converted tool / response_format payloads are additionally cached per (client, schema) so
+distinct `StructuredTool` instances with the same schema share them.
+
+Templates and payloads are shared between requests and must be treated as read-only.
+"""
+
+import json
+from collections import OrderedDict
+from typing import Any, Dict, List, Optional, Tuple
+
+from anthropic.types.message_create_params import ToolChoiceToolChoiceTool
+from openai.types.chat.completion_create_params import ResponseFormat
+
+from market_agents.inference.clients_models import AnthropicRequest, OpenAIRequest, VLLMRequest
+from market_agents.inference.message_models import LLMPromptContext, StructuredTool
+from market_agents.inference.prefix_sharing import anthropic_cache_breakpoints
+from market_agents.inference.utils import msg_dict_to_anthropic
+
+REQUEST_MODELS = {"openai": OpenAIRequest, "anthropic": AnthropicRequest, "vllm": VLLMRequest, "litellm": OpenAIRequest}
+MESSAGE_ROLES = {
+    "openai": {"system", "user", "assistant", "tool", "function"},
+    "vllm": {"system", "user", "assistant", "tool", "function"},
+    "litellm": {"system", "user", "assistant", "tool", "function"},
+    "anthropic": {"user", "assistant"},
+}
+# the messages stamped into a template while validating it
+PROBE_MESSAGES = [{"role": "user", "content": "probe"}]
+
+
+class RequestBuilder:
+    """
+    Builds provider request dicts from `LLMPromptContext`s from cached, pre-validated templates.
+
+    Parameters:
+    - max_templates: Templates kept, least recently used ones are dropped beyond it.
+    """
+
+    def __init__(self, max_templates: int = 256):
+        self.max_templates = max_templates
+        # (client, llm_config values, id(structured_output)) -> (structured_output, template);
+        # the tool is kept referenced so its id cannot be reused by another object
+        self._templates: "OrderedDict[Tuple[Any, ...], Tuple[Optional[StructuredTool], Dict[str, Any]]]" = OrderedDict()
+        # (kind, schema, name, description, strict) -> converted tool or response_format
+        self._payloads: Dict[Tuple[Any, ...], Any] = {}
+        self.template_hits = 0
+        self.template_misses = 0
+
+    def clear(self) -> None:
+        self._templates.clear()
+        self._payloads.clear()
+
+    def build(self, prompt: LLMPromptContext, client: str, shared_prefix_length: Optional[int] = None) -> Optional[Dict[str, Any]]:
+        """ The request of `prompt` for `client`, with Anthropic cache breakpoints at `shared_prefix_length` if given. """
+        if client not in REQUEST_MODELS:
+            raise ValueError(f"Invalid client: {client}")
+        template = self.template(prompt, client)
+        request = dict(template)
+        if client == "anthropic":
+            if shared_prefix_length is not None and prompt.llm_config.use_cache:
+                uses_tool = prompt.llm_config.response_format == "tool" and prompt.structured_output is not None
+                breakpoints = anthropic_cache_breakpoints(prompt.messages, shared_prefix_length, max_breakpoints=2 if uses_tool else 3)
+                system_content, messages = msg_dict_to_anthropic(prompt.messages, use_cache=True, cache_breakpoints=breakpoints)
+            else:
+                system_content, messages = prompt.anthropic_messages
+            request["system"] = system_content if system_content else None
+        elif client == "vllm":
+            messages = prompt.vllm_messages
+        else:
+            messages = prompt.oai_messages
+        self._check_messages(messages, client)
+        request["messages"] = messages
+        return request
+
+    def template(self, prompt: LLMPromptContext, client: str) -> Dict[str, Any]:
+        """ The validated request of `prompt` without its messages (and Anthropic system), built once per config and tool. """
+        llm_config = prompt.llm_config
+        structured_output = prompt.structured_output
+        key = (client, tuple(llm_config.__dict__.values()), id(structured_output))
+        entry = self._templates.get(key)
+        if entry is not None and entry[0] is structured_output:
+            self._templates.move_to_end(key)
+            self.template_hits += 1
+            return entry[1]
+        self.template_misses += 1
+        template = self._build_template(prompt, client)
+        # validated once with a placeholder conversation, the per-prompt messages only get a structural check
+        try:
+            REQUEST_MODELS[client](**dict(template, messages=PROBE_MESSAGES))
+        except Exception as e:
+            raise ValueError(f"Error validating {client} request: {e} with request: {template}")
+        self._templates[key] = (structured_output, template)
+        if len(self._templates) > self.max_templates:
+            self._templates.popitem(last=False)
+        return template
+
+    def _build_template(self, prompt: LLMPromptContext, client: str) -> Dict[str, Any]:
+        llm_config = prompt.llm_config
+        structured_output = prompt.structured_output
+        uses_tool = llm_config.response_format == "tool" and structured_output is not None
+        if client in ("vllm", "litellm") and llm_config.response_format == "json_object":
+            raise ValueError("VLLM does not support json_object response format otherwise infinite whitespaces are returned")
+        template: Dict[str, Any] = {"model": llm_config.model, "max_tokens": llm_config.max_tokens, "temperature": llm_config.temperature}
+        if client == "anthropic":
+            tool = self.anthropic_tool(structured_output) if uses_tool else None
+            if tool:
+                template["tools"] = [tool]
+                template["tool_choice"] = ToolChoiceToolChoiceTool(name=structured_output.schema_name, type="tool")
+            return template
+        response_format = self.oai_response_format(prompt)
+        if response_format:
+            template["response_format"] = response_format
+        tool = self.openai_tool(structured_output) if uses_tool else None
+        if tool:
+            template["tools"] = [tool]
+            template["tool_choice"] = {"type": "function", "function": {"name": structured_output.schema_name}}
+        return template
+
+    def oai_response_format(self, prompt: LLMPromptContext) -> Optional[ResponseFormat]:
+        """ `prompt.oai_response_format`, with the json_schema payload shared across prompts with the same schema. """
+        if prompt.llm_config.response_format == "structured_output":
+            assert prompt.structured_output is not None, "Structured output is not set"
+            return self._payload("json_schema", prompt.structured_output, prompt.structured_output.get_openai_json_schema_response)
+        return prompt.oai_response_format
+
+    def openai_tool(self, structured_output: StructuredTool) -> Optional[Dict[str, Any]]:
+        return self._payload("openai_tool", structured_output, structured_output.get_openai_tool)
+
+    def anthropic_tool(self, structured_output: StructuredTool) -> Optional[Dict[str, Any]]:
+        return self._payload("anthropic_tool", structured_output, structured_output.get_anthropic_tool)
+
+    def _payload(self, kind: str, structured_output: StructuredTool, convert) -> Any:
+        if not structured_output.json_schema:
+            return None
+        key = (kind, json.dumps(structured_output.json_schema, sort_keys=True, default=str), structured_output.schema_name,
+               structured_output.schema_description, structured_output.strict_schema)
+        if key not in self._payloads:
+            self._payloads[key] = convert()
+        return self._payloads[key]
+
+    @staticmethod
+    def _check_messages(messages: List[Dict[str, Any]], client: str) -> None:
+        roles = MESSAGE_ROLES[client]
+        for message in messages:
+            if not isinstance(message, dict) or message.get("role") not in roles:
+                raise ValueError(f"Invalid {client} message: {message}")
@@ -0,0 +1,73 @@
+import asyncio
+from dataclasses import dataclass
+from typing import Any, Dict, Optional, Tuple
+
+from market_agents.inference.response_cache import request_hash
+
+
+@dataclass
+class CoalescingStats:
+    """
+    Counters describing how in-flight requests were de-duplicated.
+
+    Attributes:
+    - sent: Distinct requests sent to the provider.
+    - coalesced: Requests answered with the response of an identical request already in flight.
+    - bypassed: Requests not eligible for coalescing because they are sampled (temperature > 0).
+    """
+
+    sent: int = 0
+    coalesced: int = 0
+    bypassed: int = 0
+
+    @property
+    def coalesce_rate(self) -> float:
+        eligible = self.sent + self.coalesced
+        return self.coalesced / eligible if eligible else 0.0
+
+
+class InflightRequests:
+    """
+    Registry of the provider requests currently in flight, keyed by `request_hash`.
+
+    The first caller of `join` for a given request becomes its leader and must later `resolve`
+    (or `cancel`) it; every identical request joining while the leader is in flight gets the
+    leader's future instead of being sent, and receives the same raw response. Sampled requests
+    (temperature > 0) are independent draws and are never coalesced unless
+    `coalesce_nonzero_temperature` is set.
+    """
+
+    def __init__(self, coalesce_nonzero_temperature: bool = False):
+        self.coalesce_nonzero_temperature = coalesce_nonzero_temperature
+        self.stats = CoalescingStats()
+        self._futures: Dict[str, asyncio.Future] = {}
+
+    def is_eligible(self, request_json: Dict[str, Any]) -> bool:
+        if self.coalesce_nonzero_temperature or (request_json.get("temperature") or 0) <= 0:
+            return True
+        self.stats.bypassed += 1
+        return False
+
+    def join(self, client: str, request_json: Dict[str, Any]) -> Tuple[str, Optional[asyncio.Future]]:
+        """ Returns the request key and, if an identical request is already in flight, the future of its response. """
+        key = request_hash(client, request_json)
+        future = self._futures.get(key)
+        if future is not None:
+            self.stats.coalesced += 1
+            return key, future
+        self._futures[key] = asyncio.get_running_loop().create_future()
+        self.stats.sent += 1
+        return key, None
+
+    def resolve(self, key: str, response: Any) -> None:
+        future = self._futures.pop(key, None)
+        if future is not None and not future.done():
+            future.set_result(response)
+
+    def cancel(self, key: str) -> None:
+        future = self._futures.pop(key, None)
+        if future is not None and not future.done():
+            future.cancel()
+
+    def __len__(self) -> int:
+        return len(self._futures)
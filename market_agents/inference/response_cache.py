@@ -0,0 +1,156 @@
+import hashlib
+import json
+import sqlite3
+import time
+from dataclasses import dataclass
+from typing import Any, Dict, Optional
+
+
+def request_hash(client: str, request_json: Dict[str, Any]) -> str:
+    """
+    Canonical content hash of a provider request.
+
+    The request dict (model, messages, system, tools, tool_choice, response_format, temperature,
+    max_tokens, ...) is serialised with sorted keys and no whitespace so that two prompts that
+    would produce byte-identical HTTP bodies for the same client share a key, regardless of
+    dict insertion order or which `LLMPromptContext` produced them.
+    """
+    canonical = json.dumps([client, request_json], sort_keys=True, separators=(",", ":"), ensure_ascii=False, default=str)
+    return hashlib.sha256(canonical.encode("utf-8")).hexdigest()
+
+
+@dataclass
+class CacheStats:
+    """
+    Counters describing how the response cache was used.
+
+    Attributes:
+    - hits: Lookups answered from the cache.
+    - misses: Lookups for cacheable requests that were not found or had expired.
+    - bypassed: Lookups skipped because the request is not deterministic (temperature > 0).
+    - writes: Responses stored.
+    - evictions: Entries removed by TTL expiry or LRU eviction.
+    """
+
+    hits: int = 0
+    misses: int = 0
+    bypassed: int = 0
+    writes: int = 0
+    evictions: int = 0
+
+    @property
+    def hit_rate(self) -> float:
+        lookups = self.hits + self.misses
+        return self.hits / lookups if lookups else 0.0
+
+
+class ResponseCache:
+    """
+    Disk-backed LLM response cache keyed by `request_hash`.
+
+    Entries live in a single SQLite table so they survive restarts and can be shared by
+    sequential runs of the same scenario. Entries older than `ttl_seconds` are treated as misses
+    and purged, and once more than `max_entries` are stored the least recently used ones are
+    evicted (the size is checked every `eviction_interval` writes to keep inserts cheap).
+
+    Sampling at temperature > 0 is not reproducible, so such requests bypass the cache unless
+    `cache_nonzero_temperature` is set.
+
+    Parameters:
+    - path: SQLite database file, ":memory:" keeps the cache in process.
+    - ttl_seconds: Maximum age of an entry, None to keep entries until evicted.
+    - max_entries: Maximum number of entries before LRU eviction, None for unbounded.
+    - eviction_interval: Number of writes between two size checks.
+    - cache_nonzero_temperature: Also serve and store requests with temperature > 0.
+    """
+
+    def __init__(
+        self,
+        path: str,
+        ttl_seconds: Optional[float] = None,
+        max_entries: Optional[int] = 100_000,
+        eviction_interval: int = 100,
+        cache_nonzero_temperature: bool = False,
+    ):
+        self.path = path
+        self.ttl_seconds = ttl_seconds
+        self.max_entries = max_entries
+        self.eviction_interval = eviction_interval
+        self.cache_nonzero_temperature = cache_nonzero_temperature
+        self.stats = CacheStats()
+        self._conn = sqlite3.connect(path, check_same_thread=False, isolation_level=None)
+        self._conn.execute("PRAGMA journal_mode=WAL")
+        self._conn.execute("PRAGMA synchronous=NORMAL")
+        self._conn.execute(
+            "CREATE TABLE IF NOT EXISTS responses ("
+            "key TEXT PRIMARY KEY, client TEXT, response TEXT, created REAL, last_access REAL)"
+        )
+        self._conn.execute("CREATE INDEX IF NOT EXISTS responses_last_access ON responses (last_access)")
+
+    def is_cacheable(self, request_json: Dict[str, Any]) -> bool:
+        return self.cache_nonzero_temperature or (request_json.get("temperature") or 0) <= 0
+
+    def get(self, client: str, request_json: Dict[str, Any]) -> Optional[Dict[str, Any]]:
+        """ Returns the cached raw response for the request, or None on a miss or bypass. """
+        if not self.is_cacheable(request_json):
+            self.stats.bypassed += 1
+            return None
+        key = request_hash(client, request_json)
+        row = self._conn.execute("SELECT response, created FROM responses WHERE key = ?", (key,)).fetchone()
+        now = time.time()
+        if row is None:
+            self.stats.misses += 1
+            return None
+        response, created = row
+        if self.ttl_seconds is not None and now - created > self.ttl_seconds:
+            self._conn.execute("DELETE FROM responses WHERE key = ?", (key,))
+            self.stats.evictions += 1
+            self.stats.misses += 1
+            return None
+        self._conn.execute("UPDATE responses SET last_access = ? WHERE key = ?", (now, key))
+        self.stats.hits += 1
+        return json.loads(response)
+
+    def put(self, client: str, request_json: Dict[str, Any], response: Dict[str, Any]) -> None:
+        """ Stores a successful raw response, error payloads are never cached. """
+        if not self.is_cacheable(request_json) or not isinstance(response, dict) or "error" in response:
+            return
+        key = request_hash(client, request_json)
+        now = time.time()
+        self._conn.execute(
+            "INSERT OR REPLACE INTO responses (key, client, response, created, last_access) VALUES (?, ?, ?, ?, ?)",
+            (key, client, json.dumps(response), now, now),
+        )
+        self.stats.writes += 1
+        if self.stats.writes % self.eviction_interval == 0:
+            self.evict()
+
+    def evict(self) -> None:
+        """ Removes the least recently used entries above max_entries. """
+        if self.max_entries is None:
+            return
+        (count,) = self._conn.execute("SELECT COUNT(*) FROM responses").fetchone()
+        excess = count - self.max_entries
+        if excess > 0:
+            self._conn.execute(
+                "DELETE FROM responses WHERE key IN (SELECT key FROM responses ORDER BY last_access ASC LIMIT ?)",
+                (excess,),
+            )
+            self.stats.evictions += excess
+
+    def purge_expired(self) -> int:
+        if self.ttl_seconds is None:
+            return 0
+        cursor = self._conn.execute("DELETE FROM responses WHERE created < ?", (time.time() - self.ttl_seconds,))
+        self.stats.evictions += cursor.rowcount
+        return cursor.rowcount
+
+    def clear(self) -> None:
+        self._conn.execute("DELETE FROM responses")
+
+    def __len__(self) -> int:
+        (count,) = self._conn.execute("SELECT COUNT(*) FROM responses").fetchone()
+        return count
+
+    def close(self) -> None:
+        self._conn.close()
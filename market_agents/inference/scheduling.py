@@ -0,0 +1,138 @@
+"""
+Priority lanes with per-agent fair sharing for the request dispatcher and the shared limiters.
+
+Requests carry a priority (0 is served first, see `PRIORITY_LEVELS` in message_models) and a
+flow, the id of the agent that sent them. Waiters are served lane by lane, and within a lane by
+start-time fair queueing: every flow gets a virtual start tag of
+`max(lane virtual time, flow's previous finish tag)` and a finish tag `start + cost`, where cost
+is the request's token estimate. A chatty agent's tags run ahead of the lane's virtual time, so
+one request of every other agent is served before its next one, and large prompts count for
+more than small ones. Requests without a flow share the lane's virtual time and are served in
+arrival order.
+
+Waiting on a `RateLimiter`, `AdaptiveConcurrencyLimiter` or `EndpointPool` is ordered this way,
+which is what makes priorities hold across concurrent `run_parallel_ai_completion` calls (e.g.
+one call per agent), and `FairRequestQueue` orders the requests of a single call.
+"""
+
+import asyncio
+import heapq
+import itertools
+from typing import Any, Dict, Hashable, List, Optional, Tuple
+
+OrderKey = Tuple[int, float, int]
+
+
+class FairShare:
+    """ Virtual clocks of the priority lanes and the finish tags of their flows. """
+
+    # finish tags behind the lane's virtual time carry no information and are dropped beyond this many flows
+    max_flows = 10000
+
+    def __init__(self):
+        self._virtual_time: Dict[int, float] = {}
+        self._finish: Dict[Tuple[int, Hashable], float] = {}
+        self._sequence = itertools.count()
+
+    def order_key(self, priority: int = 0, flow: Optional[Hashable] = None, cost: float = 1.0) -> OrderKey:
+        """ The sort key of a new request, lower is served first. """
+        virtual_time = self._virtual_time.get(priority, 0.0)
+        start = virtual_time
+        if flow is not None:
+            start = max(virtual_time, self._finish.get((priority, flow), 0.0))
+            self._finish[(priority, flow)] = start + max(cost, 1.0)
+            if len(self._finish) > self.max_flows:
+                self._prune()
+        return (priority, start, next(self._sequence))
+
+    def served(self, key: OrderKey) -> None:
+        """ Advances the lane's virtual time to the start tag of the request being served. """
+        priority, start, _ = key
+        if start > self._virtual_time.get(priority, 0.0):
+            self._virtual_time[priority] = start
+
+    def _prune(self) -> None:
+        self._finish = {key: finish for key, finish in self._finish.items() if finish > self._virtual_time.get(key[0], 0.0)}
+
+
+class FairLock:
+    """
+    An asyncio lock granted by `FairShare` order instead of arrival order: when it is released the
+    waiter of the highest priority lane with the lowest start tag gets it.
+    """
+
+    def __init__(self):
+        self.share = FairShare()
+        self._held = False
+        self._waiters: List[Tuple[OrderKey, asyncio.Future]] = []
+
+    def locked(self) -> bool:
+        return self._held
+
+    async def acquire(self, priority: int = 0, flow: Optional[Hashable] = None, cost: float = 1.0) -> None:
+        key = self.share.order_key(priority, flow, cost)
+        if not self._held and not self._waiters:
+            self._held = True
+            self.share.served(key)
+            return
+        waiter = asyncio.get_running_loop().create_future()
+        heapq.heappush(self._waiters, (key, waiter))
+        try:
+            await waiter
+        except asyncio.CancelledError:
+            if waiter.done() and not waiter.cancelled():
+                # the lock was handed over just as we were cancelled, pass it on
+                self.release()
+            raise
+        self.share.served(key)
+
+    def release(self) -> None:
+        # ownership goes straight to the next waiter so no newcomer can overtake it
+        while self._waiters:
+            _, waiter = heapq.heappop(self._waiters)
+            if not waiter.done():
+                waiter.set_result(None)
+                return
+        self._held = False
+
+    def hold(self, priority: int = 0, flow: Optional[Hashable] = None, cost: float = 1.0) -> "_FairLockContext":
+        """ `async with lock.hold(priority, flow, cost):` """
+        return _FairLockContext(self, priority, flow, cost)
+
+
+class _FairLockContext:
+    def __init__(self, lock: FairLock, priority: int, flow: Optional[Hashable], cost: float):
+        self.lock = lock
+        self.args = (priority, flow, cost)
+
+    async def __aenter__(self) -> None:
+        await self.lock.acquire(*self.args)
+
+    async def __aexit__(self, *exc_info) -> None:
+        self.lock.release()
+
+
+class FairRequestQueue(asyncio.Queue):
+    """
+    `asyncio.Queue` of `APIRequest`s returned in `FairShare` order of their `priority`, `flow`
+    and `token_consumption`. `None` wake-up sentinels are returned before any request.
+    """
+
+    def _init(self, maxsize: int) -> None:
+        self.share = FairShare()
+        # asyncio.Queue's qsize() and empty() look at _queue, so everything goes into the one heap
+        self._queue: List[Tuple[OrderKey, Any]] = []
+        self._sentinels = itertools.count()
+
+    def _put(self, item: Any) -> None:
+        if item is None:
+            heapq.heappush(self._queue, ((-1, 0.0, next(self._sentinels)), None))
+            return
+        key = self.share.order_key(item.priority, item.flow, item.token_consumption)
+        heapq.heappush(self._queue, (key, item))
+
+    def _get(self) -> Any:
+        key, item = heapq.heappop(self._queue)
+        if item is not None:
+            self.share.served(key)
+        return item
@@ -0,0 +1,172 @@
+import json
+import time
+from typing import Any, AsyncIterator, Dict, List, Optional, Tuple
+
+import aiohttp
+
+
+async def iter_sse_events(response: aiohttp.ClientResponse) -> AsyncIterator[Tuple[Optional[str], str]]:
+    """
+    Parses a server-sent events body into `(event, data)` pairs.
+
+    Multi-line `data:` fields are joined with newlines, comments are skipped and the OpenAI
+    `[DONE]` terminator ends the iteration.
+    """
+    event = None
+    data_lines: List[str] = []
+    async for raw_line in response.content:
+        line = raw_line.decode("utf-8").rstrip("\r\n")
+        if not line:
+            if data_lines:
+                data = "\n".join(data_lines)
+                if data == "[DONE]":
+                    return
+                yield event, data
+            event = None
+            data_lines = []
+            continue
+        if line.startswith(":"):
+            continue
+        field, _, value = line.partition(":")
+        value = value[1:] if value.startswith(" ") else value
+        if field == "event":
+            event = value
+        elif field == "data":
+            data_lines.append(value)
+    if data_lines and "\n".join(data_lines) != "[DONE]":
+        yield event, "\n".join(data_lines)
+
+
+class OpenAIStreamAssembler:
+    """
+    Accumulates `chat.completion.chunk` events (OpenAI, vLLM, LiteLLM) into the dict a
+    non-streaming `chat.completion` call would have returned, including tool calls and usage
+    when `stream_options.include_usage` is set.
+    """
+
+    def __init__(self):
+        self.id: Optional[str] = None
+        self.model: Optional[str] = None
+        self.created: Optional[int] = None
+        self.system_fingerprint: Optional[str] = None
+        self.role = "assistant"
+        self.content: List[str] = []
+        self.tool_calls: Dict[int, Dict[str, Any]] = {}
+        self.finish_reason: Optional[str] = None
+        self.usage: Optional[Dict[str, Any]] = None
+
+    def add(self, event: Optional[str], data: str) -> Optional[str]:
+        """ Consumes one SSE payload and returns the text (or tool argument) fragment it carried. """
+        chunk = json.loads(data)
+        if "error" in chunk:
+            raise StreamError(chunk)
+        self.id = self.id or chunk.get("id")
+        self.model = self.model or chunk.get("model")
+        self.created = self.created or chunk.get("created")
+        self.system_fingerprint = self.system_fingerprint or chunk.get("system_fingerprint")
+        if chunk.get("usage"):
+            self.usage = chunk["usage"]
+        fragments = []
+        for choice in chunk.get("choices") or []:
+            if choice.get("index", 0) != 0:
+                continue
+            delta = choice.get("delta") or {}
+            self.role = delta.get("role") or self.role
+            if delta.get("content"):
+                self.content.append(delta["content"])
+                fragments.append(delta["content"])
+            for tool_call_delta in delta.get("tool_calls") or []:
+                tool_call = self.tool_calls.setdefault(
+                    tool_call_delta.get("index", 0),
+                    {"id": None, "type": "function", "function": {"name": "", "arguments": ""}},
+                )
+                tool_call["id"] = tool_call_delta.get("id") or tool_call["id"]
+                function = tool_call_delta.get("function") or {}
+                tool_call["function"]["name"] += function.get("name") or ""
+                if function.get("arguments"):
+                    tool_call["function"]["arguments"] += function["arguments"]
+                    fragments.append(function["arguments"])
+            if choice.get("finish_reason"):
+                self.finish_reason = choice["finish_reason"]
+        return "".join(fragments) if fragments else None
+
+    def build(self) -> Dict[str, Any]:
+        message: Dict[str, Any] = {"role": self.role, "content": "".join(self.content) if self.content else None}
+        if self.tool_calls:
+            message["tool_calls"] = [self.tool_calls[index] for index in sorted(self.tool_calls)]
+        completion = {
+            "id": self.id or "",
+            "object": "chat.completion",
+            "created": self.created or int(time.time()),
+            "model": self.model or "",
+            "choices": [{"index": 0, "message": message, "finish_reason": self.finish_reason or "stop", "logprobs": None}],
+        }
+        if self.system_fingerprint:
+            completion["system_fingerprint"] = self.system_fingerprint
+        if self.usage:
+            completion["usage"] = self.usage
+        return completion
+
+
+class AnthropicStreamAssembler:
+    """
+    Accumulates Anthropic Messages streaming events (`message_start`, `content_block_*`,
+    `message_delta`) into the dict a non-streaming `/v1/messages` call would have returned.
+    Tool inputs streamed as `input_json_delta` fragments are decoded when their block stops.
+    """
+
+    def __init__(self):
+        self.message: Dict[str, Any] = {}
+        self.blocks: Dict[int, Dict[str, Any]] = {}
+        self.partial_json: Dict[int, List[str]] = {}
+
+    def add(self, event: Optional[str], data: str) -> Optional[str]:
+        """ Consumes one SSE payload and returns the text (or tool input) fragment it carried. """
+        payload = json.loads(data)
+        event_type = payload.get("type", event)
+        if event_type == "error":
+            raise StreamError(payload)
+        if event_type == "message_start":
+            self.message = dict(payload["message"])
+        elif event_type == "content_block_start":
+            self.blocks[payload["index"]] = dict(payload["content_block"])
+            if self.blocks[payload["index"]].get("type") == "tool_use":
+                self.partial_json[payload["index"]] = []
+        elif event_type == "content_block_delta":
+            block = self.blocks[payload["index"]]
+            delta = payload["delta"]
+            if delta.get("type") == "text_delta":
+                block["text"] = block.get("text", "") + delta["text"]
+                return delta["text"]
+            if delta.get("type") == "input_json_delta":
+                self.partial_json[payload["index"]].append(delta["partial_json"])
+                return delta["partial_json"]
+        elif event_type == "content_block_stop":
+            index = payload["index"]
+            if index in self.partial_json:
+                raw_input = "".join(self.partial_json.pop(index))
+                self.blocks[index]["input"] = json.loads(raw_input) if raw_input else {}
+        elif event_type == "message_delta":
+            self.message.update({key: value for key, value in payload.get("delta", {}).items() if value is not None})
+            if payload.get("usage"):
+                self.message.setdefault("usage", {}).update(payload["usage"])
+        return None
+
+    def build(self) -> Dict[str, Any]:
+        message = dict(self.message)
+        message["content"] = [self.blocks[index] for index in sorted(self.blocks)]
+        return message
+
+
+class StreamError(Exception):
+    """ An error event received in the middle of a stream. """
+
+    def __init__(self, payload: Dict[str, Any]):
+        super().__init__(str(payload.get("error", payload)))
+        self.payload = payload
+
+
+def stream_assembler_for_client(client: str):
+    if client == "anthropic":
+        return AnthropicStreamAssembler()
+    return OpenAIStreamAssembler()
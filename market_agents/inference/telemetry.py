@@ -0,0 +1,278 @@
+"""
+Per-request telemetry of `ParallelAIUtilities`.
+
+Every `LLMOutput` produced (live, cached, coalesced, replayed, streamed or batched) is recorded
+as a `RequestSpan` carrying the timings the request engine measured:
+
+- queue_wait: seconds spent in the dispatcher waiting for rate limit or concurrency capacity,
+- wire_time: seconds on the wire, summed over attempts,
+- time_to_first_byte: seconds until the response headers (or first streamed token) arrived,
+
+together with tokens in/out, attempts and whether the answer came from a cache. Spans are kept
+in a bounded buffer, passed to the registered exporters (`OpenTelemetryExporter` forwards them
+to an OpenTelemetry tracer when `opentelemetry-api` is installed) and aggregated per
+provider/model into rolling p50/p95/p99 latencies and counters. `TelemetryServer` exposes the
+aggregates over HTTP during long runs:
+
+    GET /metrics  Prometheus text format
+    GET /stats    JSON snapshot of the aggregates
+    GET /spans    the most recent spans as JSON, `?limit=` to bound them
+    GET /budget   live spend totals of the `BudgetManager`, when one is given
+"""
+
+import logging
+import time
+from collections import defaultdict, deque
+from dataclasses import asdict, dataclass, field
+from typing import Any, Callable, Dict, List, Optional, Tuple
+
+from aiohttp import web
+
+from market_agents.inference.budget import BudgetManager
+from market_agents.inference.rate_limiter import LatencyWindow
+
+try:
+    from opentelemetry import trace as otel_trace
+except ImportError:  # optional, spans are only kept in-process without it
+    otel_trace = None
+
+QUANTILES = (0.5, 0.95, 0.99)
+
+
+@dataclass
+class RequestSpan:
+    """
+    One completed request.
+
+    Attributes:
+    - source_id: The prompt context id.
+    - client: The provider the request was meant for.
+    - model: The model of the request.
+    - endpoint: The URL of the last attempt, None when no request was sent.
+    - start_time, end_time: Wall-clock times from queuing to the final result.
+    - queue_wait: Seconds waiting for rate limit or concurrency capacity, over all attempts.
+    - wire_time: Seconds on the wire, over all attempts.
+    - time_to_first_byte: Seconds from sending the answered attempt to its response headers or first streamed token.
+    - prompt_tokens, completion_tokens: Token usage reported by the provider.
+    - attempts: HTTP attempts made, 0 when answered from a cache or trace.
+    - hedged: Whether a duplicate attempt was sent because the first one was slow.
+    - source: "network", "cache", "coalesced", "replay", "batch" or "budget" (rejected by the budget, nothing sent).
+    - error: The error message when the request failed.
+    """
+
+    source_id: str
+    client: str
+    model: str
+    endpoint: Optional[str]
+    start_time: float
+    end_time: float
+    queue_wait: Optional[float] = None
+    wire_time: Optional[float] = None
+    time_to_first_byte: Optional[float] = None
+    prompt_tokens: Optional[int] = None
+    completion_tokens: Optional[int] = None
+    attempts: int = 0
+    hedged: bool = False
+    source: str = "network"
+    error: Optional[str] = None
+
+    @property
+    def duration(self) -> float:
+        return self.end_time - self.start_time
+
+    def to_dict(self) -> Dict[str, Any]:
+        return dict(asdict(self), duration=self.duration)
+
+
+@dataclass
+class ModelTelemetry:
+    """ Counters and rolling latency windows of one provider/model. """
+
+    window_size: int = 1000
+    requests: int = 0
+    errors: int = 0
+    cache_hits: int = 0
+    retries: int = 0
+    hedged: int = 0
+    prompt_tokens: int = 0
+    completion_tokens: int = 0
+    latencies: Dict[str, LatencyWindow] = field(default_factory=dict)
+
+    def observe(self, name: str, value: Optional[float]) -> None:
+        if value is None:
+            return
+        window = self.latencies.get(name)
+        if window is None:
+            window = self.latencies[name] = LatencyWindow(self.window_size)
+        window.add(value)
+
+    def percentiles(self, name: str) -> Dict[str, Optional[float]]:
+        window = self.latencies.get(name)
+        return {f"p{round(quantile * 100)}": window.percentile(quantile) if window is not None else None for quantile in QUANTILES}
+
+    def snapshot(self) -> Dict[str, Any]:
+        return {
+            "requests": self.requests,
+            "errors": self.errors,
+            "cache_hits": self.cache_hits,
+            "retries": self.retries,
+            "hedged": self.hedged,
+            "prompt_tokens": self.prompt_tokens,
+            "completion_tokens": self.completion_tokens,
+            **{name: self.percentiles(name) for name in sorted(self.latencies)},
+        }
+
+
+class TelemetryRegistry:
+    """
+    Aggregates `RequestSpan`s per (client, model).
+
+    Parameters:
+    - window_size: Samples per rolling latency window, the percentiles cover the last `window_size` requests of a model.
+    - max_spans: Recent spans kept for `recent_spans` and the /spans endpoint.
+    """
+
+    def __init__(self, window_size: int = 1000, max_spans: int = 10000):
+        self.window_size = window_size
+        self.models: Dict[Tuple[str, str], ModelTelemetry] = {}
+        self.spans: deque = deque(maxlen=max_spans)
+        self.exporters: List[Callable[[RequestSpan], None]] = []
+        self.started_at = time.time()
+
+    def add_exporter(self, exporter: Callable[[RequestSpan], None]) -> None:
+        """ Registers a callable receiving every recorded span, e.g. `OpenTelemetryExporter()` or a `JsonlSink.write` wrapper. """
+        self.exporters.append(exporter)
+
+    def record(self, span: RequestSpan) -> None:
+        key = (span.client, span.model)
+        stats = self.models.get(key)
+        if stats is None:
+            stats = self.models[key] = ModelTelemetry(self.window_size)
+        stats.requests += 1
+        if span.error is not None:
+            stats.errors += 1
+        if span.source in ("cache", "coalesced", "replay"):
+            stats.cache_hits += 1
+        stats.retries += max(span.attempts - 1, 0)
+        stats.hedged += span.hedged
+        stats.prompt_tokens += span.prompt_tokens or 0
+        stats.completion_tokens += span.completion_tokens or 0
+        if span.error is None:
+            stats.observe("latency", span.duration)
+            stats.observe("queue_wait", span.queue_wait)
+            stats.observe("wire_time", span.wire_time)
+            stats.observe("time_to_first_byte", span.time_to_first_byte)
+        self.spans.append(span)
+        for exporter in self.exporters:
+            try:
+                exporter(span)
+            except Exception as e:
+                logging.warning(f"Telemetry exporter {exporter!r} failed: {e}")
+
+    def recent_spans(self, limit: Optional[int] = None) -> List[RequestSpan]:
+        spans = list(self.spans)
+        if limit is None:
+            return spans
+        # spans[-0:] would be all of them
+        return spans[-limit:] if limit > 0 else []
+
+    def snapshot(self) -> Dict[str, Dict[str, Dict[str, Any]]]:
+        """ `{client: {model: {counters..., latency: {p50, p95, p99}, queue_wait: {...}, ...}}}` """
+        snapshot: Dict[str, Dict[str, Dict[str, Any]]] = defaultdict(dict)
+        for (client, model), stats in sorted(self.models.items()):
+            snapshot[client][model] = stats.snapshot()
+        return dict(snapshot)
+
+    def render_prometheus(self) -> str:
+        counters = ("requests", "errors", "cache_hits", "retries", "hedged", "prompt_tokens", "completion_tokens")
+        lines = []
+        for name in counters:
+            lines += [f"# TYPE inference_{name}_total counter"]
+            for (client, model), stats in sorted(self.models.items()):
+                lines.append(f'inference_{name}_total{{client="{client}",model="{model}"}} {getattr(stats, name)}')
+        for name in ("latency", "queue_wait", "wire_time", "time_to_first_byte"):
+            lines += [f"# TYPE inference_{name}_seconds summary"]
+            for (client, model), stats in sorted(self.models.items()):
+                window = stats.latencies.get(name)
+                if window is None:
+                    continue
+                for quantile in QUANTILES:
+                    lines.append(f'inference_{name}_seconds{{client="{client}",model="{model}",quantile="{quantile}"}} {window.percentile(quantile)}')
+        return "\n".join(lines) + "\n"
+
+
+class OpenTelemetryExporter:
+    """ Forwards spans to an OpenTelemetry tracer, configure the SDK and its exporter (OTLP, console, ...) as usual. """
+
+    def __init__(self, tracer_name: str = "market_agents.inference"):
+        if otel_trace is None:
+            raise ImportError("OpenTelemetryExporter needs the opentelemetry-api package")
+        self.tracer = otel_trace.get_tracer(tracer_name)
+
+    def __call__(self, span: RequestSpan) -> None:
+        attributes = {f"llm.{key}": value for key, value in asdict(span).items()
+                      if value is not None and key not in ("start_time", "end_time")}
+        otel_span = self.tracer.start_span(f"llm.{span.client}.completion", start_time=int(span.start_time * 1e9), attributes=attributes)
+        if span.error is not None:
+            otel_span.set_status(otel_trace.Status(otel_trace.StatusCode.ERROR, span.error))
+        otel_span.end(end_time=int(span.end_time * 1e9))
+
+
+class TelemetryServer:
+    """
+    Serves a `TelemetryRegistry` over HTTP from the simulation's event loop; port 0 picks a free port.
+    """
+
+    def __init__(self, registry: TelemetryRegistry, host: str = "localhost", port: int = 0, budget: Optional[BudgetManager] = None):
+        self.registry = registry
+        self.budget = budget
+        self.host = host
+        self.port = port
+        self._runner: Optional[web.AppRunner] = None
+
+    @property
+    def url(self) -> str:
+        return f"http://{self.host}:{self.port}"
+
+    async def start(self) -> "TelemetryServer":
+        app = web.Application()
+        app.router.add_get("/metrics", self.metrics)
+        app.router.add_get("/stats", self.stats)
+        app.router.add_get("/spans", self.spans)
+        app.router.add_get("/budget", self.budget_totals)
+        self._runner = web.AppRunner(app, access_log=None)
+        await self._runner.setup()
+        site = web.TCPSite(self._runner, self.host, self.port)
+        await site.start()
+        self.port = self._runner.addresses[0][1]
+        logging.info(f"Serving inference telemetry on {self.url}/metrics")
+        return self
+
+    async def stop(self) -> None:
+        if self._runner is not None:
+            await self._runner.cleanup()
+            self._runner = None
+
+    async def __aenter__(self) -> "TelemetryServer":
+        return await self.start()
+
+    async def __aexit__(self, *exc_info) -> None:
+        await self.stop()
+
+    async def metrics(self, request: web.Request) -> web.Response:
+        return web.Response(text=self.registry.render_prometheus(), content_type="text/plain")
+
+    async def stats(self, request: web.Request) -> web.Response:
+        return web.json_response({"uptime": time.time() - self.registry.started_at, "models": self.registry.snapshot()})
+
+    async def spans(self, request: web.Request) -> web.Response:
+        try:
+            limit = max(int(request.query.get("limit", 100)), 0)
+        except ValueError:
+            raise web.HTTPBadRequest(text="limit must be an integer")
+        return web.json_response([span.to_dict() for span in self.registry.recent_spans(limit)])
+
+    async def budget_totals(self, request: web.Request) -> web.Response:
+        if self.budget is None:
+            raise web.HTTPNotFound(text="No budget configured")
+        return web.json_response(self.budget.snapshot())
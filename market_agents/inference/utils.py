@@ -15,7 +15,7 @@ from openai.types.chat import (
 )
 
 
-from typing import Union, Optional, List, Tuple, Literal, Dict, Any
+from typing import Union, Optional, List, Tuple, Literal, Dict, Any, Iterable
 import json
 import re
 import tiktoken
@@ -81,7 +81,9 @@ def msg_dict_to_oai(messages: List[Dict[str, Any]]) -> List[ChatCompletionMessag
 
         return [convert_message(msg) for msg in messages]
 
-def msg_dict_to_anthropic(messages: List[Dict[str, Any]],use_cache:bool=True,use_prefill:bool=False) -> Tuple[List[PromptCachingBetaTextBlockParam],List[MessageParam]]:
+def msg_dict_to_anthropic(messages: List[Dict[str, Any]],use_cache:bool=True,use_prefill:bool=False,cache_breakpoints:Optional[Iterable[int]]=None) -> Tuple[List[PromptCachingBetaTextBlockParam],List[MessageParam]]:
+        """ cache_breakpoints are indices into messages that get a cache_control marker, by default the last and
+        third to last messages are marked; the system message is always marked when use_cache is set """
         def create_anthropic_system_message(system_message: Optional[Dict[str, Any]],use_cache:bool=True) -> List[PromptCachingBetaTextBlockParam]:
             if system_message and system_message["role"] == "system":
                 text = system_message["content"]
@@ -120,7 +122,9 @@ def msg_dict_to_anthropic(messages: List[Dict[str, Any]],use_cache:bool=True,use
         converted_messages = []
         system_message = []
         num_messages = len(messages)
-        if use_cache:
+        if use_cache and cache_breakpoints is not None:
+            use_cache_ids = set(cache_breakpoints)
+        elif use_cache:
             use_cache_ids = set([num_messages - 1, max(0, num_messages - 3)])
         else:
             use_cache_ids = set()
@@ -53,7 +53,8 @@ async def generate_ai_summary(self, url: str, content: Union[str, Dict[str, Any]
             new_message=formatted_prompt,
             llm_config=llm_config.dict(),
             use_history=False,
-            source_id=context_id
+            source_id=context_id,
+            priority="research_summary"
         )
 
         # Process response with retries